@@ -4,10 +4,23 @@ from typing import List, Dict, Any
 import time
 
 from src.startup_loader import initialize_equipment_data, get_available_buildings, get_building_info_for_prompt, get_filtered_files_by_jurisdiction
+from src.rag_retriever import get_rag_status, RETRIEVAL_METHODS
+from src.context_packer import MODEL_CONTEXT_WINDOWS, pack_prompt_context
+from src.prompts import DEFAULT_PROMPTS
+from src.prompt_data import build_prompt_data
+from src.history_manager import compact_chat_history, schedule_history_summary
 from src.logging_utils import init_logger
 from src.sheets_manager import log_to_sheets, get_sheets_manager, send_prompt_to_model_comparison
-from src.langchain_chains import generate_smart_answer_with_langchain
-from src.building_manager import get_building_manager
+from src.langchain_chains import stream_smart_answer_with_langchain, get_single_flight_stats
+from src.langchain_models import refresh_model_clients
+from src.hedging import HEDGE_ENABLED, get_hedge_policy
+from src.answer_cache import ANSWER_CACHE_ENABLED, CachedAnswer, get_answer_cache
+from src.title_generator import generate_title_async
+from src.prompt_capture import prompt_log_text
+from src.multi_stream import StreamMultiplexer
+from src.usage_ledger import get_usage_ledger, record_usage
+from src.admission import get_admission_controller
+from src.resilience import get_resilience_stats
 from src.firestore_manager import log_to_firestore, send_prompt_to_firestore_comparison
 
 import yaml
@@ -31,6 +44,42 @@ def _sanitize_title(s: str) -> str:
         t = t[1:-1].strip()
     return t[:60] or "Chat"
 
+def _apply_chat_title(sid: str, new_title: str) -> None:
+    """サニタイズと重複回避をしたうえで chat_store のタイトルを更新"""
+    try:
+        sanitized_title = _sanitize_title(new_title)
+        if not sanitized_title:
+            return
+        s = st.session_state.chat_store
+        if sid not in s["by_id"]:
+            return
+        existing_titles = {v["title"] for v in s["by_id"].values() if v.get("title") and v.get("title") != s["by_id"][sid].get("title")}
+        
+        final_title = sanitized_title
+        counter = 2
+        while final_title in existing_titles:
+            final_title = f"{sanitized_title} ({counter})"
+            counter += 1
+        
+        s["by_id"][sid]["title"] = final_title
+        logger.info(f"✅ 新しいタイトルを保存しました: '{final_title}'")
+    except Exception as e:
+        logger.error(f"💥 タイトル保存処理でエラー: {e}", exc_info=True)
+
+def apply_pending_titles() -> None:
+    """バックグラウンドで生成中だったタイトルのうち、完了したものを chat_store に反映"""
+    pending = st.session_state.get("_pending_titles")
+    if not pending or "chat_store" not in st.session_state:
+        return
+    for sid, future in list(pending.items()):
+        if not future.done():
+            continue
+        del pending[sid]
+        try:
+            _apply_chat_title(sid, future.result())
+        except Exception as e:
+            logger.warning(f"⚠️ タイトル生成結果の取得に失敗: {e}")
+
 # === 🔥 改良版：統合されたタイトル更新システム ===
 def ensure_chat_store():
     """
@@ -199,7 +248,7 @@ def post_log(
                 success = log_to_sheets(
                     input_text=input_text,
                     output_text=output_text,
-                    prompt=prompt,
+                    prompt=prompt_log_text(prompt),
                     chat_title=chat_title,
                     user_id=username,
                     session_id=session_id,
@@ -207,7 +256,8 @@ def post_log(
                     model=claude_model,
                     temperature=temperature,
                     max_tokens=max_tokens,
-                    use_rag=use_rag
+                    use_rag=use_rag,
+                    usage=(user_info or {}).get("usage")
                 )
                 
                 logger.info("🔍 Step 5: log_to_sheets result — success=%s", success)
@@ -277,7 +327,7 @@ def post_log(
 
 # 🔥 新しいFirestore用の非同期ログ関数を追加（既存のpost_log_asyncは変更しない）
 def post_log_firestore_async(input_text: str, output_text: str, prompt: str, 
-                             send_to_model_comparison: bool = False):
+                             send_to_model_comparison: bool = False, usage: Dict[str, Any] = None):
     """Firestore専用の非同期ログ投稿関数"""
     try:
         logger.info("🔥 Firestore logging start...")
@@ -308,7 +358,7 @@ def post_log_firestore_async(input_text: str, output_text: str, prompt: str,
         firestore_success = log_to_firestore(
             input_text=input_text,
             output_text=output_text,
-            prompt=prompt,
+            prompt=prompt_log_text(prompt),
             chat_title=chat_title,
             user_id=username or "unknown",
             session_id=session_id or "unknown",
@@ -316,7 +366,8 @@ def post_log_firestore_async(input_text: str, output_text: str, prompt: str,
             model=claude_model or "unknown",
             temperature=temperature,
             max_tokens=max_tokens,
-            use_rag=use_rag
+            use_rag=use_rag,
+            usage=usage
         )
         
         if firestore_success:
@@ -540,7 +591,7 @@ def get_async_logger() -> StreamlitAsyncLogger:
     return async_logger
 
 def post_log_async(input_text: str, output_text: str, prompt: str, 
-                    send_to_model_comparison: bool = False):
+                    send_to_model_comparison: bool = False, usage: Dict[str, Any] = None):
     """非同期ログ投稿の便利関数（セッション状態対応）"""
     try:
         # デバッグ: セッション状態の内容を確認
@@ -568,7 +619,8 @@ def post_log_async(input_text: str, output_text: str, prompt: str,
             "temperature": temperature,
             "max_tokens": max_tokens,
             "use_rag": use_rag,
-            "chat_title": chat_title
+            "chat_title": chat_title,
+            "usage": usage
         }
         
         logger.info("🔍 Final user_info — %s", user_info)
@@ -603,7 +655,8 @@ def post_log_async(input_text: str, output_text: str, prompt: str,
         # フォールバック: 同期処理で確実にログを保存
         try:
             logger.warning("⚠️ Falling back to synchronous logging")
-            post_log(input_text, output_text, prompt, send_to_model_comparison)
+            post_log(input_text, output_text, prompt, send_to_model_comparison,
+                     user_info={"usage": usage} if usage else None)
         except Exception as fallback_error:
             logger.error("❌ Fallback logging also failed — %s", fallback_error)
 
@@ -687,199 +740,8 @@ if st.session_state["authentication_status"]:
     else:
         logger.info("🔍🔍🔍 設備データは既に初期化済み")
 
-    # --------------------------------------------------------------------------- #
-    #                         ★ 各モード専用プロンプト ★                           #
-    # --------------------------------------------------------------------------- #
-    DEFAULT_PROMPTS: Dict[str, str] = {
-        "暗黙知法令チャットモード": """
-    あなたは建築電気設備設計のエキスパートエンジニアです。
-    今回の対象は **複合用途ビルのオフィス入居工事（B工事）** に限定されます。
-    以下の知識と技術をもとに、対話を通じて不足情報を質問しつつ、根拠を示した実務アドバイスを行ってください。
-    専門用語は必要に応じて解説を加え、判断の背景にある理由を丁寧に説明します。
-    ────────────────────────────────
-    ## 【回答方針】
-    **重要：以下の各事項は「代表的なビル（丸の内ビルディング）」を想定して記載しています。他のビルでは仕様や基準が異なる可能性があることを、回答時には必ず言及してください。**
-    **注意：過度に込み入った条件の詳細説明をユーザーに求めることは避け、一般的な設計基準に基づく実務的な回答を心がけてください。**
-
-    ### ■ 暗黙知情報不足時の対応プロセス
-    現在保有している暗黙知情報では適切な回答ができない場合は、以下の手順で対応してください：
-    1. **現状把握の明示**
-    - 「現在の暗黙知情報では、○○ビルの△△設備について十分な情報がございません」と明確に伝える
-    - 一般的な設計基準に基づく暫定的な回答がある場合は、その旨を明記して提供する
-    2. **逆質問の実行**
-    - ユーザーの実務経験や現場知識を活用するため、具体的な逆質問を行う
-    - 質問例：「○○ビルでは△△設備についてどのような仕様・基準をお使いでしょうか？」
-    - 「過去の類似案件では、どのような対応をされましたか？」
-    3. **暗黙知情報の記録**
-    - ユーザーから有効な回答が得られた場合、以下のフォーマットで情報を記録する：
-    ```
-    【暗黙知情報：ビル名、設備名】
-    内容：（ユーザーから得られた情報の要約）
-    適用条件：（どのような条件下で適用されるか）
-    ```
-    4. **情報活用とフィードバック**
-    - 得られた暗黙知情報を元に、改めて適切な回答を提供する
-    - 「この情報は今後の設計業務改善に活用させていただきます」と感謝の意を示す
-
-    ────────────────────────────────
-    ## 【工事区分について】
-    - **B工事**：本システムが対象とする工事。入居者負担でビル側が施工する工事
-    - **C工事**：入居者が独自に施工する工事（電話・LAN・防犯設備など）
-    - 本システムでは、C工事設備については配管類の数量算出のみを行います
-
-    ────────────────────────────────
-    ## 【消防署事前相談の指針】
-    ### ■ 事前相談が必要な状況
-    法令のルールが競合する場合や細かな仕様で判断が分かれる場合は、**必ず消防署への事前相談を行う**ことを推奨してください。
-
-    ### ■ 事前相談のタイミング
-    - **着工届出書提出時**：通常の手続きの中で相談
-    - **軽微な工事で着工届が不要な場合**：別途消防署に出向いて相談
-
-    ### ■ 法令競合の典型例
-    1. **自火報（煙感知器）関連**
-    - 狭い部屋内で「吹き出しから離して設置」「吸込口付近に設置」「入口付近に設置」を同時に満たす場所がない場合
-
-    ### ■ 細かな仕様判断の典型例
-    1. **自火報（煙感知器）関連**
-    - 欄間オープン内に侵入防止バーがあって面積が阻害されている場合
-    - 阻害された面積分を補うように欄間オープンの面積を広げている場合の扱い
-    2. **避難口誘導灯関連**
-    - 扉の直上扱いとして矢印シンボルなしを設置してよい範囲（扉周辺3m程度が目安だが、最終的には担当者判断）
-    - パーテーション等による視認阻害の程度と補完誘導灯設置の要否
-
-    ────────────────────────────────
-    ## 【重要な注意事項】
-    1. **ビル仕様の違い**：上記の内容は丸の内ビルディングを基準としています。他のビルでは異なる仕様・基準が適用される可能性があります。
-    2. **過度な詳細要求の回避**：ユーザーに対して、込み入った条件の詳細説明を過度に求めることは避けてください。
-    3. **工事区分の明確化**：B工事とC工事の区分を常に意識し、C工事設備については配管類のみを扱うことを明確にしてください。
-    4. **法令準拠**：検索結果の言い回しをそのまま複製することを避け、直接引用以外のすべてを自分の言葉で表現します。
-    5. **判断困難時の対応**：法令競合や細かな仕様判断で迷いが生じた場合は、必ず消防署への事前相談を推奨し、一般的な傾向は示しつつも最終判断は消防署見解に委ねることを明記してください。
-    6. **暗黙知収集**：現在の知識で対応できない質問については、積極的にユーザーの実務経験を活用し、将来の暗黙知データベース拡充に貢献してください。
-    7. **資料からの原文抜粋の禁止**：ユーザーから提供された資料や図面からの原文抜粋は行わず、必ず自分の言葉で説明してください。
-
-    ────────────────────────────────
-    ## 【文字数制限と回答作成プロセス】
-    ### 回答は{MAX_CHARS}文字以内で作成してください
-
-    以下のPythonコードを参考に文字数を意識して回答を作成してください：
-
-    ```python
-    def validate_answer_length(answer, max_chars={MAX_CHARS}):
-        char_count = len(answer)
-        
-        print(f"文字数チェック結果:")
-        print(f"- 現在の文字数: {{char_count}}")
-        print(f"- 制限文字数: {{max_chars}}")
-        
-        if char_count > max_chars:
-            excess = char_count - max_chars
-            print(f"- 超過文字数: {{excess}}")
-            print("⚠️ 文字数制限を超過しています")
-            print("→ 以下の方針で要約してください：")
-            print("  1. 重要でない詳細を削除")
-            print("  2. 冗長な表現を簡潔に")
-            print("  3. 例示を減らす")
-            return False
-        else:
-            print("✅ 文字数制限内です")
-            return True
-    ```
-
-    **重要な指示:**
-    1. 回答作成時に文字数を意識する
-    2. 冗長な表現を避ける  
-    3. 要点を簡潔にまとめる
-    4. 回答末尾に「（回答文字数：XXX文字）」を必ず記載
-
-    最大{MAX_CHARS}文字以内で、簡潔かつ的確な回答を心がけてください。
-    """,
-
-        "質疑応答書添削モード": """
-    あなたは建築電気設備分野における質疑応答書作成の専門家です。
-    ユーザーが入力した文章を、見積根拠図や見積書と一緒に提出する質疑応答書として最適な文章に添削してください。
-
-    【重要】添削文のみを出力し、添削内容の説明は一切不要です。
-
-    【添削・整形の仕様】
-    1. **誤字脱字の修正**
-        - 一般的な誤記、表記揺れを修正し、読みやすく整えます。
-
-    2. **表現の統一・調整**
-        - 質疑応答書として適切かつ丁寧な表現に統一・調整します
-        - 文体は敬体（です・ます調）に統一します
-        - 過度な敬語や冗長な表現は避け、簡潔で分かりやすい表現に修正します
-        - 専門用語は業界標準に則って表記統一します
-
-    3. **見積・提案の文脈に合わせた表現**
-        - 指示がなくても合理的に見積もれる内容であれば、**確認文を使わずに断定的に表現**してください。
-        例：「○○については□□として見込んでおります。」
-        - 情報が明らかに不足しており、仕様決定の判断ができない場合のみ、
-        **前提を提示したうえで控えめに確認を促す表現**としてください。
-        例：「図面記載がないため、○○として想定しておりますが、仕様のご確認をお願いいたします。」
-
-    4. **クローズドクエスチョンへの変換**
-        - 「〜でよろしいでしょうか？」「〜でしょうか？」といった**クローズドクエスチョン表現は使用しないでください。**
-        - 「〜と見込んでおります」や「〜とさせていただきたいと考えております」といった**先方のリアクションがなくてもそのまま見積を行えるような文章**が理想です。
-
-    【変換例】
-    変換前：
-    家具コンセント・テレキューブが設置される場所に関してはOA内にOAタップを設置する認識でよろしいでしょうか。
-    変換後：
-    家具コンセント・テレキューブが設置される場所については、OA内にOAタップを設置する前提としております。
-
-    変換前：
-    NW工事（光ケーブル、電話含め）、AV工事は全てC工事という認識でよろしいですね。
-    変換後：
-    NW工事（光ケーブル、電話含む）およびAV工事は、全てC工事区分として想定しております。
-
-    変換前：
-    ＴＶ共聴信号については、壁埋め込みとしコンセントと２連での設置でよろしいでしょうか。また、口数はいくつ必要でしょうか。
-    変換後：
-    TV共聴信号については、コンセントと2連の壁埋め込み型で設置する想定です。必要な口数は未記載のため、ご指示をお願いいたします。
-
-    【出力】
-    添削内容を1つだけ出力してください。説明や理由などの付加情報は一切不要です。
-    出力は添削した質疑応答書の文章のみとしてください。
-
-    【注意点】
-    検索結果の言い回しをそのまま複製することを避け、直接引用以外のすべてを自分の言葉で表現します。
-    """,
-
-    "ビルマスタ質問モード": """
-    あなたは建築電気設備設計のエキスパートエンジニアです。
-    今回の対象は **複合用途ビルのオフィス入居工事（B工事）** に限定されます。
-    提供されたビルマスターデータを参照して、ユーザーの質問に正確に回答してください。
-
-    【回答方針】
-    1. **正確性を最優先**: ビルマスターデータに記載されている情報のみを使用してください  
-    2. **複数ビルの比較**: 複数のビルについて質問された場合は、各ビルの情報を比較して回答してください  
-    3. **情報の出典明示**: 回答する際は、どのビルの情報を参照しているかを明確にしてください  
-    4. **データ不足時の対応**: 要求された情報がデータにない場合は、「情報が記載されていません」と明記し、必要情報を逆質問してください  
-
-    【似ているビルの判定方法】  
-    ビル同士を参考にする必要がある場合は、以下の順で近いものを選んでください。  
-    1. 用途区分（消防）が同じ  
-    2. オーナー  
-        -  三菱であるか
-        -  それ以外か(それ以外の場合でも三菱系のビルを参考とする)
-    3. 竣工年月が近い  
-    4. 延床面積が近い  
-    5. 所在地が近い  
-    該当するビルが複数存在する場合は、回答ビル全てを参考にしてください。
-
-    【注意事項】
-    - ビルマスターデータにない情報は推測しない  
-    - 設備仕様や設計基準はデータに記載されている範囲のみを使用  
-
-    【回答形式】
-    - 簡潔でわかりやすい日本語  
-    - 必要に応じて箇条書きや表形式  
-    - ビル名は正式名称で記載
-    """
-    }
-
     # =====  セッション変数  =======================================================
+    apply_pending_titles()
     ensure_chat_store()
     if "edit_target" not in st.session_state:
         st.session_state.edit_target = None
@@ -932,99 +794,25 @@ if st.session_state["authentication_status"]:
         st.rerun()
     
     # =====  データ準備関数（新規追加）  ===============================================
-    def prepare_prompt_data():
+    def prepare_prompt_data(question: str | None = None):
         """セッション状態から選択されたデータを取得してLangChain用に準備"""
-        current_mode = st.session_state.design_mode
-        
-        equipment_content = None
-        building_content = None
-        target_building_content = None  # 🔥 新規追加
-        other_buildings_content = None  # 🔥 新規追加
-        
-        # 設備資料の取得（暗黙知モードのみ）
-        if current_mode == "暗黙知法令チャットモード":
-            selected_equipment = st.session_state.get("selected_equipment")
-            if selected_equipment:
-                selected_jurisdiction = st.session_state.get("selected_jurisdiction")
-                selected_files_key = f"selected_files_{selected_equipment}_{selected_jurisdiction or 'none'}"
-                selected_files = st.session_state.get(selected_files_key, [])
-                
-                if selected_files:
-                    equipment_texts = []
-                    equipment_data = st.session_state.equipment_data
-                    
-                    for file_name in selected_files:
-                        if file_name in equipment_data[selected_equipment]["files"]:
-                            file_text = equipment_data[selected_equipment]["files"][file_name]
-                            equipment_texts.append(file_text)
-                    
-                    if equipment_texts:
-                        equipment_content = "\n\n".join(equipment_texts)
-        
-        # 🔥 修正: ビル情報の取得（新しいbuilding_mode対応）
-        if current_mode in ["暗黙知法令チャットモード", "ビルマスタ質問モード"]:
-            include_building = st.session_state.get("include_building_info", False)
-            
-            # ビルマスタモードは常にビル情報を使用、暗黙知モードはチェックボックス次第
-            if (current_mode == "ビルマスタ質問モード") or \
-            (current_mode == "暗黙知法令チャットモード" and include_building):
-                
-                building_mode = st.session_state.get("building_mode", "none")
-                selected_building = st.session_state.get("selected_building")
-                
-                try:
-                    building_manager = get_building_manager()
-                    if building_manager and building_manager.available:
-                        
-                        if building_mode == "specific_only" and selected_building:
-                            # 特定ビルのみ（従来の動作）
-                            building_content = building_manager.format_building_info_for_prompt(selected_building)
-                            target_building_content = building_content
-                            other_buildings_content = None
-                            
-                        elif building_mode == "specific_with_others" and selected_building:
-                            # 🔥 新機能: 特定ビル + 他のビル
-                            target_building_content = building_manager.format_building_info_for_prompt(selected_building)
-                            
-                            # 他のビル情報を取得（選択したビル以外）
-                            all_buildings = building_manager.get_building_list()
-                            other_buildings = [b for b in all_buildings if b != selected_building]
-                            
-                            if other_buildings:
-                                other_building_parts = []
-                                for other_building in other_buildings:
-                                    other_info = building_manager.format_building_info_for_prompt(other_building)
-                                    other_building_parts.append(other_info)
-                                other_buildings_content = "\n\n".join(other_building_parts)
-                            else:
-                                other_buildings_content = "他のビル情報はありません。"
-                            
-                            # 従来のbuilding_contentも設定（後方互換性のため）
-                            building_content = target_building_content + "\n\n" + other_buildings_content
-                            
-                        elif building_mode == "all":
-                            # 全ビル情報（従来の動作）
-                            building_content = building_manager.format_building_info_for_prompt()
-                            target_building_content = None
-                            other_buildings_content = building_content
-                            
-                        elif building_mode in ["specific", "specific_only"]:
-                            # 🔥 後方互換性: 既存のspecificモードを specific_only として処理
-                            if selected_building:
-                                building_content = building_manager.format_building_info_for_prompt(selected_building)
-                                target_building_content = building_content
-                                other_buildings_content = None
-                            
-                except Exception as e:
-                    logger.warning(f"⚠️ ビル情報取得失敗: {e}")
-        
-        return {
-            "mode": current_mode,
-            "equipment_content": equipment_content,
-            "building_content": building_content,  # 従来の統合版（後方互換性）
-            "target_building_content": target_building_content,  # 🔥 新規: 対象ビル
-            "other_buildings_content": other_buildings_content,   # 🔥 新規: その他ビル
-        }
+        selected_equipment = st.session_state.get("selected_equipment")
+        selected_jurisdiction = st.session_state.get("selected_jurisdiction")
+        selected_files_key = f"selected_files_{selected_equipment}_{selected_jurisdiction or 'none'}"
+        return build_prompt_data(
+            question,
+            mode=st.session_state.design_mode,
+            equipment_data=st.session_state.get("equipment_data"),
+            selected_equipment=selected_equipment,
+            selected_files=st.session_state.get(selected_files_key, []),
+            selected_jurisdiction=selected_jurisdiction,
+            context_mode=st.session_state.get("context_mode", "full"),
+            retrieval_top_k=st.session_state.get("retrieval_top_k", 8),
+            retrieval_method=st.session_state.get("retrieval_method", "hybrid"),
+            include_building=st.session_state.get("include_building_info", False),
+            building_mode=st.session_state.get("building_mode", "none"),
+            selected_building=st.session_state.get("selected_building"),
+        )
         
     # =====  編集機能用のヘルパー関数（変更なし）  ==============================================
     def handle_save_prompt(mode_name, edited_text):
@@ -1269,6 +1057,40 @@ if st.session_state["authentication_status"]:
                     file_chars = len(eq_info['files'].get(file, ''))
                     st.markdown(f"  - ✅ {file} `{file_tag}` ({file_chars:,}文字)")
 
+    def render_context_mode_setting():
+        """設備資料の渡し方（全文 / 検索）設定UI"""
+        st.markdown("#### 📚 資料の渡し方")
+        
+        context_mode = st.radio(
+            "資料の渡し方",
+            ["full", "retrieval"],
+            index=0 if st.session_state.get("context_mode", "full") == "full" else 1,
+            format_func=lambda x: {
+                "full": "全文（選択ファイルをすべて送信）",
+                "retrieval": "検索（質問に関連する上位チャンクのみ）",
+            }[x],
+            help="検索モードでは入力トークン・コスト・応答開始までの時間を大きく削減できます",
+            label_visibility="collapsed",
+        )
+        st.session_state["context_mode"] = context_mode
+        
+        if context_mode == "retrieval":
+            st.session_state["retrieval_top_k"] = st.slider(
+                "取得チャンク数 (top-k)",
+                min_value=3,
+                max_value=20,
+                value=st.session_state.get("retrieval_top_k", 8),
+                step=1,
+            )
+            st.session_state["retrieval_method"] = st.selectbox(
+                "検索方式",
+                options=list(RETRIEVAL_METHODS.keys()),
+                index=list(RETRIEVAL_METHODS.keys()).index(st.session_state.get("retrieval_method", "hybrid")),
+                format_func=lambda x: RETRIEVAL_METHODS[x],
+                help="ハイブリッドは型式や条文番号などの完全一致語にも強くなります",
+            )
+            st.caption(f"🧭 インデックス状態: {get_rag_status()}")
+
     def render_building_selection(expanded=False):
         """ビル選択UIを描画（共通関数）"""
         with st.expander("🏢 対象ビル選択", expanded=expanded):
@@ -1564,6 +1386,107 @@ if st.session_state["authentication_status"]:
         update_prompts_with_char_limit(st.session_state.char_limit)
         st.session_state.prompts_initialized = True
 
+    def format_compare_caption(metrics: Dict[str, Any], elapsed_s: float) -> str:
+        return (f"⏱️ 最初のトークンまで {metrics.get('ttft_ms', 0) / 1000:.1f}秒 ・ "
+                f"{metrics.get('tokens_per_sec', 0):.0f} tokens/s ・ 合計 {elapsed_s:.1f}秒 ・ "
+                f"入力 {metrics.get('input_tokens', 0):,} / 出力 {metrics.get('output_tokens', 0):,} tokens")
+
+    def record_turn_usage(result: Dict[str, Any], *, purpose: str, latency_s: float, input_tokens_estimate: int,
+                          equipment: str | None, files: List[str]) -> Dict[str, Any] | None:
+        """ターンの使用量・コストを記録（プロバイダが usage を返さなかった場合は送信トークン数の概算で記録）"""
+        usage = result.get("usage")
+        return record_usage(
+            model=result.get("model") or st.session_state.claude_model,
+            usage=usage or {"input_tokens": input_tokens_estimate,
+                            "output_tokens": (result.get("metrics") or {}).get("output_tokens", 0)},
+            purpose=purpose,
+            user=st.session_state.get("username") or st.session_state.get("name"),
+            mode=st.session_state.design_mode,
+            sid=st.session_state.chat_store["current_sid"],
+            equipment=equipment,
+            files=files,
+            latency_s=latency_s,
+            estimated=not usage,
+        )
+
+    def render_usage_summary():
+        """直近 7 日のトークン使用量・コスト（ユーザー × モード × モデル、資料ファイル別）"""
+        with st.expander("💰 使用量・コスト（直近7日）", expanded=False):
+            try:
+                ledger = get_usage_ledger()
+                since = time.time() - 7 * 24 * 3600
+                rows = ledger.aggregate(group_by=("user", "mode", "model"), since=since)
+            except Exception as e:
+                st.warning(f"使用量を取得できませんでした: {e}")
+                return
+            if not rows:
+                st.caption("まだ記録がありません")
+                return
+            st.metric("合計コスト", f"${sum(r['cost_usd'] or 0 for r in rows):,.2f}",
+                      help=f"{sum(r['calls'] for r in rows):,} 回の呼び出し")
+            st.dataframe(rows, hide_index=True, use_container_width=True)
+            by_file = ledger.aggregate_by_file(since=since)
+            if by_file:
+                st.markdown("**資料ファイル別（ターンのコストを使用ファイル数で按分）**")
+                st.dataframe(by_file[:20], hide_index=True, use_container_width=True)
+
+    def render_system_status():
+        """プロバイダのサーキットブレーカー・アドミッション制御・ヘッジ等の状態"""
+        with st.expander("🩺 システム状態", expanded=False):
+            resilience = get_resilience_stats()
+            admission = get_admission_controller().get_stats()
+            state_icons = {"closed": "🟢 正常", "half_open": "🟡 回復確認中", "open": "🔴 停止中"}
+            for provider in sorted(set(resilience["breakers"]) | {"bedrock", "azure"}):
+                breaker = resilience["breakers"].get(provider, {"state": "closed", "consecutive_failures": 0})
+                queue = admission.get(provider, {})
+                st.markdown(f"**{provider}** — {state_icons.get(breaker['state'], breaker['state'])}"
+                            + (f"（あと {breaker['retry_in_s']:.0f}秒で再試行）" if breaker.get("retry_in_s") else ""))
+                st.caption(f"連続失敗 {breaker['consecutive_failures']} ・ 実行中 {queue.get('in_flight', 0)} ・ "
+                           f"待ち {queue.get('waiting', 0)} ・ 待ち時間 p50 {queue.get('wait_p50_s', 0):.1f}秒 / "
+                           f"p95 {queue.get('wait_p95_s', 0):.1f}秒")
+            retry = resilience["retry"]
+            st.caption(f"🔁 再試行 {retry['retries']} 回（回復 {retry['recovered']} / 断念 {retry['gave_up']}）")
+            st.json({
+                "breakers": resilience["breakers"],
+                "admission": admission,
+                "hedge": get_hedge_policy().get_stats(),
+                "single_flight": get_single_flight_stats(),
+            }, expanded=False)
+
+    def render_compare_answers(answer_streams: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """比較モード: 各モデルの回答を列に並べて同時にストリーミング表示し、モデルごとの result を返す"""
+        models = list(answer_streams)
+        columns = st.columns(len(models))
+        placeholders = []
+        for column, model in zip(columns, models):
+            with column:
+                st.markdown(f"**🤖 {model}**")
+                placeholders.append(st.empty())
+
+        texts = ["" for _ in models]
+        multiplexer = StreamMultiplexer(answer_streams.values())
+        for idx, chunk in multiplexer:
+            texts[idx] += chunk
+            placeholders[idx].markdown(texts[idx] + "▌")
+
+        results: Dict[str, Dict[str, Any]] = {}
+        for idx, (column, model) in enumerate(zip(columns, models)):
+            elapsed_s = multiplexer.elapsed_s.get(idx, 0.0)
+            with column:
+                if idx in multiplexer.errors:
+                    placeholders[idx].error(f"回答生成に失敗しました: {multiplexer.errors[idx]}")
+                    results[model] = {"model": model, "answer": "", "metrics": {}, "elapsed_s": elapsed_s,
+                                      "error": str(multiplexer.errors[idx])}
+                    continue
+                placeholders[idx].markdown(texts[idx])
+                result = dict(answer_streams[model].result or {}, elapsed_s=elapsed_s)
+                if result.get("metrics"):
+                    st.caption(format_compare_caption(result["metrics"], elapsed_s))
+                results[model] = result
+        logger.info("🆚 compare_done — %s", " ".join(
+            f"{model}={r['elapsed_s']:.1f}s{'(error)' if r.get('error') else ''}" for model, r in results.items()))
+        return results
+
     # 🔥 サイドバーでの使用（最新コードベースに統合）
     with st.sidebar:
         st.markdown(f"👤 ログインユーザー: `{name}`")
@@ -1613,6 +1536,17 @@ if st.session_state["authentication_status"]:
         )
         st.markdown(f"**🛈 現在のモデル:** `{model_options[st.session_state.claude_model]}`")
 
+        # 同じ質問を複数モデルへ同時に送り、回答を横並びで比較
+        if st.checkbox("🆚 複数モデルで同時に回答（比較モード）", key="compare_mode",
+                       help="選択中のモデルに加えて、ここで選んだモデルにも同じプロンプトを同時に送信します"):
+            compare_candidates = [m for m in model_options if m != st.session_state.claude_model]
+            st.session_state.compare_models = st.multiselect(
+                "比較するモデル",
+                options=compare_candidates,
+                default=[m for m in st.session_state.get("compare_models", compare_candidates[:1]) if m in compare_candidates],
+                format_func=lambda x: model_options[x],
+            )
+
         # ------- モデル詳細設定 -------
         with st.expander("🔧 詳細設定"):
             st.slider("応答の多様性",
@@ -1640,6 +1574,21 @@ if st.session_state["authentication_status"]:
                 st.markdown("**現在の設定**")
                 st.markdown(f"トークン: {custom_max_tokens}")
                 st.markdown(f"温度: {st.session_state.get('temperature', 0.0)}")
+            
+            st.checkbox("🛡️ 応答が遅い場合に別モデルへ同時リクエスト（ヘッジ）",
+                        value=st.session_state.get("hedge_enabled", HEDGE_ENABLED),
+                        key="hedge_enabled",
+                        help="最初のトークンが通常より遅い場合やエラー時に、別プロバイダのモデルにも送信して先に応答した方を使います")
+
+            st.checkbox("⚡ 回答キャッシュを使う",
+                        value=st.session_state.get("use_answer_cache", True),
+                        key="use_answer_cache",
+                        help="同じ資料に対する同じ・よく似た質問には保存済みの回答を返します（オフにすると毎回生成）")
+
+            # 認証情報のローテーション時に接続を作り直す
+            if st.button("🔄 モデル接続をリフレッシュ", help="AWS / Azure の認証情報を更新した後に押してください"):
+                refresh_model_clients()
+                st.success("モデル接続をリフレッシュしました")
 
         st.divider()
 
@@ -1671,6 +1620,7 @@ if st.session_state["authentication_status"]:
             current_equipment = st.session_state.get("selected_equipment")
             if current_equipment:
                 render_file_selection(current_equipment)
+                render_context_mode_setting()
 
             # ビル情報選択（閉じられた状態）
             render_building_selection(expanded=False)
@@ -1702,6 +1652,9 @@ if st.session_state["authentication_status"]:
         
         st.divider()
 
+        render_usage_summary()
+        render_system_status()
+
     # =====  プロンプト編集画面  =================================================
     if st.session_state.edit_target:
         mode_name = st.session_state.edit_target
@@ -1748,6 +1701,20 @@ if st.session_state["authentication_status"]:
                     unsafe_allow_html=True
                 )
 
+            if m["role"] == "assistant" and m.get("cached"):
+                st.caption("⚡ キャッシュから回答")
+
+            if m["role"] == "assistant" and m.get("compare"):
+                with st.expander(f"🆚 比較モデルの回答（{len(m['compare'])}件）", expanded=False):
+                    for column, other in zip(st.columns(len(m["compare"])), m["compare"]):
+                        with column:
+                            st.markdown(f"**🤖 {other['model']}**")
+                            if other.get("error"):
+                                st.error(f"回答生成に失敗しました: {other['error']}")
+                            else:
+                                st.markdown(other["answer"])
+                                st.caption(format_compare_caption(other["metrics"], other["elapsed_s"]))
+
             # 使用設備・ファイルを表示（アシスタントメッセージの場合）
             if m["role"] == "assistant" and "used_equipment" in m:
                 equipment_name = m['used_equipment']
@@ -1776,8 +1743,15 @@ if st.session_state["authentication_status"]:
         with st.chat_message("user"):
             st.markdown(f'<div class="user-message">{user_prompt}</div>', unsafe_allow_html=True)
 
+        # 比較モードでは選択中のモデル + 比較モデルに同時送信（プロンプトの組み立ては 1 回だけ）
+        compare_models = []
+        if st.session_state.get("compare_mode") and st.session_state.get("compare_models"):
+            compare_models = [st.session_state.claude_model] + [
+                m for m in st.session_state.compare_models if m != st.session_state.claude_model]
+        answer_models = compare_models or [st.session_state.claude_model]
+
         # シンプルなステータス表示
-        with st.status(f"🤖 {st.session_state.claude_model} で回答を生成中...", expanded=True) as status:
+        with st.status(f"🤖 {' / '.join(answer_models)} で回答を生成中...", expanded=True) as status:
             # プロンプト取得
             base_prompt = st.session_state.prompts[st.session_state.design_mode]
             # 🔥 LangChainでプロンプト処理も自動化されるため簡素化
@@ -1790,14 +1764,49 @@ if st.session_state["authentication_status"]:
 
             try:
                 # データ準備
-                prompt_data = prepare_prompt_data()
+                prompt_data = prepare_prompt_data(user_prompt)
+                context_stats = prompt_data["context_stats"]
+                
+                # 🔥 直近のターン以外はローリング要約に畳んだ履歴を使う（要約は前ターンの回答後に非同期で更新済み）
+                compacted_history, history_report = compact_chat_history(
+                    st.session_state.chat_store["current_sid"], msgs
+                )
+                context_stats["history_summarized"] = history_report["summarized_messages"]
+
+                # 🔥 セクション別のトークン予算に収まるよう設備資料・ビル情報・履歴を詰め直す
+                # （比較モードでは全モデルに同じ入力を送るため、コンテキストが最も小さいモデルに合わせる）
+                packed = pack_prompt_context(
+                    model=min(answer_models, key=lambda m: MODEL_CONTEXT_WINDOWS.get(m, 128_000)),
+                    system_prompt=prompt,
+                    question=user_prompt,
+                    equipment_content=prompt_data["equipment_content"],
+                    building_content=prompt_data["building_content"],
+                    target_building_content=prompt_data.get("target_building_content"),
+                    other_buildings_content=prompt_data.get("other_buildings_content"),
+                    chat_history=compacted_history,
+                    max_output_tokens=st.session_state.get("max_tokens"),
+                )
+                for key in ("equipment_content", "building_content", "target_building_content", "other_buildings_content"):
+                    prompt_data[key] = packed[key]
+                pack_report = packed["report"]
+                context_stats.update({
+                    "packed_tokens": pack_report["total_tokens"],
+                    "dropped_items": len(pack_report["dropped"]),
+                    "dropped_tokens": pack_report["dropped_tokens"],
+                })
+                if pack_report["dropped"]:
+                    dropped_sections = "・".join(sorted({d["section"] for d in pack_report["dropped"]}))
+                    st.info(f"✂️ トークン予算超過のため {len(pack_report['dropped'])}件"
+                            f"（約{pack_report['dropped_tokens']:,}トークン）を省略: {dropped_sections}")
                 
                 # 使用データの表示
                 if prompt_data["equipment_content"]:
-                    selected_equipment = st.session_state.get("selected_equipment")
-                    selected_files_key = f"selected_files_{selected_equipment}"
-                    selected_files = st.session_state.get(selected_files_key, [])
-                    st.info(f"📄 設備資料使用: {selected_equipment} ({len(selected_files)}ファイル)")
+                    st.info(f"📄 設備資料使用: {prompt_data['used_equipment']} ({len(prompt_data['used_files'])}ファイル)")
+                    
+                    if context_stats["context_mode"] == "retrieval":
+                        reduction = 1 - context_stats["context_chars"] / max(context_stats["full_chars"], 1)
+                        st.info(f"🔎 検索モード: {context_stats['hits']}チャンク "
+                                f"{context_stats['context_chars']:,}文字（全文 {context_stats['full_chars']:,}文字から {reduction:.0%} 削減）")
                 
                 if prompt_data["building_content"]:
                     building_mode = st.session_state.get("building_mode", "none")
@@ -1816,39 +1825,80 @@ if st.session_state["authentication_status"]:
                 is_first_message = len(msgs) == 1
                 is_default_title = st.session_state.current_chat.startswith("Chat ")
                 should_generate_title = is_first_message and is_default_title
+                # タイトルは回答とは別経路（小型モデル or ヒューリスティック）で並行生成
+                title_future = generate_title_async(user_prompt) if should_generate_title else None
                 t_api = time.perf_counter()
                 
-                result = generate_smart_answer_with_langchain(
+                # ⚡ 同じ資料・履歴に対する同じ（または十分に似た）質問は保存済みの回答を使う
+                answer_cache_key, cache_hit = None, None
+                if ANSWER_CACHE_ENABLED and st.session_state.get("use_answer_cache", True) and not compare_models:
+                    try:
+                        answer_cache = get_answer_cache()
+                        answer_cache_key = answer_cache.make_key(
+                            mode=prompt_data["mode"],
+                            model=st.session_state.claude_model,
+                            system_prompt=prompt,
+                            question=user_prompt,
+                            context={key: prompt_data.get(key) for key in (
+                                "equipment_content", "building_content",
+                                "target_building_content", "other_buildings_content")},
+                            chat_history=packed["chat_history"][:-1],
+                            temperature=st.session_state.get("temperature", 0.0),
+                            max_tokens=st.session_state.get("max_tokens"),
+                        )
+                        cache_hit = answer_cache.lookup(answer_cache_key)
+                    except Exception as e:
+                        logger.warning(f"⚠️ 回答キャッシュ参照失敗: {e}")
+                
+                # 🚦 混雑時はプロセス全体のアドミッション制御で順番待ちになる（順番・推定待ち時間を表示）
+                queue_notice = st.empty()
+
+                def show_queue_position(ticket):
+                    queue_notice.warning(f"⏳ 混雑のため順番待ちです: {ticket.provider} の {ticket.position}番目"
+                                         f"（推定 約{ticket.eta_s:.0f}秒・待ち {ticket.wait_s:.0f}秒）")
+
+                # 🔥 ストリーミング: ここではチェーンを準備するだけで、トークンは下の chat_message 内で描画
+                stream_kwargs = dict(
                     prompt=prompt,
                     question=user_prompt,
-                    model=st.session_state.claude_model,
                     mode=prompt_data["mode"],
                     equipment_content=prompt_data["equipment_content"],
                     building_content=prompt_data["building_content"],
                     target_building_content=prompt_data.get("target_building_content"),
                     other_buildings_content=prompt_data.get("other_buildings_content"),
-                    chat_history=msgs,
+                    chat_history=packed["chat_history"],
                     temperature=st.session_state.get("temperature", 0.0),
                     max_tokens=st.session_state.get("max_tokens"),
-                    generate_title=should_generate_title # ★このフラグを追加
+                    generate_title=False,  # 回答はプレーンテキストでストリーミング
+                    user=st.session_state.get("username") or st.session_state.get("name"),
+                    on_queue=show_queue_position,
                 )
-                
-                api_elapsed = time.perf_counter() - t_api
-                
-                assistant_reply = result.get("answer", "エラー：応答がありません。")
-                new_title = result.get("title") # 初回以外はNoneになる
-                complete_prompt = result.get("complete_prompt", prompt)
+                answer_streams = {}
+                if cache_hit:
+                    st.info(f"⚡ 過去の同じ質問への回答をキャッシュから表示します（類似度 {cache_hit['similarity']:.2f}）")
+                    answer_stream = CachedAnswer(cache_hit)
+                elif compare_models:
+                    # 比較対象そのものが別モデルなのでヘッジはしない
+                    answer_streams = {
+                        model: stream_smart_answer_with_langchain(model=model, hedge=False, **stream_kwargs)
+                        for model in compare_models
+                    }
+                    answer_stream = answer_streams[st.session_state.claude_model]
+                else:
+                    answer_stream = stream_smart_answer_with_langchain(
+                        model=st.session_state.claude_model,
+                        hedge=st.session_state.get("hedge_enabled", False),
+                        **stream_kwargs,
+                    )
+                queue_notice.empty()
                 
                 # 使用した設備・ファイル情報の記録
                 used_equipment = "なし（一般知識による回答）"
                 used_files = []
                 
-                if prompt_data["equipment_content"]:
-                    selected_equipment = st.session_state.get("selected_equipment")
-                    if selected_equipment:
-                        used_equipment = selected_equipment
-                        selected_files_key = f"selected_files_{selected_equipment}"
-                        used_files = st.session_state.get(selected_files_key, [])
+                if prompt_data["equipment_content"] and prompt_data["used_equipment"]:
+                    used_equipment = prompt_data["used_equipment"]
+                    used_files = prompt_data["used_files"]
                 
                 processing_mode = "equipment_with_files" if used_files else "no_equipment"
                 
@@ -1861,26 +1911,78 @@ if st.session_state["authentication_status"]:
                     st.info(f"💭 {used_equipment}")
                 else:
                     st.info(f"🔧 処理モード: {processing_mode}")
-                
-                logger.info("💬 LangChain回答完了 — mode=%s equipment=%s files=%d api_elapsed=%.2fs 回答文字数=%d",
-                        processing_mode, used_equipment, len(used_files), api_elapsed, len(assistant_reply))
 
             except Exception as e:
                 logger.exception("❌ LangChain answer_gen failed — %s", e)
                 st.error(f"回答生成時にエラーが発生しました: {e}")
                 st.stop()
 
-            # 画面反映 
+            # 画面反映（トークンが届き次第描画）
+            compare_results = {}
             with st.chat_message("assistant"):
+                try:
+                    if answer_streams:
+                        compare_results = render_compare_answers(answer_streams)
+                    else:
+                        st.write_stream(answer_stream)
+                except Exception as e:
+                    logger.exception("❌ LangChain answer_stream failed — %s", e)
+                    st.error(f"回答生成時にエラーが発生しました: {e}")
+                    st.stop()
+                
+                api_elapsed = time.perf_counter() - t_api
+                result = answer_stream.result or {}
+                assistant_reply = result.get("answer") or "エラー：応答がありません。"
+                complete_prompt = result.get("complete_prompt", prompt)
+                stream_metrics = result.get("metrics", {})
+                # ヘッジ・フェイルオーバー時は実際に回答したモデルを表示
+                answered_model = result.get("model") or st.session_state.claude_model
+                
                 # モデル情報と使用設備・ファイルを応答に追加 
                 if used_files:
                     file_info = f"（{len(used_files)}ファイル使用）"
-                    model_info = f"\n\n---\n*このレスポンスは `{st.session_state.claude_model}` と設備「{used_equipment}」{file_info}で生成されました*"
+                    model_info = f"\n\n---\n*このレスポンスは `{answered_model}` と設備「{used_equipment}」{file_info}で生成されました*"
                 else:
-                    model_info = f"\n\n---\n*このレスポンスは `{st.session_state.claude_model}` で生成されました（設備資料なし）*"
+                    model_info = f"\n\n---\n*このレスポンスは `{answered_model}` で生成されました（設備資料なし）*"
+                if answered_model != st.session_state.claude_model:
+                    model_info += f"\n\n*（`{st.session_state.claude_model}` の応答が遅延・失敗したため切り替え）*"
+
+                # 💰 ターンのトークン使用量・コスト（キャッシュから返した回答は API を呼んでいないので記録しない。
+                # 同じ質問の生成を共有した後続の購読者も、呼び出しは先行の 1 回分なので記録しない）
+                turn_usage, compare_usage = None, {}
+                usage_scope = dict(equipment=used_equipment if used_files else None, files=used_files,
+                                   input_tokens_estimate=context_stats["packed_tokens"])
+                if result.get("answer") and not result.get("cached") and not result.get("coalesced"):
+                    turn_usage = record_turn_usage(result, purpose="answer", latency_s=api_elapsed, **usage_scope)
+                for model, r in compare_results.items():
+                    if model != st.session_state.claude_model and r.get("answer") and not r.get("coalesced"):
+                        compare_usage[model] = record_turn_usage(r, purpose="compare", latency_s=r["elapsed_s"],
+                                                                 **usage_scope)
                 
-                full_reply = assistant_reply + model_info
-                st.markdown(full_reply)
+                st.markdown(model_info)
+                cached_info = result.get("cached")
+                if result.get("coalesced"):
+                    st.caption("🔗 同時に送信された同じ質問の生成結果を共有しました")
+                if cached_info:
+                    st.caption(f"⚡ キャッシュから回答 ・ 類似度 {cached_info['similarity']:.2f} ・ "
+                               f"{cached_info['age_s'] / 3600:.1f}時間前の回答 ・ 元の質問: {cached_info['question'][:40]}")
+                if stream_metrics:
+                    st.caption(f"⏱️ 最初のトークンまで {stream_metrics['ttft_ms'] / 1000:.1f}秒 ・ "
+                               f"{stream_metrics['tokens_per_sec']:.0f} tokens/s ・ 合計 {api_elapsed:.1f}秒"
+                               + (f" ・ 💾 キャッシュ読込 {stream_metrics['cache_read_tokens']:,} / 書込 {stream_metrics['cache_write_tokens']:,} tokens"
+                                  if stream_metrics.get("cache_read_tokens") or stream_metrics.get("cache_write_tokens") else "")
+                               + (f" ・ 💰 ${turn_usage['cost_usd']:.4f}{'（推定）' if turn_usage['estimated'] else ''}"
+                                  if turn_usage else "")
+                               + (f" ・ ⏳ 順番待ち {stream_metrics['queue_wait_ms'] / 1000:.1f}秒"
+                                  if stream_metrics.get("queue_wait_ms", 0) >= 500 else ""))
+            
+            logger.info("💬 LangChain回答完了 — mode=%s equipment=%s files=%d api_elapsed=%.2fs 回答文字数=%d",
+                    processing_mode, used_equipment, len(used_files), api_elapsed, len(assistant_reply))
+            logger.info("📏 context_stats — context_mode=%s context_chars=%d full_chars=%d "
+                        "packed_tokens=%d dropped=%d api_elapsed=%.2fs",
+                    context_stats["context_mode"], context_stats["context_chars"],
+                    context_stats["full_chars"], context_stats["packed_tokens"],
+                    context_stats["dropped_items"], api_elapsed)
 
             # 保存するのは元の応答（付加情報なし）
             msg_to_save = {
@@ -1892,33 +1994,71 @@ if st.session_state["authentication_status"]:
             if used_equipment and used_equipment != "なし（一般知識による回答）":
                 msg_to_save["used_equipment"] = used_equipment
                 msg_to_save["used_files"] = used_files
+            
+            # ターンごとの応答速度（TTFT / tokens per sec）
+            if stream_metrics:
+                msg_to_save["metrics"] = {
+                    "ttft_ms": round(stream_metrics["ttft_ms"]),
+                    "tokens_per_sec": round(stream_metrics["tokens_per_sec"], 1),
+                    "output_tokens": stream_metrics["output_tokens"],
+                    "input_tokens": stream_metrics.get("input_tokens", 0),
+                    "cache_read_tokens": stream_metrics.get("cache_read_tokens", 0),
+                    "cache_write_tokens": stream_metrics.get("cache_write_tokens", 0),
+                    "queue_wait_ms": round(stream_metrics.get("queue_wait_ms", 0)),
+                    "elapsed_s": round(api_elapsed, 2),
+                }
+
+            if cached_info:
+                msg_to_save["cached"] = True
+
+            if turn_usage:
+                msg_to_save["usage"] = turn_usage
+
+            # 比較モードの他モデルの回答（履歴では選択中のモデルの回答を本文とし、他は折りたたんで表示）
+            if compare_results:
+                msg_to_save["compare"] = [
+                    {
+                        "model": model,
+                        "answer": r.get("answer") or "",
+                        "error": r.get("error"),
+                        "elapsed_s": round(r["elapsed_s"], 2),
+                        "metrics": {k: r.get("metrics", {}).get(k, 0) for k in (
+                            "ttft_ms", "tokens_per_sec", "input_tokens", "output_tokens")},
+                        "usage": compare_usage.get(model),
+                    }
+                    for model, r in compare_results.items() if model != st.session_state.claude_model
+                ]
 
             msgs.append(msg_to_save)
 
-            if new_title:
+            # 新しく生成した回答は回答キャッシュへ保存
+            if answer_cache_key and not cached_info and result.get("answer"):
                 try:
-                    # 以前のコードにあったサニタイズと重複回避のロジックをそのまま流用
-                    sanitized_title = _sanitize_title(new_title)
-                    if sanitized_title:
-                        s = st.session_state.chat_store
-                        sid = s["current_sid"]
-                        existing_titles = {v["title"] for v in s["by_id"].values() if v.get("title") and v.get("title") != s["by_id"][sid].get("title")}
-                        
-                        final_title = sanitized_title
-                        counter = 2
-                        while final_title in existing_titles:
-                            final_title = f"{sanitized_title} ({counter})"
-                            counter += 1
-                        
-                        s["by_id"][sid]["title"] = final_title
-                        logger.info(f"✅ 新しいタイトルを保存しました: '{final_title}'")
+                    get_answer_cache().store(answer_cache_key, assistant_reply)
                 except Exception as e:
-                    logger.error(f"💥 タイトル保存処理でエラー: {e}", exc_info=True)
+                    logger.warning(f"⚠️ 回答キャッシュ保存失敗: {e}")
+
+            # 次のターンに備え、直近から外れる古いやり取りをバックグラウンドで要約に畳む
+            schedule_history_summary(st.session_state.chat_store["current_sid"], msgs,
+                                     model=st.session_state.claude_model)
+
+            if title_future is not None:
+                sid = st.session_state.chat_store["current_sid"]
+                if title_future.done():
+                    try:
+                        _apply_chat_title(sid, title_future.result())
+                    except Exception as e:
+                        logger.warning(f"⚠️ タイトル生成結果の取得に失敗: {e}")
+                else:
+                    # 未完了なら次回の再描画時に apply_pending_titles で反映
+                    st.session_state.setdefault("_pending_titles", {})[sid] = title_future
 
             # ログ保存
             logger.info("📝 Executing post_log operations")
-            post_log_async(user_prompt, assistant_reply, complete_prompt, send_to_model_comparison=True) 
-            post_log_firestore_async(user_prompt, assistant_reply, complete_prompt, send_to_model_comparison=True)
+            post_log_async(user_prompt, assistant_reply, complete_prompt, send_to_model_comparison=True,
+                           usage=turn_usage)
+            post_log_firestore_async(user_prompt, assistant_reply, complete_prompt, send_to_model_comparison=True,
+                                     usage=turn_usage)
 
             # 通常のrerun（タイトル更新時以外）
             st.rerun()
@@ -0,0 +1,344 @@
+# src/admission.py
+"""
+LLM 呼び出しのアドミッション制御（プロセス全体）
+
+Streamlit の各セッションが独立に Bedrock / Azure を呼ぶと、利用者が集中した時にプロバイダの
+スロットリングが全員に波及する。チャットモデルの呼び出し前に本モジュールでチケットを取得し、
+
+- プロバイダごとのトークンバケット（毎分のリクエスト数とバースト）と同時実行数の上限
+- 利用者ごとの同時実行数の上限
+- 公平キュー（利用者ごとの仮想時刻で順番を決め、1 人の連投が他の利用者を待たせない）
+
+を満たした順に実行を許可する。待ち中は順番（position）と推定待ち時間（eta_s）を参照でき、
+待ち時間は get_stats() の p50 / p95 として集計する。
+"""
+from __future__ import annotations
+
+import itertools
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional
+
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "ADMISSION_ENABLED",
+    "AdmissionTimeout",
+    "ProviderLimit",
+    "AdmissionTicket",
+    "AdmissionController",
+    "get_admission_controller",
+    "admitted_stream",
+]
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") not in ("0", "false", "False")
+_PER_USER_CONCURRENCY = int(os.getenv("ADMISSION_PER_USER", "4"))
+_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", "120"))
+
+class AdmissionTimeout(RuntimeError):
+    """待ち時間の上限を超えた（または即時実行を要求したが枠がなかった）"""
+
+@dataclass
+class ProviderLimit:
+    requests_per_minute: float
+    burst: int
+    max_concurrency: int
+
+    @classmethod
+    def from_env(cls, provider: str, *, rpm: float, concurrency: int) -> "ProviderLimit":
+        prefix = f"ADMISSION_{provider.upper()}"
+        rpm = float(os.getenv(f"{prefix}_RPM", str(rpm)))
+        return cls(
+            requests_per_minute=rpm,
+            burst=int(os.getenv(f"{prefix}_BURST", str(max(int(rpm // 6), 1)))),
+            max_concurrency=int(os.getenv(f"{prefix}_CONCURRENCY", str(concurrency))),
+        )
+
+def _default_limits() -> Dict[str, ProviderLimit]:
+    return {
+        "bedrock": ProviderLimit.from_env("bedrock", rpm=30, concurrency=8),
+        "azure": ProviderLimit.from_env("azure", rpm=60, concurrency=8),
+    }
+
+class _TokenBucket:
+    def __init__(self, rate_per_s: float, capacity: int):
+        self.rate_per_s = rate_per_s
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_s)
+        self.updated = now
+
+    def try_take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def seconds_until(self, n: float, now: float) -> float:
+        """n 個目のトークンが貯まるまでの秒数"""
+        self._refill(now)
+        return max(n - self.tokens, 0.0) / self.rate_per_s if self.rate_per_s > 0 else math.inf
+
+class _ProviderState:
+    def __init__(self, limit: ProviderLimit):
+        self.limit = limit
+        self.bucket = _TokenBucket(limit.requests_per_minute / 60.0, limit.burst)
+        self.waiting: List["AdmissionTicket"] = []
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self.user_finish: Dict[str, float] = {}
+        self.avg_hold_s = 10.0  # 1 回の呼び出しが枠を占有する時間（指数移動平均）
+        self.waits: Deque[float] = deque(maxlen=500)
+        self.stats = {"admitted": 0, "queued": 0, "timeouts": 0, "rejected": 0}
+
+class AdmissionTicket:
+    """実行許可。with 文または release() で枠を返す"""
+
+    def __init__(self, controller: "AdmissionController", provider: str, user: str, tag: float, seq: int):
+        self._controller = controller
+        self.provider = provider
+        self.user = user
+        self.tag = tag
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self.released = False
+
+    @property
+    def granted(self) -> bool:
+        return self.granted_at is not None
+
+    @property
+    def wait_s(self) -> float:
+        return (self.granted_at or time.monotonic()) - self.enqueued_at
+
+    @property
+    def position(self) -> int:
+        """キュー内の順番（1 始まり、実行中は 0）"""
+        return self._controller._position(self)
+
+    @property
+    def eta_s(self) -> float:
+        """実行開始までの推定秒数"""
+        return self._controller._eta(self)
+
+    def release(self) -> None:
+        self._controller._release(self)
+
+    def __enter__(self) -> "AdmissionTicket":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.release()
+
+class AdmissionController:
+    """プロバイダ別のトークンバケット + 利用者別上限 + 公平キュー"""
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, ProviderLimit]] = None,
+        *,
+        per_user_concurrency: int = _PER_USER_CONCURRENCY,
+        max_wait_s: float = _MAX_WAIT_S,
+    ):
+        self._providers = {name: _ProviderState(limit) for name, limit in (limits or _default_limits()).items()}
+        self.per_user_concurrency = per_user_concurrency
+        self.max_wait_s = max_wait_s
+        self._user_in_flight: Dict[str, int] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _state(self, provider: str) -> _ProviderState:
+        state = self._providers.get(provider)
+        if state is None:
+            state = self._providers[provider] = _ProviderState(ProviderLimit.from_env(provider, rpm=60, concurrency=8))
+        return state
+
+    # — 割り当て（ロック保持中に呼ぶ） —
+    def _dispatch_locked(self) -> None:
+        now = time.monotonic()
+        granted = False
+        for provider, state in self._providers.items():
+            for ticket in sorted(state.waiting, key=lambda t: (t.tag, t.seq)):
+                if state.in_flight >= state.limit.max_concurrency:
+                    break
+                if self._user_in_flight.get(ticket.user, 0) >= self.per_user_concurrency:
+                    continue  # この利用者は上限に達しているので次の利用者へ
+                if not state.bucket.try_take(now):
+                    break
+                self._grant_locked(state, ticket, now)
+                granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _grant_locked(self, state: _ProviderState, ticket: AdmissionTicket, now: float) -> None:
+        state.waiting.remove(ticket)
+        state.in_flight += 1
+        state.virtual_time = max(state.virtual_time, ticket.tag)
+        state.stats["admitted"] += 1
+        state.waits.append(now - ticket.enqueued_at)
+        self._user_in_flight[ticket.user] = self._user_in_flight.get(ticket.user, 0) + 1
+        ticket.granted_at = now
+
+    def _enqueue_locked(self, provider: str, user: str) -> AdmissionTicket:
+        state = self._state(provider)
+        # 利用者ごとの仮想時刻: 連投した利用者のチケットほど後ろに並ぶ
+        tag = max(state.virtual_time, state.user_finish.get(user, 0.0))
+        state.user_finish[user] = tag + 1.0
+        ticket = AdmissionTicket(self, provider, user, tag, next(self._seq))
+        state.waiting.append(ticket)
+        return ticket
+
+    def _withdraw_locked(self, ticket: AdmissionTicket) -> None:
+        state = self._state(ticket.provider)
+        if ticket in state.waiting:
+            state.waiting.remove(ticket)
+            # 取り下げた分だけ利用者の仮想時刻を戻す
+            state.user_finish[ticket.user] = max(state.user_finish.get(ticket.user, 0.0) - 1.0, state.virtual_time)
+
+    # — 公開 API —
+    def acquire(
+        self,
+        provider: str,
+        user: Optional[str],
+        *,
+        timeout: Optional[float] = None,
+        on_wait: Optional[Callable[[AdmissionTicket], None]] = None,
+        poll_s: float = 0.5,
+    ) -> AdmissionTicket:
+        """
+        実行許可が出るまで待つ。on_wait は待っている間 poll_s ごとに（呼び出し元のスレッドで）呼ばれる。
+        timeout（既定 max_wait_s）を超えたら AdmissionTimeout。
+        """
+        user = user or "anonymous"
+        deadline = time.monotonic() + (self.max_wait_s if timeout is None else timeout)
+        with self._cond:
+            ticket = self._enqueue_locked(provider, user)
+            self._dispatch_locked()
+        if not ticket.granted:
+            with self._cond:
+                self._state(provider).stats["queued"] += 1
+            logger.info("⏳ admission — provider=%s user=%s position=%d eta≈%.0fs",
+                        provider, user, ticket.position, ticket.eta_s)
+        while not ticket.granted:
+            if on_wait:
+                on_wait(ticket)
+            with self._cond:
+                now = time.monotonic()
+                if ticket.granted:
+                    break
+                if now >= deadline:
+                    self._withdraw_locked(ticket)
+                    self._state(provider).stats["timeouts"] += 1
+                    raise AdmissionTimeout(
+                        f"{provider} が混雑しているため {self.max_wait_s if timeout is None else timeout:.0f}秒以内に実行できませんでした"
+                    )
+                state = self._state(provider)
+                wake = min(poll_s, deadline - now, max(state.bucket.seconds_until(1.0, now), 0.01))
+                self._cond.wait(timeout=wake)
+                self._dispatch_locked()
+        if ticket.wait_s >= 1.0:
+            logger.info("✅ admission — provider=%s user=%s waited=%.1fs", provider, user, ticket.wait_s)
+        return ticket
+
+    def try_acquire(self, provider: str, user: Optional[str]) -> Optional[AdmissionTicket]:
+        """今すぐ実行できる場合のみチケットを返す（ヘッジの副リクエスト用）"""
+        with self._cond:
+            ticket = self._enqueue_locked(provider, user or "anonymous")
+            self._dispatch_locked()
+            if ticket.granted:
+                return ticket
+            self._withdraw_locked(ticket)
+            self._state(provider).stats["rejected"] += 1
+            return None
+
+    @contextmanager
+    def admit(self, provider: str, user: Optional[str], **kwargs: Any) -> Iterator[AdmissionTicket]:
+        ticket = self.acquire(provider, user, **kwargs)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def _release(self, ticket: AdmissionTicket) -> None:
+        with self._cond:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            state = self._state(ticket.provider)
+            state.in_flight -= 1
+            state.avg_hold_s = 0.8 * state.avg_hold_s + 0.2 * (time.monotonic() - ticket.granted_at)
+            remaining = self._user_in_flight.get(ticket.user, 1) - 1
+            if remaining > 0:
+                self._user_in_flight[ticket.user] = remaining
+            else:
+                self._user_in_flight.pop(ticket.user, None)
+            self._dispatch_locked()
+            self._cond.notify_all()
+
+    # — 参照 —
+    def _position(self, ticket: AdmissionTicket) -> int:
+        with self._cond:
+            if ticket.granted:
+                return 0
+            key = (ticket.tag, ticket.seq)
+            return 1 + sum(1 for t in self._state(ticket.provider).waiting if (t.tag, t.seq) < key)
+
+    def _eta(self, ticket: AdmissionTicket) -> float:
+        position = self._position(ticket)
+        if position == 0:
+            return 0.0
+        with self._cond:
+            state = self._state(ticket.provider)
+            rate_eta = state.bucket.seconds_until(float(position), time.monotonic())
+            concurrency_eta = 0.0
+            if state.in_flight >= state.limit.max_concurrency:
+                concurrency_eta = state.avg_hold_s * math.ceil(position / state.limit.max_concurrency)
+            return max(rate_eta, concurrency_eta)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {}
+        with self._cond:
+            for provider, state in self._providers.items():
+                waits = sorted(state.waits)
+                stats[provider] = dict(
+                    state.stats,
+                    waiting=len(state.waiting),
+                    in_flight=state.in_flight,
+                    tokens=round(state.bucket.tokens, 2),
+                    wait_p50_s=round(waits[len(waits) // 2], 2) if waits else 0.0,
+                    wait_p95_s=round(waits[min(int(len(waits) * 0.95), len(waits) - 1)], 2) if waits else 0.0,
+                    limit=vars(state.limit),
+                )
+            stats["users_in_flight"] = dict(self._user_in_flight)
+        return stats
+
+def admitted_stream(ticket: AdmissionTicket, chunks: Iterable[Any]) -> Iterator[Any]:
+    """ストリームを読み終える（または close される）と ticket を返すジェネレータ"""
+    try:
+        yield from chunks
+    finally:
+        ticket.release()
+
+_admission_controller: Optional[AdmissionController] = None
+_admission_controller_lock = threading.Lock()
+
+def get_admission_controller() -> AdmissionController:
+    """プロセス共通の AdmissionController を取得"""
+    global _admission_controller
+    with _admission_controller_lock:
+        if _admission_controller is None:
+            _admission_controller = AdmissionController()
+            logger.info("🚦 AdmissionController 初期化: %s", {
+                name: vars(state.limit) for name, state in _admission_controller._providers.items()})
+        return _admission_controller
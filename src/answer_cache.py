@@ -0,0 +1,313 @@
+# src/answer_cache.py
+"""
+質問 + コンテキストのフィンガープリントをキーにした回答キャッシュ
+
+同じ資料に対する定番の質問（感知器の設置間隔、誘導灯の区分など）は利用者が違っても繰り返されるため、
+(モード, モデル, 生成パラメータ, system プロンプト, 資料ブロック, 履歴) が一致し、
+質問が正規化一致または埋め込みの類似度がしきい値以上なら保存済みの回答を返す。
+
+- TTL（ANSWER_CACHE_TTL 秒）を過ぎたエントリは使わない
+- 資料（コーパス）の版が変わったら set_corpus_version で古いエントリを破棄する
+- 埋め込みが使えない環境では正規化一致のみで動作する
+- 意味的一致は質問中の数値・英字（寸法・単位など）が一致する場合のみ採用する
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.embedding_cache import get_cache_dir
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "ANSWER_CACHE_ENABLED",
+    "normalize_question",
+    "AnswerCache",
+    "CachedAnswer",
+    "get_answer_cache",
+    "compute_corpus_version",
+]
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "1") not in ("0", "false", "False")
+_DEFAULT_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+_DEFAULT_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+_MAX_CANDIDATES = 200
+_EMBED_COOLDOWN_S = float(os.getenv("ANSWER_CACHE_EMBED_COOLDOWN_S", "60"))
+
+_PUNCT = re.compile(r"[\s、。，．,.？?！!「」『』（）()\[\]【】・:：;；\"'“”‘’]+")
+
+def normalize_question(question: str) -> str:
+    """全角/半角・大文字小文字・空白・句読点の違いを吸収した比較用の質問文"""
+    text = unicodedata.normalize("NFKC", question or "").lower()
+    return _PUNCT.sub("", text)
+
+# 数値（4, 2.5）と英字（m, mm, lx, led）。NFKC 後の正規化質問から取り出す
+_LITERAL_TOKENS = re.compile(r"[0-9]+(?:\.[0-9]+)*|[a-z]+")
+
+def _literal_tokens(question_norm: str) -> List[str]:
+    """
+    類似度では区別できない数値・単位（「4m以下」と「8m以下」など）。
+    意味的一致はこれが完全に一致する場合だけ採用する。
+    """
+    return sorted(_LITERAL_TOKENS.findall(question_norm))
+
+def _sha(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+def compute_corpus_version(equipment_data: Dict[str, Any]) -> str:
+    """設備資料（設備名・ファイル名・本文）のハッシュ。資料の追加・更新・削除で変わる"""
+    digest = hashlib.sha256()
+    for equipment_name in sorted(equipment_data):
+        files = equipment_data[equipment_name].get("files", {})
+        for file_name in sorted(files):
+            digest.update(f"{equipment_name}\x1f{file_name}\x1f".encode("utf-8"))
+            digest.update(_sha(files[file_name]).encode("ascii"))
+    return digest.hexdigest()[:16]
+
+def _default_embed(texts: Sequence[str]) -> List[List[float]]:
+    from src.rag_vector import embed_queries
+    return embed_queries(texts)
+
+class AnswerCache:
+    """SQLite に (scope, 正規化質問, 質問埋め込み, 回答) を保存する回答キャッシュ"""
+
+    def __init__(
+        self,
+        db_path: str | None = None,
+        *,
+        ttl_seconds: float = _DEFAULT_TTL,
+        similarity_threshold: float = _DEFAULT_SIMILARITY,
+        embed_fn: Optional[Callable[[Sequence[str]], List[List[float]]]] = _default_embed,
+    ):
+        self.db_path = db_path or os.path.join(get_cache_dir(), "answer_cache.sqlite3")
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._embed_fn = embed_fn
+        self._embed_retry_at = 0.0  # 埋め込みの一時的な失敗後、この時刻までは正規化一致のみで動作
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                id             INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope          TEXT NOT NULL,
+                question_norm  TEXT NOT NULL,
+                question       TEXT NOT NULL,
+                embedding      BLOB,
+                answer         TEXT NOT NULL,
+                mode           TEXT NOT NULL,
+                model          TEXT NOT NULL,
+                corpus_version TEXT NOT NULL,
+                created_at     REAL NOT NULL,
+                hits           INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_answer_cache_scope ON answer_cache (scope, question_norm);
+            CREATE TABLE IF NOT EXISTS answer_cache_meta (
+                key   TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            """
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT value FROM answer_cache_meta WHERE key = 'corpus_version'").fetchone()
+        self.corpus_version = row[0] if row else ""
+        self.stats = {"lookups": 0, "exact_hits": 0, "semantic_hits": 0, "stores": 0, "invalidated": 0}
+
+    # — キー —
+    def make_key(
+        self,
+        *,
+        mode: str,
+        model: str,
+        system_prompt: str,
+        question: str,
+        context: Dict[str, Optional[str]],
+        chat_history: Optional[Sequence[Dict[str, str]]] = None,
+        temperature: float = 0.0,
+        max_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        質問以外の入力をまとめた scope と正規化済み質問を返す。
+        chat_history は今回の質問を除いた履歴（履歴が違えば別の scope になる）。
+        """
+        scope_parts = {
+            "mode": mode,
+            "model": model,
+            "temperature": float(temperature or 0.0),
+            "max_tokens": max_tokens,
+            "system": _sha(system_prompt),
+            "context": {k: _sha(v) for k, v in sorted(context.items()) if v},
+            "history": [_sha(f"{m.get('role')}:{m.get('content')}") for m in (chat_history or [])],
+            "corpus": self.corpus_version,
+        }
+        return {
+            "scope": _sha(json.dumps(scope_parts, sort_keys=True)),
+            "question": question,
+            "question_norm": normalize_question(question),
+            "mode": mode,
+            "model": model,
+        }
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        if self._embed_fn is None or time.monotonic() < self._embed_retry_at:
+            return None
+        try:
+            vector = np.asarray(self._embed_fn([text])[0], dtype=np.float32)
+        except Exception as e:
+            # タイムアウト・429 などは一時的なので、しばらく正規化一致のみで動作してから再開する
+            self._embed_retry_at = time.monotonic() + _EMBED_COOLDOWN_S
+            logger.warning(f"⚠️ 回答キャッシュ: 埋め込み取得失敗のため {_EMBED_COOLDOWN_S:.0f}秒間 正規化一致のみで動作: {e}")
+            return None
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else None
+
+    # — 参照・保存 —
+    def lookup(self, key: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """一致するエントリがあれば {answer, question, similarity, age_s, model} を返す"""
+        min_created = time.time() - self.ttl_seconds
+        with self._lock:
+            self.stats["lookups"] += 1
+            row = self._conn.execute(
+                "SELECT id, question, answer, model, created_at FROM answer_cache "
+                "WHERE scope = ? AND question_norm = ? AND created_at >= ? ORDER BY created_at DESC LIMIT 1",
+                (key["scope"], key["question_norm"], min_created),
+            ).fetchone()
+        similarity = 1.0
+        if row is None:
+            row, similarity = self._semantic_lookup(key, min_created)
+            if row is None:
+                return None
+            kind = "semantic_hits"
+        else:
+            kind = "exact_hits"
+
+        entry_id, question, answer, model, created_at = row
+        with self._lock:
+            self.stats[kind] += 1
+            self._conn.execute("UPDATE answer_cache SET hits = hits + 1 WHERE id = ?", (entry_id,))
+            self._conn.commit()
+        logger.info("⚡ answer_cache hit — kind=%s similarity=%.3f age=%.0fs question=%r",
+                    kind, similarity, time.time() - created_at, question[:40])
+        return {"answer": answer, "question": question, "similarity": similarity,
+                "age_s": time.time() - created_at, "model": model}
+
+    def _semantic_lookup(self, key: Dict[str, Any], min_created: float):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, question, answer, model, created_at, embedding FROM answer_cache "
+                "WHERE scope = ? AND created_at >= ? AND embedding IS NOT NULL ORDER BY created_at DESC LIMIT ?",
+                (key["scope"], min_created, _MAX_CANDIDATES),
+            ).fetchall()
+        if not rows:
+            return None, 0.0
+        query = self._embed(key["question"])
+        if query is None:
+            return None, 0.0
+        matrix = np.stack([np.frombuffer(r[5], dtype=np.float32) for r in rows])
+        scores = matrix @ query
+        # 数値・単位が違う質問は類似度が高くても別の質問（違えば正規化一致のみ）
+        literals = _literal_tokens(key["question_norm"])
+        for best in np.argsort(-scores):
+            if scores[best] < self.similarity_threshold:
+                break
+            if _literal_tokens(normalize_question(rows[best][1])) == literals:
+                return rows[best][:5], float(scores[best])
+        return None, float(scores.max())
+
+    def store(self, key: Dict[str, Any], answer: str) -> None:
+        if not answer:
+            return
+        vector = self._embed(key["question"])
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answer_cache (scope, question_norm, question, embedding, answer, mode, model, corpus_version, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key["scope"], key["question_norm"], key["question"],
+                 vector.tobytes() if vector is not None else None,
+                 answer, key["mode"], key["model"], self.corpus_version, time.time()),
+            )
+            self._conn.commit()
+            self.stats["stores"] += 1
+
+    # — 無効化 —
+    def set_corpus_version(self, version: str) -> int:
+        """資料の版を更新し、別の版で作られたエントリと期限切れエントリを削除する（削除件数を返す）"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM answer_cache WHERE corpus_version != ? OR created_at < ?",
+                (version, time.time() - self.ttl_seconds),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answer_cache_meta (key, value) VALUES ('corpus_version', ?)", (version,)
+            )
+            self._conn.commit()
+            removed = cursor.rowcount
+            changed = version != self.corpus_version
+            self.corpus_version = version
+            self.stats["invalidated"] += removed
+        if removed or changed:
+            logger.info("🧹 answer_cache — corpus_version=%s removed=%d", version, removed)
+        return removed
+
+    def invalidate(self, mode: Optional[str] = None) -> int:
+        """mode 指定時はそのモードのみ、未指定時は全件削除（プロンプト編集時など）"""
+        with self._lock:
+            if mode is None:
+                cursor = self._conn.execute("DELETE FROM answer_cache")
+            else:
+                cursor = self._conn.execute("DELETE FROM answer_cache WHERE mode = ?", (mode,))
+            self._conn.commit()
+            self.stats["invalidated"] += cursor.rowcount
+            return cursor.rowcount
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0]
+            stats: Dict[str, Any] = dict(self.stats, entries=entries, corpus_version=self.corpus_version)
+        hits = stats["exact_hits"] + stats["semantic_hits"]
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
+
+class CachedAnswer:
+    """
+    キャッシュ済みの回答を AnswerStream と同じ形で返す（st.write_stream にそのまま渡せる）。
+    result["cached"] にヒットの詳細（類似度・経過秒数・元の質問）が入る。
+    """
+
+    def __init__(self, hit: Dict[str, Any]):
+        self.hit = hit
+        self.result = {
+            "answer": hit["answer"],
+            "title": None,
+            "langchain_used": False,
+            "model": hit["model"],
+            "metrics": {},
+            "usage": None,
+            "cached": {k: hit[k] for k in ("similarity", "age_s", "question")},
+        }
+
+    def __iter__(self):
+        yield self.hit["answer"]
+
+_answer_cache: Optional[AnswerCache] = None
+_answer_cache_lock = threading.Lock()
+
+def get_answer_cache() -> AnswerCache:
+    """プロセス共通の AnswerCache を取得"""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+            logger.info("⚡ AnswerCache 初期化: %s", _answer_cache.db_path)
+        return _answer_cache
@@ -0,0 +1,308 @@
+# src/batch_compare.py
+"""
+複数モデルのオフライン一括比較
+
+質問セット（CSV / JSONL）の各行について、アプリと同じ手順（build_prompt_data → pack_prompt_context →
+モード別チェーン）でプロンプトを組み立て、CLAUDE_MODEL_MAPPING / AZURE_MODEL_MAPPING の全モデルで回答を生成する。
+プロバイダごとに同時実行数を制限（Bedrock のスロットリング対策）し、回答・レイテンシ・TTFT・トークン使用量を
+結果ファイル（.jsonl / .csv）へ書き出す。
+
+質問セットの列（question 以外は省略可）:
+    id, question, mode, equipment, files（";" 区切り）, jurisdiction, context_mode（full / retrieval）,
+    building_mode, building, include_building
+
+使い方:
+    python -m src.batch_compare questions.csv -o results.jsonl
+    python -m src.batch_compare questions.jsonl -o results.csv --models claude-4-sonnet gpt-4.1 --per-provider 2
+    python -m src.batch_compare questions.csv -o results.jsonl --stub   # API を呼ばないスタブ LLM で動作確認
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from langchain_core.output_parsers import StrOutputParser
+
+from src.context_packer import pack_prompt_context
+from src.langchain_chains import AnswerStream, build_answer_chain, supports_cache_points
+from src.langchain_models import AZURE_MODEL_MAPPING, CLAUDE_MODEL_MAPPING, get_chat_model, get_provider
+from src.prompt_capture import PromptCapture
+from src.prompt_data import build_prompt_data
+from src.prompts import DEFAULT_PROMPTS
+from src.usage_ledger import estimate_cost
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "ALL_MODELS",
+    "load_questions",
+    "stub_model_factory",
+    "run_batch",
+    "write_results",
+]
+
+ALL_MODELS = list(CLAUDE_MODEL_MAPPING) + list(AZURE_MODEL_MAPPING)
+_DEFAULT_MODE = "暗黙知法令チャットモード"
+_DEFAULT_PER_PROVIDER = int(os.getenv("BATCH_MAX_PER_PROVIDER", "2"))
+
+RESULT_FIELDS = [
+    "id", "model", "provider", "mode", "question", "answer", "error",
+    "latency_s", "ttft_ms", "tokens_per_sec", "input_tokens", "output_tokens",
+    "cache_read_tokens", "cache_write_tokens", "cost_usd", "context_tokens", "dropped_tokens",
+]
+
+# ---------------------------------------------------------------------------
+# 入力
+# ---------------------------------------------------------------------------
+def load_questions(path: str) -> List[Dict[str, Any]]:
+    """CSV または JSONL の質問セットを読み込み、id 未指定の行には連番を振る"""
+    with open(path, encoding="utf-8-sig") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    questions = []
+    for idx, row in enumerate(rows, start=1):
+        if not (row.get("question") or "").strip():
+            continue
+        files = row.get("files") or []
+        if isinstance(files, str):
+            files = [name.strip() for name in files.split(";") if name.strip()]
+        include_building = row.get("include_building")
+        if isinstance(include_building, str):
+            include_building = include_building.strip().lower() in ("1", "true", "yes", "y")
+        questions.append({
+            "id": str(row.get("id") or idx),
+            "question": row["question"].strip(),
+            "mode": row.get("mode") or _DEFAULT_MODE,
+            "equipment": row.get("equipment") or None,
+            "files": files,
+            "jurisdiction": row.get("jurisdiction") or None,
+            "context_mode": row.get("context_mode") or "full",
+            "building_mode": row.get("building_mode") or "none",
+            "building": row.get("building") or None,
+            "include_building": bool(include_building),
+        })
+    return questions
+
+def stub_model_factory(delay_s: float = 0.01) -> Callable[[str, float, Optional[int]], Any]:
+    """API を呼ばないスタブ LLM（チャンクごとに delay_s 待つ）を返すファクトリ"""
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+    def _factory(model: str, temperature: float, max_tokens: Optional[int]):
+        return FakeListChatModel(responses=[f"[stub:{model}] スタブ回答です。"], sleep=delay_s)
+    return _factory
+
+# ---------------------------------------------------------------------------
+# 実行
+# ---------------------------------------------------------------------------
+def _prepare(question: Dict[str, Any], equipment_data: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    files = question["files"]
+    if question["equipment"] and not files and equipment_data and question["equipment"] in equipment_data:
+        files = sorted(equipment_data[question["equipment"]]["files"])  # ファイル未指定なら設備の全ファイル
+    return build_prompt_data(
+        question["question"],
+        mode=question["mode"],
+        equipment_data=equipment_data,
+        selected_equipment=question["equipment"],
+        selected_files=files,
+        selected_jurisdiction=question["jurisdiction"],
+        context_mode=question["context_mode"],
+        include_building=question["include_building"],
+        building_mode=question["building_mode"],
+        selected_building=question["building"],
+    )
+
+def _run_one(
+    question: Dict[str, Any],
+    prompt_data: Dict[str, Any],
+    model: str,
+    *,
+    system_prompt: str,
+    model_factory: Callable[[str, float, Optional[int]], Any],
+    temperature: float,
+    max_tokens: Optional[int],
+) -> Dict[str, Any]:
+    record: Dict[str, Any] = {
+        "id": question["id"], "model": model, "provider": get_provider(model),
+        "mode": question["mode"], "question": question["question"], "answer": "", "error": "",
+    }
+    t0 = time.perf_counter()
+    try:
+        packed = pack_prompt_context(
+            model=model,
+            system_prompt=system_prompt,
+            question=question["question"],
+            equipment_content=prompt_data["equipment_content"],
+            building_content=prompt_data["building_content"],
+            target_building_content=prompt_data.get("target_building_content"),
+            other_buildings_content=prompt_data.get("other_buildings_content"),
+            chat_history=[{"role": "user", "content": question["question"]}],
+            max_output_tokens=max_tokens,
+        )
+        chat_model = model_factory(model, temperature, max_tokens)
+        _, chain = build_answer_chain(question["mode"], system_prompt, chat_model, StrOutputParser(),
+                                      cache_points=supports_cache_points(model))
+        chain_input = {
+            "question": question["question"],
+            "chat_history": None,
+            **{key: packed[key] or "" for key in (
+                "equipment_content", "building_content", "target_building_content", "other_buildings_content")},
+        }
+        stream = AnswerStream(
+            chain, chain_input,
+            complete_prompt=PromptCapture(mode=question["mode"], model=model,
+                                          system_prompt=system_prompt, chain_input=chain_input),
+            generate_title=False, model=model, mode=question["mode"],
+        )
+        for _ in stream:
+            pass
+        metrics = stream.result["metrics"]
+        record.update({
+            "answer": stream.result["answer"],
+            "ttft_ms": round(metrics["ttft_ms"], 1),
+            "tokens_per_sec": round(metrics["tokens_per_sec"], 1),
+            "input_tokens": metrics["input_tokens"],
+            "output_tokens": metrics["output_tokens"],
+            "cache_read_tokens": metrics["cache_read_tokens"],
+            "cache_write_tokens": metrics["cache_write_tokens"],
+            "cost_usd": round(estimate_cost(model, metrics), 6),
+            "context_tokens": packed["report"]["total_tokens"],
+            "dropped_tokens": packed["report"]["dropped_tokens"],
+        })
+    except Exception as e:
+        logger.error(f"❌ batch_compare 失敗: id={question['id']} model={model}: {e}")
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["latency_s"] = round(time.perf_counter() - t0, 3)
+    return record
+
+def run_batch(
+    questions: Sequence[Dict[str, Any]],
+    *,
+    models: Optional[Sequence[str]] = None,
+    equipment_data: Optional[Dict[str, Any]] = None,
+    prompts: Optional[Dict[str, str]] = None,
+    model_factory: Optional[Callable[[str, float, Optional[int]], Any]] = None,
+    max_per_provider: int = _DEFAULT_PER_PROVIDER,
+    temperature: float = 0.0,
+    max_tokens: Optional[int] = 4096,
+    char_limit: int = 1500,
+    on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    質問 × モデルの全組み合わせを実行し、質問順・モデル順に並べた結果を返す。
+    プロバイダごとに max_per_provider 本のスレッドプールを持ち、同時リクエスト数を制限する。
+    プロンプト中の {MAX_CHARS} はアプリの文字数プリセットと同様に char_limit で置き換える。
+    """
+    models = list(models or ALL_MODELS)
+    prompts = {mode: text.replace("{MAX_CHARS}", str(char_limit))
+               for mode, text in (prompts or DEFAULT_PROMPTS).items()}
+    model_factory = model_factory or (lambda m, t, mt: get_chat_model(m, t, mt))
+
+    # 資料の検索・ビル情報の組み立てはモデルに依存しないので質問ごとに 1 回だけ
+    prepared = [_prepare(q, equipment_data) for q in questions]
+
+    executors = {
+        provider: ThreadPoolExecutor(max_workers=max_per_provider, thread_name_prefix=f"Batch-{provider}")
+        for provider in sorted({get_provider(m) for m in models})
+    }
+    lock = threading.Lock()
+    results: Dict[tuple, Dict[str, Any]] = {}
+    t0 = time.perf_counter()
+    try:
+        futures = {}
+        for q_idx, (question, prompt_data) in enumerate(zip(questions, prepared)):
+            system_prompt = prompts.get(question["mode"], "")
+            for m_idx, model in enumerate(models):
+                future = executors[get_provider(model)].submit(
+                    _run_one, question, prompt_data, model,
+                    system_prompt=system_prompt, model_factory=model_factory,
+                    temperature=temperature, max_tokens=max_tokens,
+                )
+                futures[future] = (q_idx, m_idx)
+        for done, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            with lock:
+                results[futures[future]] = record
+            if on_result:
+                on_result(record)
+            logger.info("📊 batch_compare %d/%d — id=%s model=%s latency=%.2fs%s",
+                        done, len(futures), record["id"], record["model"], record["latency_s"],
+                        f" error={record['error']}" if record["error"] else "")
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+    logger.info("✅ batch_compare 完了: %d 件 (%d 問 × %d モデル) %.1fs",
+                len(results), len(questions), len(models), time.perf_counter() - t0)
+    return [results[key] for key in sorted(results)]
+
+# ---------------------------------------------------------------------------
+# 出力
+# ---------------------------------------------------------------------------
+def write_results(results: Sequence[Dict[str, Any]], path: str) -> None:
+    """拡張子が .csv なら CSV、それ以外は JSONL で書き出す"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+        else:
+            for record in results:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def _summary(results: Sequence[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    summary: Dict[str, Dict[str, float]] = {}
+    for model in dict.fromkeys(r["model"] for r in results):
+        ok = [r for r in results if r["model"] == model and not r["error"]]
+        latencies = sorted(r["latency_s"] for r in ok)
+        summary[model] = {
+            "ok": len(ok),
+            "errors": sum(1 for r in results if r["model"] == model and r["error"]),
+            "latency_p50_s": latencies[len(latencies) // 2] if latencies else 0.0,
+            "ttft_avg_ms": round(sum(r["ttft_ms"] for r in ok) / len(ok), 1) if ok else 0.0,
+            "output_tokens": sum(r["output_tokens"] for r in ok),
+        }
+    return summary
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="複数モデルのオフライン一括比較")
+    parser.add_argument("questions", help="質問セット（.csv / .jsonl）")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="結果ファイル（.jsonl / .csv）")
+    parser.add_argument("--models", nargs="+", default=ALL_MODELS, help=f"比較するモデル（既定: {' '.join(ALL_MODELS)}）")
+    parser.add_argument("--per-provider", type=int, default=_DEFAULT_PER_PROVIDER, help="プロバイダごとの同時実行数")
+    parser.add_argument("--input-dir", default="rag_data", help="設備資料のディレクトリ")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max-tokens", type=int, default=4096)
+    parser.add_argument("--char-limit", type=int, default=1500, help="回答文字数の上限（{MAX_CHARS}）")
+    parser.add_argument("--stub", action="store_true", help="API を呼ばずスタブ LLM で実行")
+    args = parser.parse_args(argv)
+
+    questions = load_questions(args.questions)
+    equipment_data = None
+    if any(q["equipment"] for q in questions):
+        from src.startup_loader import initialize_equipment_data
+        equipment_data = initialize_equipment_data(args.input_dir)["equipment_data"]
+
+    results = run_batch(
+        questions,
+        models=args.models,
+        equipment_data=equipment_data,
+        model_factory=stub_model_factory() if args.stub else None,
+        max_per_provider=args.per_provider,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        char_limit=args.char_limit,
+    )
+    write_results(results, args.output)
+    print(json.dumps(_summary(results), ensure_ascii=False, indent=2))
+    return 0 if all(not r["error"] for r in results) else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
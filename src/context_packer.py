@@ -0,0 +1,296 @@
+# src/context_packer.py
+"""
+プロンプトに載せるコンテキストのトークン予算管理
+
+prepare_prompt_data の出力（設備資料・ビル情報）とチャット履歴を、
+セクションごとの予算（system / equipment / building / history）に収まるよう詰め直す。
+予算を超える場合は質問との関連度が高いもの・新しいものから優先して残し、
+落とした内容は report["dropped"] に記録する。
+
+トークン数は UTF-8 のバイト数から概算する（ネットワーク越しのトークナイザは使わない）。
+"""
+from __future__ import annotations
+
+import math
+import os
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.rag_lexical import tokenize_ngrams
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "MODEL_CONTEXT_WINDOWS",
+    "DEFAULT_SECTION_SHARES",
+    "estimate_tokens",
+    "get_context_budgets",
+    "pack_prompt_context",
+]
+
+# モデルごとの最大入力コンテキスト（トークン）
+MODEL_CONTEXT_WINDOWS = {
+    "claude-4-sonnet": 200_000,
+    "claude-3.7": 200_000,
+    "gpt-4.1": 1_000_000,
+    "gpt-4o": 128_000,
+}
+
+# 全体予算に対する各セクションの配分
+DEFAULT_SECTION_SHARES = {
+    "system": 0.10,
+    "equipment": 0.60,
+    "building": 0.15,
+    "history": 0.15,
+}
+
+# レイテンシ抑制のため、モデルの上限より小さい入力予算を既定とする
+_DEFAULT_INPUT_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "120000"))
+_DEFAULT_OUTPUT_RESERVE = 4096
+
+_FILE_HEADER = re.compile(r"^=== (?:ファイル|表): .*===$", re.MULTILINE)
+_PAGE_MARKER = re.compile(r"^--- ページ \d+ ---$", re.MULTILINE)
+_BUILDING_HEADER = re.compile(r"^【ビル情報[：:].*】$", re.MULTILINE)
+_OMITTED = "（…予算超過のため一部省略…）"
+
+# ---------------------------------------------------------------------------
+# トークン概算
+# ---------------------------------------------------------------------------
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    トークン数の概算。ASCII は 4 文字 ≒ 1 トークン、それ以外（日本語など）は 1 文字 ≒ 1 トークン。
+    非 ASCII 文字数は UTF-8 のバイト数から求める（文字ごとのループを避けて高速に計算）。
+    """
+    if not text:
+        return 0
+    n_chars = len(text)
+    n_bytes = len(text.encode("utf-8", "surrogatepass"))
+    non_ascii = min(n_chars, (n_bytes - n_chars) // 2)
+    return non_ascii + math.ceil((n_chars - non_ascii) / 4)
+
+def get_context_budgets(
+    model: str,
+    *,
+    max_output_tokens: Optional[int] = None,
+    total_budget: Optional[int] = None,
+    shares: Optional[Dict[str, float]] = None,
+) -> Dict[str, int]:
+    """モデルの上限・出力予約・全体予算から各セクションの予算（トークン）を計算"""
+    window = MODEL_CONTEXT_WINDOWS.get(model, 128_000)
+    total = min(
+        total_budget or _DEFAULT_INPUT_BUDGET,
+        window - (max_output_tokens or _DEFAULT_OUTPUT_RESERVE),
+    )
+    shares = shares or DEFAULT_SECTION_SHARES
+    budgets = {section: int(total * share) for section, share in shares.items()}
+    budgets["total"] = total
+    return budgets
+
+# ---------------------------------------------------------------------------
+# ブロック単位の詰め込み
+# ---------------------------------------------------------------------------
+def _query_terms(question: Optional[str]) -> List[str]:
+    return list(set(tokenize_ngrams(question or "")))
+
+def _relevance(text: str, terms: Sequence[str]) -> int:
+    if not terms:
+        return 0
+    normalized = unicodedata.normalize("NFKC", text).lower()
+    return sum(1 for term in terms if term in normalized)
+
+def _pack_blocks(
+    blocks: List[Tuple[str, str]],
+    budget: int,
+    terms: Sequence[str],
+    *,
+    section: str,
+    dropped: List[Dict[str, Any]],
+) -> Tuple[List[bool], int]:
+    """
+    (ラベル, テキスト) のブロック列から予算内に収まるものを選ぶ。
+    質問との関連度が高い順（同点なら元の順）に採用し、採否フラグと使用トークンを返す。
+    """
+    sizes = [estimate_tokens(text) for _, text in blocks]
+    if sum(sizes) <= budget:
+        return [True] * len(blocks), sum(sizes)
+
+    order = sorted(range(len(blocks)), key=lambda i: (-_relevance(blocks[i][1], terms), i))
+    keep = [False] * len(blocks)
+    used = 0
+    for i in order:
+        if used + sizes[i] <= budget:
+            keep[i] = True
+            used += sizes[i]
+        else:
+            dropped.append({"section": section, "label": blocks[i][0], "tokens": sizes[i]})
+    return keep, used
+
+def _truncate(text: str, budget: int) -> str:
+    """単一ブロックが予算を超える場合に先頭から予算分だけ残す"""
+    if estimate_tokens(text) <= budget:
+        return text
+    ratio = budget / max(estimate_tokens(text), 1)
+    return text[:int(len(text) * ratio)] + "\n" + _OMITTED
+
+def _split_by_header(text: str, header: re.Pattern) -> List[str]:
+    starts = [m.start() for m in header.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts = [0] + starts
+    return [text[s:e].strip() for s, e in zip(starts, starts[1:] + [len(text)]) if text[s:e].strip()]
+
+# ---------------------------------------------------------------------------
+# セクション別の詰め込み
+# ---------------------------------------------------------------------------
+def _pack_equipment(content: str, budget: int, terms: Sequence[str], dropped: List[Dict[str, Any]]) -> Tuple[str, int]:
+    """ファイル／表ブロック → ページ単位に分けて関連度順に詰め、元の順序で再構成"""
+    units: List[Tuple[int, str, str]] = []  # (ファイル番号, ラベル, テキスト)
+    headers: List[str] = []
+    for file_idx, block in enumerate(_split_by_header(content, _FILE_HEADER)):
+        first_line, _, body = block.partition("\n")
+        is_header = bool(_FILE_HEADER.match(first_line))
+        headers.append(first_line if is_header else "")
+        body = body if is_header else block
+        label = first_line.strip("= ") if is_header else f"ブロック{file_idx + 1}"
+        pages = _split_by_header(body, _PAGE_MARKER) if _PAGE_MARKER.search(body) else [body]
+        for page in pages:
+            page_label = page.partition("\n")[0].strip("- ") if _PAGE_MARKER.match(page) else ""
+            units.append((file_idx, f"{label} {page_label}".strip(), page))
+
+    keep, used = _pack_blocks([(label, text) for _, label, text in units], budget, terms,
+                              section="equipment", dropped=dropped)
+
+    parts: List[str] = []
+    for file_idx, header in enumerate(headers):
+        file_units = [(k, text) for (idx, _, text), k in zip(units, keep) if idx == file_idx]
+        if not any(k for k, _ in file_units):
+            continue
+        body = "\n".join(text if k else _OMITTED for k, text in file_units)
+        body = re.sub(f"(?:{re.escape(_OMITTED)}\\n?)+", _OMITTED + "\n", body).strip()
+        parts.append(f"{header}\n{body}" if header else body)
+
+    if not parts and units:
+        # 1 ページも収まらない場合は最も関連度の高いページを切り詰めて残す
+        best = max(range(len(units)), key=lambda i: (_relevance(units[i][2], terms), -i))
+        dropped[:] = [d for d in dropped if d["label"] != units[best][1]]
+        header = headers[units[best][0]]
+        text = _truncate(units[best][2], budget - estimate_tokens(header))
+        parts.append(f"{header}\n{text}" if header else text)
+        used = estimate_tokens(parts[0])
+    return "\n\n".join(parts), used
+
+def _pack_buildings(content: str, budget: int, terms: Sequence[str], dropped: List[Dict[str, Any]]) -> Tuple[str, int]:
+    blocks = [(b.partition("\n")[0], b) for b in _split_by_header(content, _BUILDING_HEADER)]
+    keep, used = _pack_blocks(blocks, budget, terms, section="building", dropped=dropped)
+    return "\n\n".join(text for (_, text), k in zip(blocks, keep) if k), used
+
+def _pack_history(
+    chat_history: List[Dict[str, str]],
+    budget: int,
+    dropped: List[Dict[str, Any]],
+) -> Tuple[List[Dict[str, str]], int]:
+    """最後のメッセージ（今回の質問）は必ず残し、それ以前は新しい順に予算まで残す"""
+    if not chat_history:
+        return [], 0
+    *past, current = chat_history
+    used = estimate_tokens(current.get("content"))
+    kept: List[Dict[str, str]] = []
+    for offset, msg in enumerate(reversed(past)):
+        tokens = estimate_tokens(msg.get("content"))
+        if used + tokens > budget:
+            # 古い側はまとめて落とす（会話の途中だけ抜けるのを避ける）
+            for old_idx, old in enumerate(past[:len(past) - offset]):
+                dropped.append({
+                    "section": "history",
+                    "label": f"{old_idx + 1}: {old.get('role')}",
+                    "tokens": estimate_tokens(old.get("content")),
+                })
+            break
+        kept.append(msg)
+        used += tokens
+    return list(reversed(kept)) + [current], used
+
+# ---------------------------------------------------------------------------
+# エントリポイント
+# ---------------------------------------------------------------------------
+def pack_prompt_context(
+    *,
+    model: str,
+    system_prompt: str,
+    question: Optional[str],
+    equipment_content: Optional[str] = None,
+    building_content: Optional[str] = None,
+    target_building_content: Optional[str] = None,
+    other_buildings_content: Optional[str] = None,
+    chat_history: Optional[List[Dict[str, str]]] = None,
+    max_output_tokens: Optional[int] = None,
+    budgets: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
+    """
+    各セクションを予算内に詰め、generate_smart_answer_with_langchain にそのまま渡せる値と
+    report（予算・使用量・省略した内容）を返す。
+
+    system → history → building の順に詰め、余った予算は equipment に回す。
+    system プロンプトは指示文なので省略しない（超過は report に記録するのみ）。
+    """
+    budgets = budgets or get_context_budgets(model, max_output_tokens=max_output_tokens)
+    terms = _query_terms(question)
+    dropped: List[Dict[str, Any]] = []
+    used: Dict[str, int] = {}
+
+    used["system"] = estimate_tokens(system_prompt)
+    if used["system"] > budgets["system"]:
+        logger.warning("⚠️ systemプロンプトが予算超過: %d > %d tokens", used["system"], budgets["system"])
+    spare = max(budgets["system"] - used["system"], 0)
+
+    packed_history, used["history"] = _pack_history(list(chat_history or []), budgets["history"], dropped)
+    spare += max(budgets["history"] - used["history"], 0)
+
+    # — ビル情報: 対象ビルを優先し、残りの予算でその他のビル —
+    building_budget = budgets["building"]
+    target = _truncate(target_building_content, building_budget) if target_building_content else target_building_content
+    target_tokens = estimate_tokens(target)
+    others, others_tokens = (
+        _pack_buildings(other_buildings_content, max(building_budget - target_tokens, 0), terms, dropped)
+        if other_buildings_content else (other_buildings_content, 0)
+    )
+    if building_content and building_content == target_building_content:
+        building = target
+    elif building_content and building_content == other_buildings_content:
+        building = others
+    elif building_content and target_building_content and other_buildings_content:
+        building = f"{target}\n\n{others}" if others else target
+    elif building_content:
+        building, _ = _pack_buildings(building_content, building_budget, terms, dropped)
+    else:
+        building = building_content
+    used["building"] = max(target_tokens + others_tokens, estimate_tokens(building))
+    spare += max(building_budget - used["building"], 0)
+
+    # — 設備資料: 余った予算も使う —
+    equipment_budget = budgets["equipment"] + spare
+    if equipment_content:
+        equipment, used["equipment"] = _pack_equipment(equipment_content, equipment_budget, terms, dropped)
+    else:
+        equipment, used["equipment"] = equipment_content, 0
+
+    report = {
+        "budgets": dict(budgets, equipment_effective=equipment_budget),
+        "used": used,
+        "total_tokens": sum(used.values()),
+        "dropped": dropped,
+        "dropped_tokens": sum(d["tokens"] for d in dropped),
+    }
+    if dropped:
+        logger.info("✂️ context_pack — model=%s total=%d dropped=%d (%d tokens) sections=%s",
+                    model, report["total_tokens"], len(dropped), report["dropped_tokens"],
+                    sorted({d["section"] for d in dropped}))
+
+    return {
+        "equipment_content": equipment,
+        "building_content": building,
+        "target_building_content": target,
+        "other_buildings_content": others,
+        "chat_history": packed_history,
+        "report": report,
+    }
@@ -0,0 +1,201 @@
+# src/embedding_cache.py
+"""
+埋め込みベクトルの永続キャッシュ
+
+(埋め込みモデル名, 正規化チャンクハッシュ) をキーに、ベクトルを float16/float32 の
+バイト列として SQLite に保存する。インデックス作成・クエリ検索の両方から利用し、
+キャッシュミスしたテキストだけを API に送る。
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "get_cache_dir",
+    "normalize_text_for_hash",
+    "content_hash",
+    "EmbeddingCache",
+    "get_embedding_cache",
+]
+
+# ---------------------------------------------------------------------------
+# 保存先
+# ---------------------------------------------------------------------------
+def get_cache_dir() -> str:
+    """RAG 関連の永続データ置き場（RAG_CACHE_DIR 未設定時は一時ディレクトリ配下）"""
+    cache_dir = os.getenv("RAG_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "rag_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+# ---------------------------------------------------------------------------
+# ハッシュ
+# ---------------------------------------------------------------------------
+def normalize_text_for_hash(text: str) -> str:
+    """全角/半角・空白の揺れを吸収してからハッシュを取るための正規化"""
+    normalized = unicodedata.normalize("NFKC", text or "")
+    normalized = re.sub(r"\s+", " ", normalized)
+    return normalized.strip()
+
+def content_hash(text: str) -> str:
+    """正規化済みテキストの SHA-256"""
+    return hashlib.sha256(normalize_text_for_hash(text).encode("utf-8")).hexdigest()
+
+# ---------------------------------------------------------------------------
+# キャッシュ本体
+# ---------------------------------------------------------------------------
+class EmbeddingCache:
+    """SQLite + numpy バイト列による埋め込みキャッシュ"""
+
+    def __init__(self, db_path: str | None = None, dtype: str | None = None):
+        self.db_path = db_path or os.path.join(get_cache_dir(), "embedding_cache.sqlite3")
+        self.dtype = np.dtype(dtype or os.getenv("EMBEDDING_CACHE_DTYPE", "float16"))
+        if self.dtype not in (np.dtype("float16"), np.dtype("float32")):
+            raise ValueError(f"未対応の dtype: {self.dtype}")
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model      TEXT NOT NULL,
+                text_hash  TEXT NOT NULL,
+                dim        INTEGER NOT NULL,
+                dtype      TEXT NOT NULL,
+                vector     BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._conn.commit()
+
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "api_calls": 0,
+            "api_texts": 0,
+        }
+
+    # — 低レベル API —
+    def get_many(self, model: str, hashes: Sequence[str]) -> Dict[str, List[float]]:
+        """ハッシュ一覧に対応するベクトルを取得（見つかったものだけ返す）"""
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            # SQLite のバインド変数上限を避けるため分割して問い合わせる
+            for start in range(0, len(unique), 500):
+                part = unique[start:start + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, dtype, vector FROM embeddings "
+                    f"WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *part],
+                ).fetchall()
+                for text_hash, dtype, blob in rows:
+                    vec = np.frombuffer(blob, dtype=np.dtype(dtype)).astype(np.float32)
+                    found[text_hash] = vec.tolist()
+        return found
+
+    def put_many(self, model: str, items: Dict[str, Sequence[float]]) -> None:
+        """ハッシュ → ベクトルを保存"""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for text_hash, vector in items.items():
+            arr = np.asarray(vector, dtype=self.dtype)
+            rows.append((model, text_hash, int(arr.shape[0]), self.dtype.name, arr.tobytes(), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, dtype, vector, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    # — 高レベル API —
+    def embed(
+        self,
+        texts: Sequence[str],
+        *,
+        model: str,
+        embed_fn: Callable[[List[str]], List[List[float]]],
+        batch_size: int = 100,
+    ) -> List[List[float]]:
+        """
+        texts の埋め込みを返す。キャッシュミス分のみ embed_fn(バッチ) で生成して保存する。
+        """
+        hashes = [content_hash(t) for t in texts]
+        cached = self.get_many(model, hashes)
+
+        # 同一テキストは 1 回だけ API に送る
+        missing: Dict[str, str] = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in cached and text_hash not in missing:
+                missing[text_hash] = text
+
+        hits = sum(1 for h in hashes if h in cached)
+        with self._lock:
+            self.stats["hits"] += hits
+            self.stats["misses"] += len(hashes) - hits
+
+        if missing:
+            miss_items = list(missing.items())
+            for start in range(0, len(miss_items), batch_size):
+                batch = miss_items[start:start + batch_size]
+                vectors = embed_fn([text for _, text in batch])
+                new_items = {text_hash: vec for (text_hash, _), vec in zip(batch, vectors)}
+                self.put_many(model, new_items)
+                cached.update({h: list(map(float, v)) for h, v in new_items.items()})
+                with self._lock:
+                    self.stats["api_calls"] += 1
+                    self.stats["api_texts"] += len(batch)
+
+        logger.info(
+            "🧮 embedding cache — model=%s total=%d hit=%d miss=%d api_texts=%d",
+            model, len(hashes), hits, len(hashes) - hits, len(missing),
+        )
+        return [cached[h] for h in hashes]
+
+    def get_stats(self) -> Dict[str, float]:
+        """ヒット率を含む統計情報"""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] / lookups) if lookups else 0.0
+        return stats
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+# ---------------------------------------------------------------------------
+# シングルトン
+# ---------------------------------------------------------------------------
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> EmbeddingCache:
+    """プロセス共通の EmbeddingCache を取得"""
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+            logger.info("🗄️ EmbeddingCache 初期化: %s (%s)", _embedding_cache.db_path, _embedding_cache.dtype.name)
+        return _embedding_cache
@@ -303,7 +303,8 @@ def log_to_firestore(
     model: str = None,
     temperature: float = None,
     max_tokens: int = None,
-    use_rag: bool = None
+    use_rag: bool = None,
+    usage: Dict[str, Any] = None
 ) -> bool:
     """Streamlitアプリからの便利なログ関数"""
     
@@ -340,6 +341,9 @@ def log_to_firestore(
         "use_rag": final_use_rag,
         "app_version": "1.0"
     }
+    # ターンのトークン使用量・コスト（usage_ledger.record の戻り値）
+    if usage:
+        metadata["usage"] = usage
     
     # 保存実行
     return manager.log_conversation(
@@ -0,0 +1,223 @@
+# src/hedging.py
+"""
+回答生成のヘッジ（遅延時の並行リクエスト）とプロバイダ間フェイルオーバー
+
+主モデルが期限（直近 TTFT の p95 から算出）までに最初のトークンを返さない場合、
+別プロバイダの副モデルにも同じリクエストを送り、先に最初のトークンを返した方を採用して
+もう一方は打ち切る。主モデルが最初のトークン前にエラーになった場合は即座に副モデルへ切り替える。
+ヘッジ率・副モデルの勝率・フェイルオーバー回数は HedgePolicy.get_stats() で確認できる。
+"""
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.resilience import has_content
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "HEDGE_ENABLED",
+    "HedgePolicy",
+    "get_hedge_policy",
+    "HedgedStream",
+]
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") in ("1", "true", "True")
+
+# 主モデル → 副モデル（別プロバイダを割り当てて障害・スロットリングを分散）
+_DEFAULT_SECONDARY = {
+    "claude-4-sonnet": "gpt-4.1",
+    "claude-3.7": "gpt-4.1",
+    "gpt-4.1": "claude-4-sonnet",
+    "gpt-4o": "claude-4-sonnet",
+}
+
+def _parse_secondary(spec: str) -> Dict[str, str]:
+    """HEDGE_SECONDARY="claude-4-sonnet:gpt-4.1,gpt-4.1:claude-3.7" 形式"""
+    mapping = {}
+    for pair in spec.split(","):
+        primary, _, secondary = pair.strip().partition(":")
+        if primary and secondary:
+            mapping[primary.strip()] = secondary.strip()
+    return mapping
+
+class HedgePolicy:
+    """モデルごとの TTFT 分布からヘッジ期限を決め、ヘッジの結果を集計する"""
+
+    def __init__(
+        self,
+        secondary: Optional[Dict[str, str]] = None,
+        *,
+        percentile: float = float(os.getenv("HEDGE_PERCENTILE", "0.95")),
+        default_deadline_s: float = float(os.getenv("HEDGE_DEFAULT_DEADLINE_S", "8")),
+        min_deadline_s: float = float(os.getenv("HEDGE_MIN_DEADLINE_S", "3")),
+        max_deadline_s: float = float(os.getenv("HEDGE_MAX_DEADLINE_S", "20")),
+        min_samples: int = 20,
+        window: int = 200,
+    ):
+        self.secondary = secondary if secondary is not None else (
+            _parse_secondary(os.getenv("HEDGE_SECONDARY", "")) or dict(_DEFAULT_SECONDARY)
+        )
+        self.percentile = percentile
+        self.default_deadline_s = default_deadline_s
+        self.min_deadline_s = min_deadline_s
+        self.max_deadline_s = max_deadline_s
+        self.min_samples = min_samples
+        self._window = window
+        self._ttft: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "hedged": 0, "secondary_wins": 0, "failovers": 0, "errors": 0}
+
+    def secondary_for(self, model: str) -> Optional[str]:
+        secondary = self.secondary.get(model)
+        return secondary if secondary and secondary != model else None
+
+    def record_ttft(self, model: str, seconds: float) -> None:
+        with self._lock:
+            self._ttft.setdefault(model, deque(maxlen=self._window)).append(seconds)
+
+    def deadline_for(self, model: str) -> float:
+        """直近 TTFT の p95（サンプル不足時は既定値）を [min, max] に丸めた秒数"""
+        with self._lock:
+            samples = sorted(self._ttft.get(model, ()))
+        if len(samples) < self.min_samples:
+            return self.default_deadline_s
+        p = samples[min(int(len(samples) * self.percentile), len(samples) - 1)]
+        return min(max(p, self.min_deadline_s), self.max_deadline_s)
+
+    def record_outcome(self, *, hedged: bool, secondary_won: bool, failover: bool, error: bool = False) -> None:
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["hedged"] += int(hedged)
+            self.stats["secondary_wins"] += int(secondary_won)
+            self.stats["failovers"] += int(failover)
+            self.stats["errors"] += int(error)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self.stats)
+            models = list(self._ttft)
+        stats["hedge_rate"] = stats["hedged"] / stats["requests"] if stats["requests"] else 0.0
+        stats["secondary_win_rate"] = stats["secondary_wins"] / stats["hedged"] if stats["hedged"] else 0.0
+        stats["deadlines_s"] = {m: round(self.deadline_for(m), 2) for m in models}
+        return stats
+
+_hedge_policy: Optional[HedgePolicy] = None
+_hedge_policy_lock = threading.Lock()
+
+def get_hedge_policy() -> HedgePolicy:
+    """プロセス共通の HedgePolicy を取得"""
+    global _hedge_policy
+    with _hedge_policy_lock:
+        if _hedge_policy is None:
+            _hedge_policy = HedgePolicy()
+        return _hedge_policy
+
+class HedgedStream:
+    """
+    主・副 2 つのストリームを競わせるイテレータ。各ストリームは別スレッドで読み、
+    中身のある最初のチャンクを返した方（winner）のチャンクだけを流す。負けた側は次のチャンク到着時に打ち切る
+    （HTTP の待ち自体は中断できないため、スレッドは daemon として放置する）。
+    """
+
+    def __init__(
+        self,
+        primary: Tuple[str, Callable[[], Iterable[Any]]],
+        secondary: Optional[Tuple[str, Callable[[], Iterable[Any]]]],
+        policy: Optional[HedgePolicy] = None,
+    ):
+        self._attempts: List[Tuple[str, Callable[[], Iterable[Any]]]] = [primary] + ([secondary] if secondary else [])
+        self.policy = policy or get_hedge_policy()
+        self._queue: "queue.Queue[Tuple[int, str, Any]]" = queue.Queue()
+        self._cancel = [threading.Event() for _ in self._attempts]
+        self._started_at: Dict[int, float] = {}
+        self._errors: Dict[int, Exception] = {}
+        self.winner: Optional[str] = None
+        self.hedged = False
+        self.failover = False
+
+    def _run(self, idx: int, factory: Callable[[], Iterable[Any]]) -> None:
+        iterator: Optional[Iterator[Any]] = None
+        try:
+            iterator = iter(factory())
+            for chunk in iterator:
+                if self._cancel[idx].is_set():
+                    break
+                self._queue.put((idx, "chunk", chunk))
+            self._queue.put((idx, "done", None))
+        except Exception as e:
+            self._queue.put((idx, "error", e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+
+    def _start(self, idx: int) -> None:
+        self._started_at[idx] = time.perf_counter()
+        name = f"Hedge-{self._attempts[idx][0]}"
+        threading.Thread(target=self._run, args=(idx, self._attempts[idx][1]), daemon=True, name=name).start()
+
+    def _choose(self, idx: int) -> None:
+        self.winner = self._attempts[idx][0]
+        now = time.perf_counter()
+        self.policy.record_ttft(self.winner, now - self._started_at[idx])
+        for other, started in self._started_at.items():
+            if other != idx and other not in self._errors:
+                self._cancel[other].set()
+                # 打ち切った側の TTFT は「少なくともこれだけ掛かった」下限として記録
+                self.policy.record_ttft(self._attempts[other][0], now - started)
+        self.policy.record_outcome(hedged=self.hedged, secondary_won=self.hedged and idx == 1, failover=self.failover)
+        if self.hedged or self.failover:
+            logger.info("🏁 hedge — winner=%s hedged=%s failover=%s", self.winner, self.hedged, self.failover)
+
+    def __iter__(self):
+        primary_model = self._attempts[0][0]
+        has_secondary = len(self._attempts) > 1
+        deadline = time.perf_counter() + self.policy.deadline_for(primary_model) if has_secondary else None
+        winner_idx: Optional[int] = None
+        errors = self._errors
+        self._start(0)
+        try:
+            while True:
+                timeout = None
+                if winner_idx is None and has_secondary and 1 not in self._started_at:
+                    timeout = max(deadline - time.perf_counter(), 0.0)
+                try:
+                    idx, kind, payload = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    logger.info("⏳ hedge — %s が期限内に応答しないため %s にも送信", primary_model, self._attempts[1][0])
+                    self.hedged = True
+                    self._start(1)
+                    continue
+
+                if winner_idx is not None and idx != winner_idx:
+                    continue
+                if kind == "error":
+                    if winner_idx is not None:
+                        raise payload
+                    errors[idx] = payload
+                    logger.warning("⚠️ hedge — %s がエラー: %s", self._attempts[idx][0], payload)
+                    if has_secondary and 1 not in self._started_at:
+                        self.failover = True
+                        self._start(1)
+                    if len(errors) == len(self._started_at):
+                        self.policy.record_outcome(hedged=self.hedged, secondary_won=False,
+                                                   failover=self.failover, error=True)
+                        raise errors[0] if 0 in errors else payload
+                    continue
+                if winner_idx is None:
+                    if kind == "chunk" and not has_content(payload):
+                        continue  # メタデータだけの空チャンクでは採用を決めない
+                    winner_idx = idx
+                    self._choose(idx)
+                if kind == "done":
+                    return
+                yield payload
+        finally:
+            for event in self._cancel:
+                event.set()
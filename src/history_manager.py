@@ -0,0 +1,232 @@
+# src/history_manager.py
+"""
+チャット履歴の圧縮（直近 N ターンはそのまま、それ以前はローリング要約）
+
+毎ターン会話全体を送るとトークン数・レイテンシが会話長に比例して増え続けるため、
+直近 HISTORY_KEEP_TURNS ターンだけを原文で送り、それより古いやり取りは要約 1 件に畳む。
+要約は回答後にバックグラウンドで更新し（回答生成をブロックしない）、chat_store の sid ごとに保持する。
+要約がまだ追いついていない部分は原文のまま送り、予算を超えた古い原文から落とす。
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.context_packer import estimate_tokens
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "HISTORY_KEEP_TURNS",
+    "HISTORY_TOKEN_BUDGET",
+    "HistoryManager",
+    "get_history_manager",
+    "compact_chat_history",
+    "schedule_history_summary",
+]
+
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "4"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "12000"))
+# 要約に使うモデル（未設定なら会話と同じモデル、"heuristic" なら LLM を使わない）
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "")
+_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_TOKENS", "1500"))
+_SUMMARY_HEADER = "【これまでの会話の要約】"
+
+def _fingerprint(messages: Sequence[Dict[str, str]]) -> str:
+    digest = hashlib.sha256()
+    for msg in messages:
+        digest.update(f"{msg.get('role')}\x1f{msg.get('content')}\x1e".encode("utf-8"))
+    return digest.hexdigest()
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def heuristic_summary(previous: str, messages: Sequence[Dict[str, str]], max_tokens: int = _SUMMARY_MAX_TOKENS) -> str:
+    """LLM を使わない抽出型の要約（各発言の冒頭のみ）。上限を超えたら古い行から落とす"""
+    lines = [line for line in (previous or "").splitlines() if line.strip()]
+    for msg in messages:
+        label = "Q" if msg.get("role") == "user" else "A"
+        lines.append(f"- {label}: {_clip(msg.get('content', ''), 80 if label == 'Q' else 160)}")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop(0)
+    return "\n".join(lines)
+
+def _llm_summary(previous: str, messages: Sequence[Dict[str, str]], model: str, sid: Optional[str] = None) -> str:
+    from langchain_core.messages import HumanMessage, SystemMessage
+    from src.admission import ADMISSION_ENABLED, get_admission_controller
+    from src.resilience import call_with_retry
+    from src.langchain_models import get_chat_model, get_provider
+    from src.usage_ledger import record_usage, usage_or_estimate
+
+    transcript = "\n\n".join(
+        f"{'ユーザー' if m.get('role') == 'user' else 'アシスタント'}: {m.get('content', '')}" for m in messages
+    )
+    chat_model = get_chat_model(model, temperature=0.0, max_tokens=_SUMMARY_MAX_TOKENS)
+    prompt_messages = [
+        SystemMessage(content="あなたは建築電気設備に関する会話の記録係です。既存の要約に新しいやり取りを統合し、"
+                              "後続の質問に答えるために必要な事実（対象ビル・設備・数値・条件・結論・未解決の論点）を"
+                              "箇条書きの日本語で簡潔にまとめてください。要約以外は出力しないでください。"),
+        HumanMessage(content=f"=== 既存の要約 ===\n{previous or 'なし'}\n\n=== 新しいやり取り ===\n{transcript}"),
+    ]
+    t0 = time.perf_counter()
+    if ADMISSION_ENABLED:
+        # 要約は次のターンまでに終わればよいので、利用者の回答より後ろに並ぶ "background" として待つ
+        with get_admission_controller().admit(get_provider(model), "background", timeout=60):
+            response = call_with_retry(get_provider(model), lambda: chat_model.invoke(prompt_messages), max_attempts=2)
+    else:
+        response = call_with_retry(get_provider(model), lambda: chat_model.invoke(prompt_messages), max_attempts=2)
+    usage, estimated = usage_or_estimate(response, f"{previous}\n{transcript}")
+    record_usage(model=model, usage=usage, purpose="summary", sid=sid,
+                 latency_s=time.perf_counter() - t0, estimated=estimated)
+    return str(response.content).strip()
+
+class HistoryManager:
+    """
+    sid ごとのローリング要約キャッシュ。
+    各エントリは「先頭から covered 件のメッセージを畳んだ要約」と、その範囲のフィンガープリントを持つ。
+    """
+
+    def __init__(self, keep_turns: int = HISTORY_KEEP_TURNS, token_budget: int = HISTORY_TOKEN_BUDGET,
+                 max_sessions: int = 256):
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        self.max_sessions = max_sessions
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="HistorySummary")
+        self.stats = {"compactions": 0, "summaries": 0, "summary_errors": 0, "stale": 0}
+
+    # — 参照 —
+    def _entry_for(self, sid: str, past: Sequence[Dict[str, str]]) -> Optional[Dict[str, Any]]:
+        """past の先頭と一致する要約エントリ（編集・削除で食い違っていれば破棄）"""
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            self._entries.move_to_end(sid)
+        if entry["covered"] > len(past) or entry["fingerprint"] != _fingerprint(past[:entry["covered"]]):
+            with self._lock:
+                if self._entries.get(sid) is entry:
+                    del self._entries[sid]
+                self.stats["stale"] += 1
+            return None
+        return entry
+
+    def compact(self, sid: str, messages: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """
+        messages（最後が今回の質問）を「要約 + 直近の原文 + 今回の質問」に圧縮する。
+        予算を超える場合は古い原文から落とす（要約と今回の質問は常に残す）。
+        """
+        if not messages:
+            return [], {"summarized_messages": 0, "dropped_messages": 0, "tokens": 0}
+        *past, current = messages
+        entry = self._entry_for(sid, past) if sid else None
+        covered = entry["covered"] if entry else 0
+        summary = entry["summary"] if entry else ""
+
+        head: List[Dict[str, str]] = []
+        if summary:
+            head.append({"role": "user", "content": f"{_SUMMARY_HEADER}\n{summary}"})
+        used = estimate_tokens(current.get("content")) + sum(estimate_tokens(m["content"]) for m in head)
+
+        verbatim = past[covered:]
+        kept: List[Dict[str, str]] = []
+        for msg in reversed(verbatim):
+            tokens = estimate_tokens(msg.get("content"))
+            if used + tokens > self.token_budget:
+                break
+            kept.append(msg)
+            used += tokens
+        kept.reverse()
+        # 先頭がアシスタント発言で始まらないようにそろえる
+        while kept and kept[0].get("role") == "assistant" and len(kept) < len(verbatim):
+            used -= estimate_tokens(kept.pop(0).get("content"))
+
+        dropped = len(verbatim) - len(kept)
+        with self._lock:
+            self.stats["compactions"] += 1
+        if covered or dropped:
+            logger.info("🗜️ history_compact — sid=%s summarized=%d verbatim=%d dropped=%d tokens≈%d",
+                        sid, covered, len(kept), dropped, used)
+        return head + kept + [current], {"summarized_messages": covered, "dropped_messages": dropped, "tokens": used}
+
+    # — 要約の更新（バックグラウンド） —
+    def schedule(self, sid: str, messages: List[Dict[str, str]], model: str) -> Optional[Future]:
+        """
+        回答後の履歴（messages）のうち、次のターンで直近 keep_turns ターンから外れる部分を要約に畳む。
+        同じ sid の更新が実行中なら何もしない（次のターンで追いつく）。
+        """
+        if not sid:
+            return None
+        fold_until = max(len(messages) - self.keep_turns * 2, 0)
+        entry = self._entry_for(sid, messages)
+        covered = entry["covered"] if entry else 0
+        if fold_until <= covered:
+            return None
+        with self._lock:
+            if sid in self._pending and not self._pending[sid].done():
+                return None
+            future = self._executor.submit(
+                self._summarize, sid, list(messages[:fold_until]), covered,
+                entry["summary"] if entry else "", model,
+            )
+            self._pending[sid] = future
+        return future
+
+    def _summarize(self, sid: str, folded: List[Dict[str, str]], covered: int, previous: str, model: str) -> str:
+        new_messages = folded[covered:]
+        summary_model = HISTORY_SUMMARY_MODEL or model
+        try:
+            if summary_model == "heuristic":
+                summary = heuristic_summary(previous, new_messages)
+            else:
+                summary = _llm_summary(previous, new_messages, summary_model, sid=sid)
+        except Exception as e:
+            logger.warning("⚠️ 履歴要約失敗 (model=%s)、抽出型要約で代替: %s", summary_model, e)
+            with self._lock:
+                self.stats["summary_errors"] += 1
+            summary = heuristic_summary(previous, new_messages)
+
+        with self._lock:
+            self._entries[sid] = {"covered": len(folded), "summary": summary, "fingerprint": _fingerprint(folded)}
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+            self.stats["summaries"] += 1
+        logger.info("📝 history_summary — sid=%s covered=%d tokens≈%d", sid, len(folded), estimate_tokens(summary))
+        return summary
+
+    def forget(self, sid: str) -> None:
+        """チャット削除時などに要約を破棄"""
+        with self._lock:
+            self._entries.pop(sid, None)
+            self._pending.pop(sid, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, sessions=len(self._entries),
+                        pending=sum(1 for f in self._pending.values() if not f.done()))
+
+_history_manager: Optional[HistoryManager] = None
+_history_manager_lock = threading.Lock()
+
+def get_history_manager() -> HistoryManager:
+    """プロセス共通の HistoryManager を取得"""
+    global _history_manager
+    with _history_manager_lock:
+        if _history_manager is None:
+            _history_manager = HistoryManager()
+        return _history_manager
+
+def compact_chat_history(sid: str, messages: List[Dict[str, str]]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    return get_history_manager().compact(sid, messages)
+
+def schedule_history_summary(sid: str, messages: List[Dict[str, str]], model: str) -> Optional[Future]:
+    return get_history_manager().schedule(sid, messages, model)
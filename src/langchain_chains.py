@@ -1,13 +1,26 @@
 # src/langchain_chains.py (最小限の変更を加えた最終版)
 
-from typing import List, Dict, Any, Optional
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Callable, Iterable, Optional, Tuple
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.runnables import RunnableLambda
 # ▼ 変更点：JSONパーサーをインポートします
 from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.callbacks import BaseCallbackHandler
 
-from src.langchain_models import get_chat_model
+from src.langchain_models import get_chat_model, get_model_pool_stats, get_provider, CLAUDE_MODEL_MAPPING
+from src.admission import (ADMISSION_ENABLED, AdmissionTicket, AdmissionTimeout, admitted_stream,
+                           get_admission_controller)
+from src.prompt_capture import PromptCapture
+from src.hedging import HEDGE_ENABLED, HedgedStream, get_hedge_policy
+from src.resilience import call_with_retry, resilient_stream
+from src.single_flight import FlightStream, SingleFlight, StreamingSingleFlight
+from src.usage_ledger import record_usage
 from src.logging_utils import init_logger
 logger = init_logger()
 
@@ -66,72 +79,7 @@ class ChainManager:
     ):
         """統一されたチェーンテンプレート - モード別プロンプト構成対応"""
         chat_model = get_chat_model(model_name, temperature, max_tokens)
-        
-        if mode == "質疑応答書添削モード":
-            # Knowledge Contentsなしの場合
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_prompt),
-                MessagesPlaceholder(variable_name="chat_history", optional=True),
-                ("human", "【添削依頼】\n{question}\n\n上記の内容について、質疑応答書として適切な形式で添削・改善提案をお願いします。")
-            ])
-            knowledge_generator = None
-            
-        elif mode == "暗黙知法令チャットモード":
-            # 暗黙知法令チャットモード専用構成
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_prompt),
-                ("human", "=== 設備資料情報 ===\n{equipment_content}\n\n=== ビル情報 ===\n{building_content}"),
-                MessagesPlaceholder(variable_name="chat_history", optional=True),
-                ("human", "【技術的質問】\n{question}\n\n上記の設備資料とビル情報を参考に、建築電気設備設計の観点から詳細に回答してください。")
-            ])
-            knowledge_generator = RunnableLambda(ChainManager.create_separate_knowledge)
-            
-        elif mode == "ビルマスタ質問モード":
-            # ビルマスタ質問モード専用構成
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_prompt),
-                ("human", "=== ビルマスター情報 ===\n{building_content}"),
-                MessagesPlaceholder(variable_name="chat_history", optional=True),
-                ("human", "【ビル情報に関する質問】\n{question}\n\nビルマスターデータに記載されている情報のみを使用して、正確に回答してください。")
-            ])
-            knowledge_generator = RunnableLambda(ChainManager.create_building_knowledge)
-            
-        else:
-            # デフォルト（既存の統一構成を維持）
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", system_prompt),
-                ("human", "{knowledge_contents}"),
-                MessagesPlaceholder(variable_name="chat_history", optional=True),
-                ("human", "【質問】\n{question}\n\n上記の資料情報を参考に、日本語で回答してください。")
-            ])
-            knowledge_generator = RunnableLambda(ChainManager.create_combined_knowledge)
-        
-        # 🔥 修正: チェーン構築を統一（新しいフィールド対応）
-        if knowledge_generator:
-            chain = (
-                {
-                    "question": lambda x: x["question"],
-                    "equipment_content": lambda x: x.get("equipment_content", ""),
-                    "building_content": lambda x: x.get("building_content", ""),
-                    "target_building_content": lambda x: x.get("target_building_content", ""),
-                    "other_buildings_content": lambda x: x.get("other_buildings_content", ""),
-                    "knowledge_contents": knowledge_generator,
-                    "chat_history": lambda x: ChainManager.create_chat_history_messages(x.get("chat_history"))
-                }
-                | prompt
-                | chat_model
-                | StrOutputParser()
-            )
-        else:
-            chain = (
-                {
-                    "question": lambda x: x["question"],
-                    "chat_history": lambda x: ChainManager.create_chat_history_messages(x.get("chat_history"))
-                }
-                | prompt
-                | chat_model
-                | StrOutputParser()
-            )
+        _, chain = build_answer_chain(mode, system_prompt, chat_model, StrOutputParser())
         
         logger.info(f"✅ Unified Chain 作成完了: model={model_name}, mode={mode}")
         return chain
@@ -201,6 +149,242 @@ class ChainManager:
         else:
             return "=== ビルマスター情報 ===\nビル情報はありません。"
 
+# =================================================================
+# チェーンの構築とキャッシュ
+# =================================================================
+_TITLE_JSON_INSTRUCTION = """
+【重要：出力形式】
+あなたの回答と、この会話のタイトルを考え、必ず以下のJSON形式で出力してください。他のテキストは一切含めないでください。
+{{
+  "answer": "ここにユーザーへの回答本文を入れてください。",
+  "title": "ここに30文字程度の会話のタイトルを入れてください。"
+}}"""
+
+# =================================================================
+# プロバイダのプロンプトキャッシュ
+# =================================================================
+# メッセージは「system → 資料（設備/ビル） → 履歴 → 今回の質問」の順で、先頭ほど会話中に変化しない。
+# Claude (Bedrock) には system・資料・履歴末尾に cache point を付け、Azure OpenAI は
+# 先頭一致のプレフィックスが自動でキャッシュされるので並び順だけで効く。
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE", "1") not in ("0", "false", "False")
+
+def supports_cache_points(model: str) -> bool:
+    """明示的な cache point が必要なモデル（Bedrock の Claude）か"""
+    return PROMPT_CACHE_ENABLED and model in CLAUDE_MODEL_MAPPING
+
+def _cache_text_block(message):
+    """メッセージ本文を cache_control 付きのテキストブロックに変換（空の場合はそのまま）"""
+    content = message.content
+    if isinstance(content, str):
+        if not content.strip():
+            return message
+        blocks = [{"type": "text", "text": content}]
+    else:
+        blocks = [dict(b) if isinstance(b, dict) else {"type": "text", "text": b} for b in content]
+        if not blocks:
+            return message
+    blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    return message.model_copy(update={"content": blocks})
+
+def _add_cache_points(static_messages: int):
+    """
+    プロンプトの固定部（先頭 static_messages 件）の末尾と、履歴の末尾に cache point を付ける Runnable。
+    Bedrock の上限（4 箇所）に収まるよう最大 3 箇所。
+    """
+    def _apply(prompt_value):
+        messages = list(prompt_value.to_messages())
+        points = {0, static_messages - 1}
+        if len(messages) - 1 > static_messages:
+            points.add(len(messages) - 2)  # 履歴の最後（次のターンではここまでが既知の接頭辞）
+        return [_cache_text_block(m) if i in points else m for i, m in enumerate(messages)]
+    return RunnableLambda(_apply)
+
+class UsageCollector(BaseCallbackHandler):
+    """LLM 呼び出しの usage（入力/出力/キャッシュ読み書きトークン）を集める"""
+
+    def __init__(self):
+        self.usage = {"input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0}
+        self.reported = False
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if not usage:
+                    continue
+                details = usage.get("input_token_details") or {}
+                self.usage["input_tokens"] += usage.get("input_tokens", 0) or 0
+                self.usage["output_tokens"] += usage.get("output_tokens", 0) or 0
+                self.usage["cache_read_tokens"] += details.get("cache_read", 0) or 0
+                self.usage["cache_write_tokens"] += details.get("cache_creation", 0) or 0
+                self.reported = True
+
+def _log_usage(model: str, usage: Dict[str, int]) -> None:
+    total_input = usage["input_tokens"]
+    hit_rate = usage["cache_read_tokens"] / total_input if total_input else 0.0
+    logger.info("💾 prompt_cache — model=%s input=%d cache_read=%d cache_write=%d (hit %.0f%%) output=%d",
+                model, total_input, usage["cache_read_tokens"], usage["cache_write_tokens"],
+                hit_rate * 100, usage["output_tokens"])
+
+def build_answer_prompt(mode: str, system_prompt: str) -> ChatPromptTemplate:
+    """モード別のプロンプトテンプレート（チェーン構築と送信プロンプトの再現で共用）"""
+    if mode == "質疑応答書添削モード":
+        # Knowledge Contentsなしの場合
+        return ChatPromptTemplate.from_messages([
+            ("system", system_prompt),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
+            ("human", "【添削依頼】\n{question}\n\n上記の内容について、質疑応答書として適切な形式で添削・改善提案をお願いします。")
+        ])
+    if mode == "暗黙知法令チャットモード":
+        # 暗黙知法令チャットモード専用構成
+        return ChatPromptTemplate.from_messages([
+            ("system", system_prompt),
+            ("human", "=== 設備資料情報 ===\n{equipment_content}\n\n=== ビル情報 ===\n{building_content}"),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
+            ("human", "【技術的質問】\n{question}\n\n上記の設備資料とビル情報を参考に、建築電気設備設計の観点から詳細に回答してください。")
+        ])
+    if mode == "ビルマスタ質問モード":
+        # ビルマスタ質問モード専用構成
+        return ChatPromptTemplate.from_messages([
+            ("system", system_prompt),
+            ("human", "=== ビルマスター情報 ===\n{building_content}"),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
+            ("human", "【ビル情報に関する質問】\n{question}\n\nビルマスターデータに記載されている情報のみを使用して、正確に回答してください。")
+        ])
+    # デフォルト（既存の統一構成を維持）
+    return ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        ("human", "{knowledge_contents}"),
+        MessagesPlaceholder(variable_name="chat_history", optional=True),
+        ("human", "【質問】\n{question}\n\n上記の資料情報を参考に、日本語で回答してください。")
+    ])
+
+def build_answer_chain(mode: str, system_prompt: str, chat_model, output_parser,
+                       cache_points: bool = False) -> Tuple[ChatPromptTemplate, Any]:
+    """
+    モード別のプロンプトテンプレートとチェーン（prompt | model | parser）を構築
+    cache_points=True の場合、固定部と履歴末尾に Bedrock 用の cache point を付ける
+    """
+    prompt_template = build_answer_prompt(mode, system_prompt)
+    if mode == "質疑応答書添削モード":
+        prompt_step = prompt_template | _add_cache_points(1) if cache_points else prompt_template
+        chain = (
+            {
+                "question": lambda x: x["question"],
+                "chat_history": lambda x: ChainManager.create_chat_history_messages(x.get("chat_history"))
+            }
+            | prompt_step
+            | chat_model
+            | output_parser
+        )
+        return prompt_template, chain
+
+    if mode == "暗黙知法令チャットモード":
+        knowledge_generator = RunnableLambda(ChainManager.create_separate_knowledge)
+    elif mode == "ビルマスタ質問モード":
+        knowledge_generator = RunnableLambda(ChainManager.create_building_knowledge)
+    else:
+        knowledge_generator = RunnableLambda(ChainManager.create_combined_knowledge)
+
+    # system + 資料メッセージの 2 件が会話中で変化しない固定部
+    prompt_step = prompt_template | _add_cache_points(2) if cache_points else prompt_template
+    chain = (
+        {
+            "question": lambda x: x["question"],
+            "equipment_content": lambda x: x.get("equipment_content", ""),
+            "building_content": lambda x: x.get("building_content", ""),
+            "target_building_content": lambda x: x.get("target_building_content", ""),
+            "other_buildings_content": lambda x: x.get("other_buildings_content", ""),
+            "knowledge_contents": knowledge_generator,
+            "chat_history": lambda x: ChainManager.create_chat_history_messages(x.get("chat_history"))
+        }
+        | prompt_step
+        | chat_model
+        | output_parser
+    )
+    return prompt_template, chain
+
+class CompiledChainCache:
+    """
+    構築済みチェーンの LRU キャッシュ
+
+    キー: (モード, systemプロンプトのハッシュ, generate_title, モデル, temperature, max_tokens, プール世代)
+    プール世代はモデル接続のリフレッシュ回数で、リフレッシュ後は古いモデルを掴んだチェーンを使わない。
+    """
+
+    def __init__(self, maxsize: int = 32, model_factory: Optional[Callable[..., Any]] = None):
+        self.maxsize = maxsize
+        self._model_factory = model_factory  # (model, temperature, max_tokens) → チャットモデル。既定は get_chat_model
+        self._items: "OrderedDict[tuple, Tuple[ChatPromptTemplate, Any, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(
+        self,
+        *,
+        mode: str,
+        system_prompt: str,
+        generate_title: bool,
+        model: str,
+        temperature: float,
+        max_tokens: Optional[int],
+    ) -> Tuple[ChatPromptTemplate, Any, str]:
+        """(prompt_template, chain, final_prompt) を返す。なければ構築して登録する。"""
+        prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        key = (mode, prompt_hash, generate_title, model, float(temperature), max_tokens,
+               get_model_pool_stats()["refreshes"])
+
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry
+            self.stats["misses"] += 1
+
+        final_prompt = system_prompt + "\n\n" + _TITLE_JSON_INSTRUCTION if generate_title else system_prompt
+        output_parser = JsonOutputParser() if generate_title else StrOutputParser()
+        chat_model = (self._model_factory or get_chat_model)(model, temperature, max_tokens)
+        prompt_template, chain = build_answer_chain(mode, final_prompt, chat_model, output_parser,
+                                                    cache_points=supports_cache_points(model))
+        entry = (prompt_template, chain, final_prompt)
+
+        with self._lock:
+            self._items[key] = entry
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.stats["evictions"] += 1
+        logger.info(f"🧱 チェーン構築: mode={mode}, model={model}, generate_title={generate_title}")
+        return entry
+
+    def invalidate(self, mode: Optional[str] = None) -> int:
+        """mode 指定時はそのモードのチェーンのみ、未指定時は全て破棄"""
+        with self._lock:
+            keys = [k for k in self._items if mode is None or k[0] == mode]
+            for key in keys:
+                del self._items[key]
+            self.stats["invalidations"] += len(keys)
+        return len(keys)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, entries=len(self._items))
+
+_chain_cache = CompiledChainCache()
+
+def invalidate_chain_cache(mode: Optional[str] = None) -> int:
+    """
+    キャッシュ済みチェーンを破棄（破棄した件数を返す）。プロセス内の全セッションに影響するため運用時のみ使う。
+    プロンプト編集ではキーのプロンプトハッシュが変わるので破棄は不要（古い版は LRU で押し出される）。
+    """
+    removed = _chain_cache.invalidate(mode)
+    logger.info(f"🧹 チェーンキャッシュ破棄: mode={mode or 'ALL'}, removed={removed}")
+    return removed
+
+def get_chain_cache_stats() -> Dict[str, int]:
+    return _chain_cache.get_stats()
+
 # =================================================================
 # ▼ 変更点
 # generate_unified_answer と generate_smart_answer_with_langchain を書き換え、
@@ -249,6 +433,72 @@ def get_actual_prompt_from_template(
         logger.error(f"❌ Prompt generation failed: {e}")
         return f"=== ERROR ===\nプロンプト生成に失敗: {str(e)}"
 
+def _prepare_unified_answer(
+    *,
+    prompt: str,
+    question: str,
+    model: str,
+    mode: str,
+    equipment_content: Optional[str],
+    building_content: Optional[str],
+    target_building_content: Optional[str],
+    other_buildings_content: Optional[str],
+    chat_history: Optional[List[Dict[str, str]]],
+    temperature: float,
+    max_tokens: Optional[int],
+    generate_title: bool,
+) -> Tuple[Any, Dict[str, Any], PromptCapture]:
+    """キャッシュ済みチェーン・入力データ・送信プロンプトのキャプチャを用意する（同期・ストリーミング共通）"""
+    # ★ チェーンはキャッシュから取得（generate_title の場合は JSON 指示付きプロンプト + JsonOutputParser）
+    prompt_template, chain, final_prompt = _chain_cache.get(
+        mode=mode,
+        system_prompt=prompt,
+        generate_title=generate_title,
+        model=model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+    )
+
+    # 入力データ準備
+    chain_input = {
+        "question": question,
+        "chat_history": chat_history[:-1] if chat_history and len(chat_history) > 1 else None,
+        "equipment_content": equipment_content or "",
+        "building_content": building_content or "",
+        "target_building_content": target_building_content or "",
+        "other_buildings_content": other_buildings_content or ""
+    }
+
+    # 送信プロンプトは参照だけ保持し、整形・保存はログ処理側で必要になった時に行う
+    actual_complete_prompt = PromptCapture(mode=mode, model=model, system_prompt=final_prompt, chain_input=chain_input)
+    return chain, chain_input, actual_complete_prompt
+
+# 同一入力の同時リクエストをまとめる（プロセス内）
+_answer_flights = SingleFlight()
+_stream_flights = StreamingSingleFlight()
+
+def _request_fingerprint(*, model: str, mode: str, system_prompt: str, chain_input: Dict[str, Any],
+                         temperature: float, max_tokens: Optional[int], **options: Any) -> str:
+    """生成結果を左右する入力すべてのハッシュ（single-flight のキー）"""
+    digest = hashlib.sha256()
+    for part in (model, mode, repr(float(temperature)), repr(max_tokens), repr(sorted(options.items())), system_prompt):
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x1e")
+    for key in sorted(chain_input):
+        value = chain_input[key]
+        digest.update(key.encode("utf-8"))
+        digest.update(b"\x1f")
+        if isinstance(value, list):
+            for msg in value:
+                digest.update(f"{msg.get('role')}\x1f{msg.get('content')}\x1d".encode("utf-8"))
+        else:
+            digest.update(str(value or "").encode("utf-8"))
+        digest.update(b"\x1e")
+    return digest.hexdigest()
+
+def get_single_flight_stats() -> Dict[str, Dict[str, int]]:
+    return {"invoke": _answer_flights.get_stats(), "stream": _stream_flights.get_stats()}
+
 def generate_unified_answer(
     *,
     prompt: str,
@@ -262,129 +512,65 @@ def generate_unified_answer(
     chat_history: Optional[List[Dict[str, str]]] = None,
     temperature: float = 0.0,
     max_tokens: Optional[int] = None,
-    generate_title: bool = False # ★タイトル生成フラグを追加
+    generate_title: bool = False, # ★タイトル生成フラグを追加
+    user: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     統一された回答生成関数。generate_titleフラグに応じて動作を切り替える。
+    user はアドミッション制御（利用者ごとの同時実行数・公平キュー）の単位。
     """
     logger.info(f"🚀 統一回答生成開始: model={model}, mode={mode}, generate_title={generate_title}")
     
-    # 既存のチェーン作成ロジックを呼び出す
-    # ★ generate_title が True の場合、元のプロンプトにJSON指示を追加する
-    final_prompt = prompt
-    output_parser = StrOutputParser()
-    if generate_title:
-        json_instruction = """
-【重要：出力形式】
-あなたの回答と、この会話のタイトルを考え、必ず以下のJSON形式で出力してください。他のテキストは一切含めないでください。
-{{
-  "answer": "ここにユーザーへの回答本文を入れてください。",
-  "title": "ここに30文字程度の会話のタイトルを入れてください。"
-}}"""
-        final_prompt = prompt + "\n\n" + json_instruction
-        output_parser = JsonOutputParser()
-
-    # ★ 既存の create_unified_chain を呼び出すが、末尾のパーサーだけを差し替える
-    # この方法では create_unified_chain の中身を書き換える必要があり、元のコードの変更が大きくなるため、
-    # ここでチェーンのロジックを再定義するのが最も安全です。元のロジックは完全にコピーします。
-    
-    chat_model = get_chat_model(model, temperature, max_tokens)
+    chain, chain_input, actual_complete_prompt = _prepare_unified_answer(
+        prompt=prompt, question=question, model=model, mode=mode,
+        equipment_content=equipment_content, building_content=building_content,
+        target_building_content=target_building_content, other_buildings_content=other_buildings_content,
+        chat_history=chat_history, temperature=temperature, max_tokens=max_tokens,
+        generate_title=generate_title,
+    )
     
-    # 元の create_unified_chain の中身をここに展開
-    if mode == "質疑応答書添削モード":
-        prompt_template = ChatPromptTemplate.from_messages([
-            ("system", final_prompt),
-            MessagesPlaceholder(variable_name="chat_history", optional=True),
-            ("human", "【添削依頼】\n{question}\n\n上記の内容について、質疑応答書として適切な形式で添削・改善提案をお願いします。")
-        ])
-        chain = (
-            {
-                "question": lambda x: x["question"],
-                "chat_history": lambda x: ChainManager.create_chat_history_messages(x.get("chat_history"))
-            }
-            | prompt_template
-            | chat_model
-            | output_parser
-        )
-    else: # 暗黙知法令、ビルマスタ、その他デフォルトモード
-        # どのモードでも knowledge_generator を使う想定で汎用化
-        if mode == "暗黙知法令チャットモード":
-            prompt_template = ChatPromptTemplate.from_messages([
-                ("system", final_prompt),
-                ("human", "=== 設備資料情報 ===\n{equipment_content}\n\n=== ビル情報 ===\n{building_content}"),
-                MessagesPlaceholder(variable_name="chat_history", optional=True),
-                ("human", "【技術的質問】\n{question}\n\n上記の設備資料とビル情報を参考に、建築電気設備設計の観点から詳細に回答してください。")
-            ])
-            knowledge_generator = RunnableLambda(ChainManager.create_separate_knowledge)
-        elif mode == "ビルマスタ質問モード":
-            prompt_template = ChatPromptTemplate.from_messages([
-                ("system", final_prompt),
-                ("human", "=== ビルマスター情報 ===\n{building_content}"),
-                MessagesPlaceholder(variable_name="chat_history", optional=True),
-                ("human", "【ビル情報に関する質問】\n{question}\n\nビルマスターデータに記載されている情報のみを使用して、正確に回答してください。")
-            ])
-            knowledge_generator = RunnableLambda(ChainManager.create_building_knowledge)
-        else: # デフォルト
-            prompt_template = ChatPromptTemplate.from_messages([
-                ("system", final_prompt),
-                ("human", "{knowledge_contents}"),
-                MessagesPlaceholder(variable_name="chat_history", optional=True),
-                ("human", "【質問】\n{question}\n\n上記の資料情報を参考に、日本語で回答してください。")
-            ])
-            knowledge_generator = RunnableLambda(ChainManager.create_combined_knowledge)
-        
-        chain = (
-            {
-                "question": lambda x: x["question"],
-                "equipment_content": lambda x: x.get("equipment_content", ""),
-                "building_content": lambda x: x.get("building_content", ""),
-                "target_building_content": lambda x: x.get("target_building_content", ""),
-                "other_buildings_content": lambda x: x.get("other_buildings_content", ""),
-                "knowledge_contents": knowledge_generator,
-                "chat_history": lambda x: ChainManager.create_chat_history_messages(x.get("chat_history"))
-            }
-            | prompt_template
-            | chat_model
-            | output_parser
-        )
+    # チェーン実行と結果の整形（同一入力が実行中ならその結果を共有）
+    flight_key = _request_fingerprint(
+        model=model, mode=mode, system_prompt=prompt, chain_input=chain_input,
+        temperature=temperature, max_tokens=max_tokens, generate_title=generate_title,
+    )
 
-    # 入力データ準備
-    chain_input = {
-        "question": question,
-        "chat_history": chat_history[:-1] if chat_history and len(chat_history) > 1 else None,
-        "equipment_content": equipment_content or "",
-        "building_content": building_content or "",
-        "target_building_content": target_building_content or "",
-        "other_buildings_content": other_buildings_content or ""
-    }
+    def _invoke():
+        usage_collector = UsageCollector()
+        provider = get_provider(model)
+
+        def _call():
+            # 一時的なエラー（スロットリング等）はバックオフして再試行、障害が続くプロバイダは即座に失敗
+            return call_with_retry(provider, lambda: chain.invoke(chain_input, config={"callbacks": [usage_collector]}))
+
+        if ADMISSION_ENABLED:
+            with get_admission_controller().admit(provider, user):
+                response = _call()
+        else:
+            response = _call()
+        usage = usage_collector.usage if usage_collector.reported else None
+        if usage:
+            _log_usage(model, usage)
+        return response, usage
 
     try:
-        actual_complete_prompt = get_actual_prompt_from_template(
-            prompt_template, chain_input, mode
-        )
-    except Exception as e:
-        logger.error(f"❌ Prompt extraction failed: {e}")
-        actual_complete_prompt = f"=== SYSTEM ===\n{final_prompt}\n\n=== HUMAN ===\n{question}"
-    
-    # チェーン実行と結果の整形
-    try:
-        response = chain.invoke(chain_input)
-        
-        # complete_prompt の構築ロジックは元のコードから省略（必要なら後で復活可能）
+        response, usage = _answer_flights.do(flight_key, _invoke)
         
         if generate_title:
             return {
                 "answer": response.get("answer", "応答の取得に失敗しました。"),
                 "title": response.get("title"),
                 "langchain_used": True,
-                "complete_prompt": actual_complete_prompt
+                "complete_prompt": actual_complete_prompt,
+                "usage": usage
             }
         else:
             return {
                 "answer": str(response),
                 "title": None,
                 "langchain_used": True,
-                "complete_prompt": actual_complete_prompt
+                "complete_prompt": actual_complete_prompt,
+                "usage": usage
             }
         
     except Exception as e:
@@ -392,6 +578,254 @@ def generate_unified_answer(
         # 既存のコードに合わせてエラーを再発生させる
         raise
 
+class AnswerStream:
+    """
+    回答をトークン単位で返すイテレータ（st.write_stream にそのまま渡せる）。
+    最後まで読み切ると result に generate_unified_answer と同じ形式の結果と
+    計測値（metrics: ttft_ms / tokens_per_sec / cache_read_tokens など）が入る。
+    """
+
+    def __init__(self, chain, chain_input: Dict[str, Any], *, complete_prompt: PromptCapture, generate_title: bool,
+                 model: str, mode: str, hedge: Optional[Tuple[str, Any]] = None,
+                 admission: Optional[AdmissionTicket] = None, user: Optional[str] = None):
+        self._chain = chain
+        self._chain_input = chain_input
+        self._hedge = hedge  # (副モデル名, 副モデルのチェーン)
+        self._admission = admission  # 主モデルの実行許可（読み終えたら返す）
+        self._user = user
+        self._generate_title = generate_title
+        self.model = model
+        self.mode = mode
+        self.result: Optional[Dict[str, Any]] = None
+        self._complete_prompt = complete_prompt
+
+    def __iter__(self):
+        try:
+            yield from self._iter()
+        finally:
+            if self._admission:
+                self._admission.release()
+
+    def _secondary_factory(self, model: str, factory: Callable[[], Any]) -> Callable[[], Any]:
+        """副モデルは実行枠が空いている場合のみ送る（混雑時にヘッジで負荷を増やさない）"""
+        if not ADMISSION_ENABLED:
+            return factory
+
+        def _admitted():
+            ticket = get_admission_controller().try_acquire(get_provider(model), self._user)
+            if ticket is None:
+                raise AdmissionTimeout(f"{model} の実行枠に空きがないため送信しません")
+            return admitted_stream(ticket, factory())
+        return _admitted
+
+    def _track_hedge_loser(self, model: str, collector: UsageCollector, stream: Iterable[Any],
+                           get_hedged: Callable[[], Optional[HedgedStream]]):
+        """
+        ヘッジで負けた側も受信した分は課金されるため、打ち切られた時点で purpose="hedge" として記録する
+        （打ち切ったストリームは usage を返さないことが多いので、その場合は受信済みの量から概算する）。
+        """
+        from src.context_packer import estimate_tokens
+
+        received: List[Any] = []
+        try:
+            for chunk in stream:
+                received.append(chunk)
+                yield chunk
+        finally:
+            hedged_stream = get_hedged()
+            winner = hedged_stream.winner if hedged_stream else None
+            if winner is not None and winner != model and (collector.reported or received):
+                if collector.reported:
+                    usage, estimated = collector.usage, False
+                else:
+                    text = "".join(c for c in received if isinstance(c, str)) or str(received[-1])
+                    usage = {"input_tokens": sum(estimate_tokens(str(v)) for v in self._chain_input.values() if v),
+                             "output_tokens": estimate_tokens(text)}
+                    estimated = True
+                record_usage(model=model, usage=usage, purpose="hedge", user=self._user, mode=self.mode,
+                             estimated=estimated)
+
+    def _iter(self):
+        from src.context_packer import estimate_tokens
+
+        t0 = time.perf_counter()
+        first_token_at: Optional[float] = None
+        parts: List[str] = []
+        title = None
+        answer_so_far = ""
+
+        collectors: Dict[str, UsageCollector] = {}
+
+        def _stream_factory(model: str, chain):
+            collectors[model] = UsageCollector()
+            # 最初のチャンクまでは一時的なエラーを再試行する（ブレーカーが open なら即座に失敗 → ヘッジ時は副モデルへ）
+            factory = lambda: resilient_stream(
+                get_provider(model),
+                lambda: chain.stream(self._chain_input, config={"callbacks": [collectors[model]]}),
+            )
+            if not self._hedge:
+                return factory
+            return lambda: self._track_hedge_loser(model, collectors[model], factory(), lambda: hedged_stream)
+
+        hedged_stream: Optional[HedgedStream] = None
+        if self._hedge:
+            secondary_model, secondary_chain = self._hedge
+            hedged_stream = HedgedStream(
+                (self.model, _stream_factory(self.model, self._chain)),
+                (secondary_model, self._secondary_factory(secondary_model,
+                                                          _stream_factory(secondary_model, secondary_chain))),
+            )
+            source = iter(hedged_stream)
+        else:
+            source = _stream_factory(self.model, self._chain)()
+
+        for chunk in source:
+            if hedged_stream and self._admission and hedged_stream.winner not in (None, self.model):
+                # 副モデルが採用されたら主モデルの枠はすぐ返す（打ち切った主モデルで他の利用者を待たせない）
+                self._admission.release()
+            if self._generate_title:
+                # JsonOutputParser は途中までの dict を返すので answer の増分だけを流す
+                if not isinstance(chunk, dict):
+                    continue
+                title = chunk.get("title") or title
+                answer = chunk.get("answer") or ""
+                if len(answer) <= len(answer_so_far):
+                    continue
+                text, answer_so_far = answer[len(answer_so_far):], answer
+            else:
+                text = str(chunk)
+            if not text:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            parts.append(text)
+            yield text
+
+        finished_at = time.perf_counter()
+        answer = "".join(parts)
+        answered_by = (hedged_stream.winner if hedged_stream else None) or self.model
+        if hedged_stream is None and first_token_at is not None:
+            get_hedge_policy().record_ttft(self.model, first_token_at - t0)
+        usage_collector = collectors.get(answered_by)
+        usage = usage_collector.usage if usage_collector and usage_collector.reported else None
+        # プロバイダが usage を返した場合はその出力トークン数を優先
+        output_tokens = (usage or {}).get("output_tokens") or estimate_tokens(answer)
+        generation_s = finished_at - (first_token_at or finished_at)
+        metrics = {
+            "ttft_ms": ((first_token_at or finished_at) - t0) * 1000,
+            "elapsed_s": finished_at - t0,
+            "output_tokens": output_tokens,
+            "tokens_per_sec": output_tokens / generation_s if generation_s > 0 else 0.0,
+            "chunks": len(parts),
+            "input_tokens": (usage or {}).get("input_tokens", 0),
+            "cache_read_tokens": (usage or {}).get("cache_read_tokens", 0),
+            "cache_write_tokens": (usage or {}).get("cache_write_tokens", 0),
+            "hedged": bool(hedged_stream and hedged_stream.hedged),
+            "failover": bool(hedged_stream and hedged_stream.failover),
+            "queue_wait_ms": self._admission.wait_s * 1000 if self._admission else 0.0,
+        }
+        logger.info("⏱️ stream_metrics — model=%s mode=%s ttft=%.0fms tokens/s=%.1f tokens≈%d elapsed=%.2fs",
+                    answered_by, self.mode, metrics["ttft_ms"], metrics["tokens_per_sec"],
+                    output_tokens, metrics["elapsed_s"])
+        if usage:
+            _log_usage(answered_by, usage)
+        self.result = {
+            "model": answered_by,
+            "answer": answer or ("応答の取得に失敗しました。" if self._generate_title else ""),
+            "title": title,
+            "langchain_used": True,
+            "complete_prompt": self._complete_prompt,
+            "metrics": metrics,
+            "usage": usage,
+        }
+
+def stream_smart_answer_with_langchain(
+    *,
+    prompt: str,
+    question: str,
+    model: str = "claude-4-sonnet",
+    mode: str = "暗黙知法令チャットモード",
+    equipment_content: Optional[str] = None,
+    building_content: Optional[str] = None,
+    target_building_content: Optional[str] = None,
+    other_buildings_content: Optional[str] = None,
+    chat_history: Optional[List[Dict[str, str]]] = None,
+    temperature: float = 0.0,
+    max_tokens: Optional[int] = None,
+    generate_title: bool = False,
+    hedge: Optional[bool] = None,
+    user: Optional[str] = None,
+    on_queue: Optional[Callable[[AdmissionTicket], None]] = None
+) -> FlightStream:
+    """
+    generate_smart_answer_with_langchain のストリーミング版（引数は同じ）
+    hedge=True（未指定時は HEDGE_ENABLED）の場合、最初のトークンが遅ければ副モデルにも並行で送る。
+    同じ入力のストリームが実行中なら新たに呼び出さず、そのチャンクを共有する。
+    混雑時は実行許可が出るまでこの呼び出しが待ち、その間 on_queue(ticket) で順番・推定待ち時間を通知する。
+    """
+    logger.info(f"🚀 ストリーミング回答生成開始: model={model}, mode={mode}, generate_title={generate_title}")
+    chain, chain_input, actual_complete_prompt = _prepare_unified_answer(
+        prompt=prompt, question=question, model=model, mode=mode,
+        equipment_content=equipment_content, building_content=building_content,
+        target_building_content=target_building_content, other_buildings_content=other_buildings_content,
+        chat_history=chat_history, temperature=temperature, max_tokens=max_tokens,
+        generate_title=generate_title,
+    )
+    use_hedge = HEDGE_ENABLED if hedge is None else hedge
+    flight_key = _request_fingerprint(
+        model=model, mode=mode, system_prompt=prompt, chain_input=chain_input,
+        temperature=temperature, max_tokens=max_tokens, generate_title=generate_title, hedge=use_hedge,
+    )
+    return _stream_flights.subscribe(flight_key, lambda: _build_answer_stream(
+        chain, chain_input, actual_complete_prompt,
+        prompt=prompt, model=model, mode=mode, temperature=temperature, max_tokens=max_tokens,
+        generate_title=generate_title, use_hedge=use_hedge, user=user, on_queue=on_queue,
+    ))
+
+def _build_answer_stream(chain, chain_input: Dict[str, Any], complete_prompt: PromptCapture, *, prompt: str,
+                         model: str, mode: str, temperature: float, max_tokens: Optional[int],
+                         generate_title: bool, use_hedge: bool, user: Optional[str] = None,
+                         on_queue: Optional[Callable[[AdmissionTicket], None]] = None) -> AnswerStream:
+    ticket = None
+    if ADMISSION_ENABLED:
+        ticket = get_admission_controller().acquire(get_provider(model), user, on_wait=on_queue)
+    try:
+        return _new_answer_stream(chain, chain_input, complete_prompt, prompt=prompt, model=model, mode=mode,
+                                  temperature=temperature, max_tokens=max_tokens, generate_title=generate_title,
+                                  use_hedge=use_hedge, user=user, ticket=ticket)
+    except BaseException:
+        if ticket:
+            ticket.release()
+        raise
+
+def _new_answer_stream(chain, chain_input: Dict[str, Any], complete_prompt: PromptCapture, *, prompt: str,
+                       model: str, mode: str, temperature: float, max_tokens: Optional[int],
+                       generate_title: bool, use_hedge: bool, user: Optional[str],
+                       ticket: Optional[AdmissionTicket]) -> AnswerStream:
+    hedge_target = None
+    secondary_model = get_hedge_policy().secondary_for(model) if use_hedge else None
+    if secondary_model:
+        try:
+            _, secondary_chain, _ = _chain_cache.get(
+                mode=mode, system_prompt=prompt, generate_title=generate_title,
+                model=secondary_model, temperature=temperature, max_tokens=max_tokens,
+            )
+            hedge_target = (secondary_model, secondary_chain)
+        except Exception as e:
+            # 副モデルの認証情報がない等。ヘッジなしで続行
+            logger.warning(f"⚠️ ヘッジ用モデル {secondary_model} を準備できません: {e}")
+    return AnswerStream(
+        chain,
+        chain_input,
+        complete_prompt=complete_prompt,
+        generate_title=generate_title,
+        model=model,
+        mode=mode,
+        hedge=hedge_target,
+        admission=ticket,
+        user=user,
+    )
+
 def generate_smart_answer_with_langchain(
     *,
     prompt: str,
@@ -439,9 +873,43 @@ def generate_smart_answer_with_langchain(
 # def generate_chat_title_with_llm(...):
 
 # =================================================================
-# ▼ 変更点
-# このテスト関数は古い構成に基づいているため、一旦コメントアウトするか削除します。
+# ベンチマーク（フェイクモデルでチェーン構築のオーバーヘッドを計測）
 # =================================================================
-# def test_chain_creation():
-# if __name__ == "__main__":
-#     test_chain_creation()
\ No newline at end of file
+def benchmark_chain_overhead(n_turns: int = 200, mode: str = "暗黙知法令チャットモード") -> Dict[str, float]:
+    """
+    API を呼ばないフェイクチャットモデルで 1 ターンあたりの処理時間を比較する。
+    before: 毎ターン チェーンを構築 / after: キャッシュ済みチェーンを再利用
+    """
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+    fake_model = FakeListChatModel(responses=["回答"])
+    system_prompt = "あなたは建築電気設備の専門家です。" * 50
+    chain_input = {
+        "question": "非常用照明の設置基準は？",
+        "chat_history": [{"role": "user", "content": "前の質問"}, {"role": "assistant", "content": "前の回答"}],
+        "equipment_content": "資料本文" * 500,
+        "building_content": "",
+        "target_building_content": "",
+        "other_buildings_content": "",
+    }
+    t0 = time.perf_counter()
+    for _ in range(n_turns):
+        _, chain = build_answer_chain(mode, system_prompt, fake_model, StrOutputParser())
+        chain.invoke(chain_input)
+    before_ms = (time.perf_counter() - t0) * 1000 / n_turns
+
+    # 本番の get_chat_model は差し替えず、フェイクモデルを返すファクトリを持つ専用キャッシュで計測する
+    cache = CompiledChainCache(model_factory=lambda *args, **kwargs: fake_model)
+    t0 = time.perf_counter()
+    for _ in range(n_turns):
+        _, chain, _ = cache.get(mode=mode, system_prompt=system_prompt, generate_title=False,
+                                model="fake", temperature=0.0, max_tokens=None)
+        chain.invoke(chain_input)
+    after_ms = (time.perf_counter() - t0) * 1000 / n_turns
+
+    result = {"before_ms_per_turn": before_ms, "after_ms_per_turn": after_ms}
+    logger.info("📊 chain overhead — before=%.2fms after=%.2fms per turn (n=%d)", before_ms, after_ms, n_turns)
+    return result
+
+if __name__ == "__main__":
+    print(benchmark_chain_overhead())
@@ -1,8 +1,12 @@
 # src/langchain_models.py
 
+import hashlib
 import os
-from typing import Union, Optional
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
 import boto3
+from botocore.config import Config as BotoConfig
+import httpx
 from langchain_aws import ChatBedrock  # ← AWS Bedrock用
 from langchain_openai import AzureChatOpenAI
 from langchain_core.language_models.chat_models import BaseChatModel
@@ -28,12 +32,133 @@ AZURE_MODEL_MAPPING = {
     "gpt-4o": "gpt-4o"
 }
 
+# 接続プール設定（同時チャット数に合わせて調整）
+_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+
+def _secret_fingerprint(*values: Optional[str]) -> str:
+    """認証情報そのものをキーに持たないためのハッシュ"""
+    return hashlib.sha256("|".join(v or "" for v in values).encode("utf-8")).hexdigest()[:16]
+
+class ClientPool:
+    """
+    プロバイダーの HTTP クライアントとチャットモデルを使い回すスレッドセーフなプール
+
+    - クライアント: (プロバイダー, リージョン/エンドポイント, 認証情報ハッシュ) ごとに 1 つ（keep-alive）
+    - モデル: (モデル名, temperature, max_tokens, 認証情報ハッシュ) ごとに 1 つ
+    - 認証情報は初回に読み込んでキャッシュし、refresh() で読み直す（ローテーション時）
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._credentials: Optional[dict] = None
+        self._clients: Dict[Tuple[str, ...], Any] = {}
+        self._models: Dict[Tuple[Any, ...], BaseChatModel] = {}
+        self.stats = {"model_hits": 0, "model_misses": 0, "client_created": 0, "refreshes": 0}
+
+    def get_credentials(self) -> dict:
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = ModelManager.load_credentials()
+            return self._credentials
+
+    def get_bedrock_client(self, credentials: dict):
+        key = (
+            "bedrock",
+            credentials["aws_region"] or "",
+            _secret_fingerprint(credentials["aws_access_key_id"], credentials["aws_secret_access_key"]),
+        )
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                session = boto3.Session(
+                    aws_access_key_id=credentials["aws_access_key_id"],
+                    aws_secret_access_key=credentials["aws_secret_access_key"],
+                    region_name=credentials["aws_region"]
+                )
+                client = session.client(
+                    "bedrock-runtime",
+                    config=BotoConfig(
+                        max_pool_connections=_POOL_MAX_CONNECTIONS,
+                        tcp_keepalive=True,
+                    ),
+                )
+                self._clients[key] = client
+                self.stats["client_created"] += 1
+                logger.info("🔌 Bedrock client作成: region=%s", credentials["aws_region"])
+            return client
+
+    def get_azure_http_client(self, credentials: dict) -> httpx.Client:
+        key = (
+            "azure",
+            credentials["azure_endpoint"] or "",
+            _secret_fingerprint(credentials["azure_api_key"]),
+        )
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = httpx.Client(
+                    limits=httpx.Limits(
+                        max_connections=_POOL_MAX_CONNECTIONS,
+                        max_keepalive_connections=_POOL_MAX_CONNECTIONS,
+                        keepalive_expiry=300,
+                    ),
+                    timeout=httpx.Timeout(600.0, connect=10.0),
+                )
+                self._clients[key] = client
+                self.stats["client_created"] += 1
+                logger.info("🔌 Azure HTTP client作成: endpoint=%s", credentials["azure_endpoint"])
+            return client
+
+    def get_model(self, model_name: str, temperature: float, max_tokens: Optional[int]) -> BaseChatModel:
+        credentials = self.get_credentials()
+        key = (
+            model_name,
+            float(temperature),
+            max_tokens,
+            _secret_fingerprint(credentials["aws_access_key_id"], credentials["azure_api_key"]),
+        )
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self.stats["model_hits"] += 1
+                return model
+            self.stats["model_misses"] += 1
+
+        model = ModelManager.create_model(model_name, temperature, max_tokens, credentials=credentials)
+        with self._lock:
+            # 並行して作成された場合は先に登録されたものを使う
+            return self._models.setdefault(key, model)
+
+    def refresh(self) -> None:
+        """
+        認証情報を読み直し、プールを空にする（次回呼び出しで再作成）。
+        古いクライアントは他のセッションのストリーミング中の可能性があるため close せず、
+        参照がなくなった時点で GC に回収させる。
+        """
+        with self._lock:
+            self._clients = {}
+            self._models = {}
+            self._credentials = None
+            self.stats["refreshes"] += 1
+        logger.info("🔄 モデルクライアントプールをリフレッシュしました")
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, clients=len(self._clients), models=len(self._models))
+
+_client_pool = ClientPool()
+
 class ModelManager:
     """LangChain用のモデル管理クラス"""
     
     @staticmethod
     def get_credentials() -> dict:
-        """認証情報を取得"""
+        """認証情報を取得（プールにキャッシュされた値）"""
+        return _client_pool.get_credentials()
+    
+    @staticmethod
+    def load_credentials() -> dict:
+        """認証情報を Streamlit Secrets / 環境変数から読み込む"""
         credentials = {}
         
         if STREAMLIT_AVAILABLE:
@@ -71,23 +196,17 @@ class ModelManager:
     def create_claude_model(
         model_name: str,
         temperature: float = 0.0,
-        max_tokens: Optional[int] = None
+        max_tokens: Optional[int] = None,
+        credentials: Optional[dict] = None
     ) -> ChatBedrock:
         """Claude (AWS Bedrock + Inference Profile経由) モデルを作成"""
-        credentials = ModelManager.get_credentials()
+        credentials = credentials or ModelManager.get_credentials()
         
         if not credentials["aws_access_key_id"] or not credentials["aws_secret_access_key"]:
             raise ValueError("AWS Bedrock の設定が不足しています。Streamlit SecretsのAWS認証情報を確認してください。")
         
-        # Boto3セッションを作成（認証情報を明示的に設定）
-        session = boto3.Session(
-            aws_access_key_id=credentials["aws_access_key_id"],
-            aws_secret_access_key=credentials["aws_secret_access_key"],
-            region_name=credentials["aws_region"]
-        )
-        
-        # Bedrock Runtimeクライアントを作成
-        bedrock_client = session.client('bedrock-runtime')
+        # Bedrock Runtimeクライアントはプールから取得（keep-alive で使い回す）
+        bedrock_client = _client_pool.get_bedrock_client(credentials)
         
         # ✅ Inference Profile IDを使用（元のコードと同じ）
         inference_profile_id = CLAUDE_MODEL_MAPPING.get(model_name, "apac.anthropic.claude-sonnet-4-20250514-v1:0")
@@ -112,10 +231,11 @@ class ModelManager:
     def create_azure_gpt_model(
         model_name: str,
         temperature: float = 0.0,
-        max_tokens: Optional[int] = None
+        max_tokens: Optional[int] = None,
+        credentials: Optional[dict] = None
     ) -> AzureChatOpenAI:
         """Azure OpenAI GPT モデルを作成"""
-        credentials = ModelManager.get_credentials()
+        credentials = credentials or ModelManager.get_credentials()
         
         if not credentials["azure_endpoint"] or not credentials["azure_api_key"]:
             raise ValueError("Azure OpenAI の設定が不足しています。Streamlit SecretsまたはSecrets.tomlを確認してください。")
@@ -128,7 +248,10 @@ class ModelManager:
             "temperature": temperature,
             "azure_endpoint": credentials["azure_endpoint"],
             "api_key": credentials["azure_api_key"],
-            "api_version": credentials["azure_api_version"]
+            "api_version": credentials["azure_api_version"],
+            "http_client": _client_pool.get_azure_http_client(credentials),
+            # ストリーミング時も usage（キャッシュ済みトークン数を含む）を受け取る
+            "stream_usage": True,
         }
         
         if max_tokens is not None:
@@ -145,7 +268,7 @@ class ModelManager:
         max_tokens: Optional[int] = None
     ) -> BaseChatModel:
         """
-        モデル名に基づいて適切なChatModelを返す
+        モデル名に基づいて適切なChatModelを返す（同じ設定のモデルはプールから再利用）
         
         Args:
             model_name: モデル名 (claude-4-sonnet, gpt-4o等)
@@ -155,12 +278,22 @@ class ModelManager:
         Returns:
             LangChainのChatModel
         """
+        return _client_pool.get_model(model_name, temperature, max_tokens)
+    
+    @staticmethod
+    def create_model(
+        model_name: str,
+        temperature: float = 0.0,
+        max_tokens: Optional[int] = None,
+        credentials: Optional[dict] = None
+    ) -> BaseChatModel:
+        """プールを経由せずに新しいChatModelを作成"""
         logger.info(f"🎯 LangChain ChatModel作成開始: model={model_name}")
         
         if model_name.startswith("claude"):
-            return ModelManager.create_claude_model(model_name, temperature, max_tokens)
+            return ModelManager.create_claude_model(model_name, temperature, max_tokens, credentials)
         elif model_name.startswith("gpt"):
-            return ModelManager.create_azure_gpt_model(model_name, temperature, max_tokens)
+            return ModelManager.create_azure_gpt_model(model_name, temperature, max_tokens, credentials)
         else:
             raise ValueError(f"サポートされていないモデル: {model_name}")
 
@@ -173,6 +306,18 @@ def get_chat_model(
     """ModelManager.get_chat_modelの便利関数"""
     return ModelManager.get_chat_model(model_name, temperature, max_tokens)
 
+def get_provider(model_name: str) -> str:
+    """モデルの呼び出し先プロバイダ（"bedrock" / "azure"）"""
+    return "bedrock" if model_name in CLAUDE_MODEL_MAPPING else "azure"
+
+def refresh_model_clients() -> None:
+    """認証情報のローテーション後に呼び出す（クライアント・モデルを作り直す）"""
+    _client_pool.refresh()
+
+def get_model_pool_stats() -> Dict[str, int]:
+    """クライアントプールの統計（モデル再利用のヒット数など）"""
+    return _client_pool.get_stats()
+
 # 互換性テスト用関数
 def test_model_creation():
     """モデル作成のテスト"""
@@ -0,0 +1,58 @@
+# src/multi_stream.py
+"""
+複数モデルの回答ストリームを同時に読む（比較モード用）
+
+Streamlit の描画はメインスレッドからしか行えないため、各ストリームは別スレッドで読み、
+到着したチャンクを (ストリーム番号, チャンク) としてキュー経由でメインスレッドへ渡す。
+1 本がエラーになっても他のストリームは最後まで読み続ける。
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "StreamMultiplexer",
+]
+
+class StreamMultiplexer:
+    """
+    streams を並行に読み、(index, chunk) を到着順に返すイテレータ。
+    読み終わった後は errors[index]（例外）と elapsed_s[index]（開始から完了までの秒数）を参照できる。
+    """
+
+    def __init__(self, streams: Iterable[Any]):
+        self.streams: List[Any] = list(streams)
+        self.errors: Dict[int, Exception] = {}
+        self.elapsed_s: Dict[int, float] = {}
+        self._queue: "queue.Queue[Tuple[int, str, Any]]" = queue.Queue()
+        self._t0: Optional[float] = None
+
+    def _run(self, idx: int, stream: Any) -> None:
+        try:
+            for chunk in stream:
+                self._queue.put((idx, "chunk", chunk))
+            self._queue.put((idx, "done", None))
+        except Exception as e:
+            self._queue.put((idx, "error", e))
+
+    def __iter__(self) -> Iterator[Tuple[int, Any]]:
+        self._t0 = time.perf_counter()
+        for idx, stream in enumerate(self.streams):
+            threading.Thread(target=self._run, args=(idx, stream), daemon=True, name=f"MultiStream-{idx}").start()
+        remaining = len(self.streams)
+        while remaining:
+            idx, kind, payload = self._queue.get()
+            if kind == "chunk":
+                yield idx, payload
+                continue
+            remaining -= 1
+            self.elapsed_s[idx] = time.perf_counter() - self._t0
+            if kind == "error":
+                logger.warning("⚠️ multi_stream — stream %d がエラー: %s", idx, payload)
+                self.errors[idx] = payload
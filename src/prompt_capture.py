@@ -0,0 +1,225 @@
+# src/prompt_capture.py
+"""
+送信プロンプトの遅延・重複排除キャプチャ
+
+毎ターン全メッセージを 1 本の文字列に整形してログへ送る代わりに、
+「system プロンプト・資料ブロック・履歴・質問」のハッシュを並べたマニフェストだけを記録する。
+ブロック本文はハッシュをキーにした SQLite ストアへ 1 度だけ保存し、
+全文が必要になったとき（モデル比較シートへの送信・調査時）にだけ組み立てる。
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from src.embedding_cache import get_cache_dir
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "block_hash",
+    "PromptBlockStore",
+    "get_prompt_block_store",
+    "PromptCapture",
+    "render_manifest",
+    "prompt_log_text",
+]
+
+# マニフェストに載せる資料ブロック（chain_input のキー）。プロンプトに使わないモードでは記録しない
+_KNOWLEDGE_FIELDS = ("equipment_content", "building_content", "target_building_content", "other_buildings_content")
+_MODE_KNOWLEDGE_FIELDS = {
+    "質疑応答書添削モード": (),
+    "ビルマスタ質問モード": ("building_content", "target_building_content", "other_buildings_content"),
+}
+
+def block_hash(text: str) -> str:
+    """ブロック本文の SHA-256（正規化なし。復元した全文が送信時と完全一致するように）"""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+# ---------------------------------------------------------------------------
+# コンテンツアドレス型ストア
+# ---------------------------------------------------------------------------
+class PromptBlockStore:
+    """ハッシュ → 本文 の SQLite ストア。保存済みハッシュはメモリにも持ち、再書き込みしない"""
+
+    def __init__(self, db_path: str | None = None):
+        self.db_path = db_path or os.path.join(get_cache_dir(), "prompt_blocks.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS prompt_blocks (
+                block_hash TEXT PRIMARY KEY,
+                kind       TEXT NOT NULL,
+                text       TEXT NOT NULL,
+                chars      INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self._known: set = set()
+        self.stats = {"written": 0, "deduplicated": 0, "written_chars": 0}
+
+    def put_many(self, blocks: Iterable[tuple]) -> int:
+        """(hash, kind, text) を保存（既知のハッシュはスキップ）。新規に書いた件数を返す"""
+        with self._lock:
+            new_rows = []
+            for digest, kind, text in blocks:
+                if digest in self._known:
+                    self.stats["deduplicated"] += 1
+                    continue
+                self._known.add(digest)
+                new_rows.append((digest, kind, text, len(text), time.time()))
+            if not new_rows:
+                return 0
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO prompt_blocks (block_hash, kind, text, chars, created_at) VALUES (?, ?, ?, ?, ?)",
+                new_rows,
+            )
+            self._conn.commit()
+            self.stats["written"] += cursor.rowcount
+            self.stats["written_chars"] += sum(row[3] for row in new_rows)
+            return len(new_rows)
+
+    def get_many(self, hashes: Iterable[str]) -> Dict[str, str]:
+        hashes = list(dict.fromkeys(hashes))
+        if not hashes:
+            return {}
+        placeholders = ",".join("?" * len(hashes))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT block_hash, text FROM prompt_blocks WHERE block_hash IN ({placeholders})", hashes
+            ).fetchall()
+        return dict(rows)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM prompt_blocks").fetchone()[0]
+            return dict(self.stats, blocks=count)
+
+_block_store: Optional[PromptBlockStore] = None
+_block_store_lock = threading.Lock()
+
+def get_prompt_block_store() -> PromptBlockStore:
+    """プロセス共通の PromptBlockStore を取得"""
+    global _block_store
+    with _block_store_lock:
+        if _block_store is None:
+            _block_store = PromptBlockStore()
+            logger.info("🗂️ PromptBlockStore 初期化: %s", _block_store.db_path)
+        return _block_store
+
+# ---------------------------------------------------------------------------
+# キャプチャ
+# ---------------------------------------------------------------------------
+class PromptCapture:
+    """
+    1 ターン分の送信プロンプトの参照を保持する。
+    生成時は入力を参照するだけで、ハッシュ計算（manifest）・保存（persist）・全文整形（render）は
+    必要になった時点で行う。str() すると全文を返すので、従来の complete_prompt 文字列の代わりに渡せる。
+    """
+
+    def __init__(self, *, mode: str, model: str, system_prompt: str, chain_input: Dict[str, Any]):
+        self.mode = mode
+        self.model = model
+        self.system_prompt = system_prompt
+        self.chain_input = chain_input
+        self._manifest: Optional[Dict[str, Any]] = None
+        self._blocks: List[tuple] = []
+        self._rendered: Optional[str] = None
+
+    @property
+    def manifest(self) -> Dict[str, Any]:
+        """system/資料/履歴はハッシュ、質問は本文のまま持つ小さな dict"""
+        if self._manifest is None:
+            blocks: List[tuple] = []
+
+            def _ref(kind: str, text: str) -> Dict[str, Any]:
+                digest = block_hash(text)
+                blocks.append((digest, kind, text))
+                return {"hash": digest, "chars": len(text)}
+
+            knowledge = {
+                field: _ref(field, self.chain_input[field])
+                for field in _MODE_KNOWLEDGE_FIELDS.get(self.mode, _KNOWLEDGE_FIELDS) if self.chain_input.get(field)
+            }
+            history = [
+                dict(_ref("history", msg["content"]), role=msg["role"])
+                for msg in (self.chain_input.get("chat_history") or [])
+                if isinstance(msg, dict) and msg.get("role") and msg.get("content")
+            ]
+            self._manifest = {
+                "v": 1,
+                "mode": self.mode,
+                "model": self.model,
+                "system": _ref("system", self.system_prompt),
+                "knowledge": knowledge,
+                "history": history,
+                "question": self.chain_input.get("question", ""),
+            }
+            self._blocks = blocks
+        return self._manifest
+
+    def manifest_json(self) -> str:
+        return json.dumps(self.manifest, ensure_ascii=False, separators=(",", ":"))
+
+    def persist(self, store: Optional[PromptBlockStore] = None) -> int:
+        """ブロック本文をストアへ保存（既知のハッシュは書かない）"""
+        self.manifest  # ブロック一覧を確定させる
+        return (store or get_prompt_block_store()).put_many(self._blocks)
+
+    def render(self) -> str:
+        """送信したメッセージ列を従来の complete_prompt と同じ形式で組み立てる"""
+        if self._rendered is None:
+            from src.langchain_chains import build_answer_prompt, get_actual_prompt_from_template
+
+            template = build_answer_prompt(self.mode, self.system_prompt)
+            self._rendered = get_actual_prompt_from_template(template, dict(self.chain_input), self.mode)
+        return self._rendered
+
+    def __str__(self) -> str:
+        return self.render()
+
+    def __len__(self) -> int:
+        manifest = self.manifest
+        return (manifest["system"]["chars"] + len(manifest["question"])
+                + sum(ref["chars"] for ref in manifest["knowledge"].values())
+                + sum(ref["chars"] for ref in manifest["history"]))
+
+def render_manifest(manifest: Union[str, Dict[str, Any]], store: Optional[PromptBlockStore] = None) -> str:
+    """ログに残したマニフェスト（dict か JSON 文字列）から全文を復元する"""
+    if isinstance(manifest, str):
+        manifest = json.loads(manifest)
+    store = store or get_prompt_block_store()
+    refs = [manifest["system"], *manifest["knowledge"].values(), *manifest["history"]]
+    texts = store.get_many(ref["hash"] for ref in refs)
+    missing = [ref["hash"] for ref in refs if ref["hash"] not in texts]
+    if missing:
+        raise KeyError(f"プロンプトブロックが見つかりません: {missing[:3]}")
+
+    chain_input = {field: texts[ref["hash"]] for field, ref in manifest["knowledge"].items()}
+    chain_input["question"] = manifest["question"]
+    chain_input["chat_history"] = [{"role": ref["role"], "content": texts[ref["hash"]]} for ref in manifest["history"]]
+    capture = PromptCapture(mode=manifest["mode"], model=manifest.get("model", ""),
+                            system_prompt=texts[manifest["system"]["hash"]], chain_input=chain_input)
+    return capture.render()
+
+def prompt_log_text(prompt: Union[str, PromptCapture]) -> str:
+    """
+    ログ保存用の文字列。PromptCapture ならブロックをストアへ保存してマニフェスト JSON を返し、
+    文字列（従来形式）ならそのまま返す。
+    """
+    if not isinstance(prompt, PromptCapture):
+        return prompt
+    try:
+        prompt.persist()
+    except Exception as e:
+        logger.warning(f"⚠️ プロンプトブロック保存失敗（マニフェストのみ記録）: {e}")
+    return prompt.manifest_json()
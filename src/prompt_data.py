@@ -0,0 +1,167 @@
+# src/prompt_data.py
+"""
+プロンプトに載せる資料データ（設備資料・ビル情報）の組み立て
+
+アプリの prepare_prompt_data（セッション状態から選択内容を読む）と
+オフラインのバッチ比較（質問セットの各行から選択内容を読む）で同じ処理を使う。
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Optional
+
+from src.rag_retriever import retrieve_equipment_context
+from src.startup_loader import get_allowed_jurisdiction_tags
+from src.table_store import get_table_store, format_table_lookup
+from src.building_manager import get_building_manager
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = ["build_prompt_data"]
+
+def build_prompt_data(
+    question: Optional[str],
+    *,
+    mode: str,
+    equipment_data: Optional[Dict[str, Any]] = None,
+    selected_equipment: Optional[str] = None,
+    selected_files: Optional[List[str]] = None,
+    selected_jurisdiction: Optional[str] = None,
+    context_mode: str = "full",
+    retrieval_top_k: int = 8,
+    retrieval_method: str = "hybrid",
+    include_building: bool = False,
+    building_mode: str = "none",
+    selected_building: Optional[str] = None,
+) -> Dict[str, Any]:
+    """選択された設備・ファイル・ビルから LangChain 用の入力データを準備"""
+    current_mode = mode
+    
+    equipment_content = None
+    building_content = None
+    target_building_content = None  # 🔥 新規追加
+    other_buildings_content = None  # 🔥 新規追加
+    context_stats = {"context_mode": "full", "full_chars": 0, "context_chars": 0}
+    used_equipment = None
+    used_files: List[str] = []  # 実際にプロンプトへ載せた資料（検索モードはヒットしたチャンクの出典）
+    
+    # 設備資料の取得（暗黙知モードのみ）
+    if current_mode == "暗黙知法令チャットモード":
+        if selected_equipment and selected_files and equipment_data:
+            equipment_texts = []
+            
+            for file_name in selected_files:
+                if file_name in equipment_data[selected_equipment]["files"]:
+                    file_text = equipment_data[selected_equipment]["files"][file_name]
+                    equipment_texts.append(file_text)
+                    used_files.append(file_name)
+            
+            if equipment_texts:
+                equipment_content = "\n\n".join(equipment_texts)
+                used_equipment = selected_equipment
+                context_stats["full_chars"] = len(equipment_content)
+                context_stats["context_chars"] = len(equipment_content)
+            
+            # 🔥 検索モード: 質問に関連する上位k件のチャンクのみ送信
+            if equipment_content and question and context_mode == "retrieval":
+                try:
+                    retrieved = retrieve_equipment_context(
+                        question,
+                        equipment_name=selected_equipment,
+                        files=selected_files,
+                        jurisdiction_tags=get_allowed_jurisdiction_tags(selected_jurisdiction),
+                        top_k=retrieval_top_k,
+                        method=retrieval_method,
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ RAG検索失敗、全文モードで継続: {e}")
+                    retrieved = None
+                
+                # 表の検索: 該当する行だけを列ヘッダー付きで先頭に載せる
+                table_results = []
+                try:
+                    table_results = get_table_store().lookup(
+                        question,
+                        equipment_name=selected_equipment,
+                        sources=selected_files,
+                    )
+                except Exception as e:
+                    logger.warning(f"⚠️ 表検索失敗: {e}")
+                
+                if retrieved and retrieved["content"]:
+                    equipment_content = retrieved["content"]
+                    if table_results:
+                        equipment_content = format_table_lookup(table_results) + "\n\n" + equipment_content
+                    used_files = [f for f in dict.fromkeys(
+                        [t["source"] for t in table_results]
+                        + [(hit.get("metadata") or {}).get("source") for hit in retrieved["hits"]]
+                    ) if f]
+                    context_stats.update({
+                        "context_mode": "retrieval",
+                        "context_chars": len(equipment_content),
+                        "hits": len(retrieved["hits"]),
+                        "table_rows": sum(len(t["rows"]) for t in table_results),
+                        "retrieval_ms": retrieved["elapsed_ms"],
+                    })
+    
+    # 🔥 修正: ビル情報の取得（新しいbuilding_mode対応）
+    if current_mode in ["暗黙知法令チャットモード", "ビルマスタ質問モード"]:
+        # ビルマスタモードは常にビル情報を使用、暗黙知モードはチェックボックス次第
+        if (current_mode == "ビルマスタ質問モード") or \
+        (current_mode == "暗黙知法令チャットモード" and include_building):
+            
+            try:
+                building_manager = get_building_manager()
+                if building_manager and building_manager.available:
+                    
+                    if building_mode == "specific_only" and selected_building:
+                        # 特定ビルのみ（従来の動作）
+                        building_content = building_manager.format_building_info_for_prompt(selected_building)
+                        target_building_content = building_content
+                        other_buildings_content = None
+                        
+                    elif building_mode == "specific_with_others" and selected_building:
+                        # 🔥 新機能: 特定ビル + 他のビル
+                        target_building_content = building_manager.format_building_info_for_prompt(selected_building)
+                        
+                        # 他のビル情報を取得（選択したビル以外）
+                        all_buildings = building_manager.get_building_list()
+                        other_buildings = [b for b in all_buildings if b != selected_building]
+                        
+                        if other_buildings:
+                            other_building_parts = []
+                            for other_building in other_buildings:
+                                other_info = building_manager.format_building_info_for_prompt(other_building)
+                                other_building_parts.append(other_info)
+                            other_buildings_content = "\n\n".join(other_building_parts)
+                        else:
+                            other_buildings_content = "他のビル情報はありません。"
+                        
+                        # 従来のbuilding_contentも設定（後方互換性のため）
+                        building_content = target_building_content + "\n\n" + other_buildings_content
+                        
+                    elif building_mode == "all":
+                        # 全ビル情報（従来の動作）
+                        building_content = building_manager.format_building_info_for_prompt()
+                        target_building_content = None
+                        other_buildings_content = building_content
+                        
+                    elif building_mode in ["specific", "specific_only"]:
+                        # 🔥 後方互換性: 既存のspecificモードを specific_only として処理
+                        if selected_building:
+                            building_content = building_manager.format_building_info_for_prompt(selected_building)
+                            target_building_content = building_content
+                            other_buildings_content = None
+                        
+            except Exception as e:
+                logger.warning(f"⚠️ ビル情報取得失敗: {e}")
+    
+    return {
+        "mode": current_mode,
+        "equipment_content": equipment_content,
+        "building_content": building_content,  # 従来の統合版（後方互換性）
+        "target_building_content": target_building_content,  # 🔥 新規: 対象ビル
+        "other_buildings_content": other_buildings_content,   # 🔥 新規: その他ビル
+        "context_stats": context_stats,  # 🔥 新規: 全文/検索モードの比較用統計
+        "used_equipment": used_equipment,  # 設備資料を載せた場合の設備名
+        "used_files": used_files,  # 載せた資料ファイル（検索モードはヒットしたチャンクの出典）
+    }
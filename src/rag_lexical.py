@@ -0,0 +1,217 @@
+# src/rag_lexical.py
+"""
+日本語向け文字 n-gram の BM25 インデックス（プロセス内）
+
+埋め込み検索では拾いにくい型式文字列・条文番号などの完全一致語を補うための語彙検索。
+文字 bigram/trigram でトークン化し、BM25 の重みは構築時に計算しておくことで、
+検索は numpy の加算だけで済ませる（数千チャンクで数ミリ秒以内）。
+"""
+from __future__ import annotations
+
+import json
+import math
+import re
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "tokenize_ngrams",
+    "metadata_matches",
+    "NgramBM25Index",
+    "reciprocal_rank_fusion",
+]
+
+_SEGMENT_SPLIT = re.compile(r"[^\w]+")
+_ASCII_TOKEN = re.compile(r"[a-z0-9]+(?:[-_/.][a-z0-9]+)*")
+_HYPHENS = str.maketrans({"‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "―": "-", "−": "-"})
+
+# ---------------------------------------------------------------------------
+# トークン化
+# ---------------------------------------------------------------------------
+def _normalize(text: str) -> str:
+    # ハイフン類の揺れも統一（型式文字列対策）
+    return unicodedata.normalize("NFKC", text or "").lower().translate(_HYPHENS)
+
+def tokenize_ngrams(text: str, sizes: Sequence[int] = (2, 3)) -> List[str]:
+    """
+    NFKC 正規化 → 記号・空白で分割 → 各区間の文字 n-gram を生成。
+    英数字の型式（例: "fhk-12a"）はトークン全体もそのまま語として加える。
+    """
+    normalized = _normalize(text)
+    tokens: List[str] = []
+
+    for ascii_token in _ASCII_TOKEN.findall(normalized):
+        if len(ascii_token) >= 2:
+            tokens.append(ascii_token)
+
+    min_size = min(sizes)
+    for segment in _SEGMENT_SPLIT.split(normalized):
+        if not segment:
+            continue
+        if len(segment) < min_size:
+            tokens.append(segment)
+            continue
+        for n in sizes:
+            tokens.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return tokens
+
+# ---------------------------------------------------------------------------
+# メタデータフィルタ（Chroma の where 構文のサブセット）
+# ---------------------------------------------------------------------------
+def metadata_matches(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """$and / $or / $eq / $ne / $in / $nin をサポート"""
+    if not where:
+        return True
+    for key, cond in where.items():
+        if key == "$and":
+            if not all(metadata_matches(metadata, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(metadata_matches(metadata, c) for c in cond):
+                return False
+        else:
+            value = metadata.get(key)
+            if isinstance(cond, dict):
+                for op, expected in cond.items():
+                    if op == "$eq" and value != expected:
+                        return False
+                    if op == "$ne" and value == expected:
+                        return False
+                    if op == "$in" and value not in expected:
+                        return False
+                    if op == "$nin" and value in expected:
+                        return False
+            elif value != cond:
+                return False
+    return True
+
+# ---------------------------------------------------------------------------
+# BM25 インデックス
+# ---------------------------------------------------------------------------
+class NgramBM25Index:
+    """文字 n-gram BM25 インデックス"""
+
+    def __init__(self, ngram_sizes: Sequence[int] = (2, 3), k1: float = 1.2, b: float = 0.75):
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.k1 = k1
+        self.b = b
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        # term -> (doc_idx 配列, 事前計算済み BM25 重み配列)
+        self._postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        # where 条件 → 対象ドキュメントのマスク（同じ絞り込みが繰り返されるため保持）
+        self._mask_cache: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def build(self, items: Iterable[Tuple[str, str, Dict[str, Any]]]) -> "NgramBM25Index":
+        """(id, content, metadata) の列からインデックスを構築"""
+        t0 = time.perf_counter()
+        self.ids, self.documents, self.metadatas = [], [], []
+        term_docs: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        doc_lengths: List[int] = []
+
+        for doc_idx, (doc_id, content, metadata) in enumerate(items):
+            self.ids.append(doc_id)
+            self.documents.append(content)
+            self.metadatas.append(metadata or {})
+            counts = Counter(tokenize_ngrams(content, self.ngram_sizes))
+            doc_lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                term_docs[term].append((doc_idx, tf))
+
+        n_docs = len(self.ids)
+        avgdl = (sum(doc_lengths) / n_docs) if n_docs else 0.0
+        lengths = np.asarray(doc_lengths, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * lengths / avgdl) if n_docs and avgdl else lengths
+
+        self._postings = {}
+        self._mask_cache = {}
+        for term, postings in term_docs.items():
+            idx = np.fromiter((p[0] for p in postings), dtype=np.int32, count=len(postings))
+            tf = np.fromiter((p[1] for p in postings), dtype=np.float32, count=len(postings))
+            df = len(postings)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            weights = idf * tf * (self.k1 + 1) / (tf + norm[idx])
+            self._postings[term] = (idx, weights.astype(np.float32))
+
+        logger.info("📚 BM25インデックス構築 — docs=%d terms=%d elapsed=%.2fs",
+                    n_docs, len(self._postings), time.perf_counter() - t0)
+        return self
+
+    def _where_mask(self, where: Dict[str, Any]) -> np.ndarray:
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        mask = self._mask_cache.get(key)
+        if mask is None:
+            mask = np.fromiter(
+                (metadata_matches(meta, where) for meta in self.metadatas),
+                dtype=bool,
+                count=len(self.metadatas),
+            )
+            if len(self._mask_cache) >= 64:
+                self._mask_cache.pop(next(iter(self._mask_cache)))
+            self._mask_cache[key] = mask
+        return mask
+
+    def search(
+        self,
+        query: str,
+        top_k: int = 20,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> List[Dict[str, Any]]:
+        """クエリの n-gram で BM25 スコアを計算し、上位 top_k 件を返す"""
+        if not self.ids:
+            return []
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term in set(tokenize_ngrams(query, self.ngram_sizes)):
+            posting = self._postings.get(term)
+            if posting is not None:
+                idx, weights = posting
+                scores[idx] += weights
+
+        if where:
+            scores[~self._where_mask(where)] = 0.0
+
+        candidates = np.flatnonzero(scores > 0)
+        if candidates.size == 0:
+            return []
+        if candidates.size > top_k:
+            part = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+            candidates = candidates[part]
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return [
+            {
+                "id": self.ids[i],
+                "content": self.documents[i],
+                "metadata": self.metadatas[i],
+                "score": float(scores[i]),
+            }
+            for i in order
+        ]
+
+# ---------------------------------------------------------------------------
+# ランキング統合
+# ---------------------------------------------------------------------------
+def reciprocal_rank_fusion(
+    rankings: Sequence[Sequence[str]],
+    k: int = 60,
+    weights: Optional[Sequence[float]] = None,
+) -> List[Tuple[str, float]]:
+    """複数のランキング（ID 列）を RRF で統合し、(id, score) を降順で返す"""
+    weights = weights or [1.0] * len(rankings)
+    fused: Dict[str, float] = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] += weight / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,336 @@
+# src/rag_memmap.py
+"""
+NumPy memmap による軽量ベクトルストア（Chroma の代替バックエンド）
+
+- 埋め込みは L2 正規化した float16 行列として .npy に保存し、読み込み時は memmap で開く
+- id / 本文 / メタデータは JSON のサイドテーブルに保存
+- 検索はメタデータで事前に行を絞り込んでから、行列×ベクトル 1 回で厳密な top-k を求める
+
+Chroma の Collection と同じ get / upsert / delete / query / count を持つため、
+rag_vector の sync_docs_to_collection / query_collection をそのまま使える。
+"""
+from __future__ import annotations
+
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.rag_lexical import metadata_matches
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "MemmapVectorStore",
+    "save_docs_to_memmap",
+    "load_memmap_store",
+    "benchmark_against_chroma",
+]
+
+# 行列×ベクトルをこの行数ずつ float32 に変換して計算する（float16 のままの演算は遅いため）
+_BLOCK_ROWS = 2048
+
+class MemmapVectorStore:
+    """memmap ベースのベクトルストア（Chroma Collection 互換の最小 API）"""
+
+    def __init__(self, directory: str, name: str, dtype: str = "float16", cache_float32: bool = True):
+        """
+        cache_float32=True の場合、初回検索時に float32 のコピーを RAM に展開して以降の行列積を速くする
+        （数千チャンク × 1536 次元で数十MB程度）。False なら毎回 memmap からブロック単位で変換する。
+        """
+        self.directory = directory
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.cache_float32 = cache_float32
+        self._matrix32: Optional[np.ndarray] = None
+        os.makedirs(directory, exist_ok=True)
+
+        self.vectors_path = os.path.join(directory, f"{name}.npy")
+        self.meta_path = os.path.join(directory, f"{name}.meta.json")
+
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._id_index: Dict[str, int] = {}
+        self._mask_cache: Dict[str, np.ndarray] = {}
+        self._dirty = False
+        self._load()
+
+    # — 永続化 —
+    def _load(self) -> None:
+        if not (os.path.exists(self.vectors_path) and os.path.exists(self.meta_path)):
+            return
+        with open(self.meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.ids = meta["ids"]
+        self.documents = meta["documents"]
+        self.metadatas = meta["metadatas"]
+        self._matrix = np.load(self.vectors_path, mmap_mode="r")
+        self._id_index = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        logger.info("📂 memmapストア読み込み: %s (%d 件)", self.vectors_path, len(self.ids))
+
+    def flush(self) -> None:
+        """変更があればファイルに書き出し、memmap で開き直す（一時ファイル経由で置換）"""
+        if not self._dirty:
+            return
+        matrix = self._matrix if self._matrix is not None else np.zeros((0, 0), dtype=self.dtype)
+
+        tmp_vectors = self.vectors_path + ".tmp.npy"
+        np.save(tmp_vectors, np.ascontiguousarray(matrix, dtype=self.dtype))
+        tmp_meta = self.meta_path + ".tmp"
+        with open(tmp_meta, "w", encoding="utf-8") as f:
+            json.dump(
+                {"ids": self.ids, "documents": self.documents, "metadatas": self.metadatas},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_vectors, self.vectors_path)
+        os.replace(tmp_meta, self.meta_path)
+
+        self._matrix = np.load(self.vectors_path, mmap_mode="r")
+        self._dirty = False
+        logger.info("💾 memmapストア保存: %s (%d 件)", self.vectors_path, len(self.ids))
+
+    def _writable_matrix(self, dim: int) -> np.ndarray:
+        # memmap（読み取り専用）を書き換える前にメモリ上へコピーする
+        if self._matrix is None or self._matrix.size == 0:
+            self._matrix = np.zeros((0, dim), dtype=self.dtype)
+        elif isinstance(self._matrix, np.memmap):
+            self._matrix = np.array(self._matrix)
+        return self._matrix
+
+    @staticmethod
+    def _normalize(vectors: Sequence[Sequence[float]]) -> np.ndarray:
+        arr = np.asarray(vectors, dtype=np.float32)
+        if arr.ndim == 1:
+            arr = arr[None, :]
+        norms = np.linalg.norm(arr, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return arr / norms
+
+    # — Chroma 互換 API —
+    def count(self) -> int:
+        return len(self.ids)
+
+    def get(self, include: Optional[List[str]] = None, ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        include = include or ["metadatas", "documents"]
+        indices = [self._id_index[i] for i in ids if i in self._id_index] if ids else range(len(self.ids))
+        result: Dict[str, Any] = {"ids": [self.ids[i] for i in indices]}
+        if "metadatas" in include:
+            result["metadatas"] = [self.metadatas[i] for i in indices]
+        if "documents" in include:
+            result["documents"] = [self.documents[i] for i in indices]
+        return result
+
+    def upsert(
+        self,
+        *,
+        embeddings: Sequence[Sequence[float]],
+        documents: Sequence[str],
+        metadatas: Sequence[Dict[str, Any]],
+        ids: Sequence[str],
+    ) -> None:
+        vectors = self._normalize(embeddings).astype(self.dtype)
+        matrix = self._writable_matrix(vectors.shape[1])
+        if matrix.shape[0] and matrix.shape[1] != vectors.shape[1]:
+            raise ValueError(f"埋め込み次元が一致しません: {matrix.shape[1]} != {vectors.shape[1]}")
+
+        new_rows = []
+        for vec, doc, meta, doc_id in zip(vectors, documents, metadatas, ids):
+            row = self._id_index.get(doc_id)
+            if row is not None:
+                matrix[row] = vec
+                self.documents[row] = doc
+                self.metadatas[row] = dict(meta)
+            else:
+                self._id_index[doc_id] = len(self.ids)
+                self.ids.append(doc_id)
+                self.documents.append(doc)
+                self.metadatas.append(dict(meta))
+                new_rows.append(vec)
+
+        if new_rows:
+            matrix = np.vstack([matrix, np.stack(new_rows)])
+        self._matrix = matrix
+        self._matrix32 = None
+        self._mask_cache = {}
+        self._dirty = True
+
+    def delete(self, ids: Sequence[str]) -> None:
+        remove = {self._id_index[i] for i in ids if i in self._id_index}
+        if not remove:
+            return
+        keep = [i for i in range(len(self.ids)) if i not in remove]
+        self._matrix = np.array(self._matrix[keep]) if self._matrix is not None else None
+        self.ids = [self.ids[i] for i in keep]
+        self.documents = [self.documents[i] for i in keep]
+        self.metadatas = [self.metadatas[i] for i in keep]
+        self._id_index = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self._matrix32 = None
+        self._mask_cache = {}
+        self._dirty = True
+
+    def _candidate_rows(self, where: Optional[Dict[str, Any]]) -> np.ndarray:
+        if not where:
+            return np.arange(len(self.ids))
+        key = json.dumps(where, sort_keys=True, ensure_ascii=False)
+        rows = self._mask_cache.get(key)
+        if rows is None:
+            rows = np.flatnonzero(np.fromiter(
+                (metadata_matches(meta, where) for meta in self.metadatas),
+                dtype=bool,
+                count=len(self.metadatas),
+            ))
+            if len(self._mask_cache) >= 64:
+                self._mask_cache.pop(next(iter(self._mask_cache)))
+            self._mask_cache[key] = rows
+        return rows
+
+    def query(
+        self,
+        *,
+        query_embeddings: Sequence[Sequence[float]],
+        n_results: int = 5,
+        where: Optional[Dict[str, Any]] = None,
+        **_: Any,
+    ) -> Dict[str, List[List[Any]]]:
+        """コサイン類似度で厳密 top-k（distances は 1 - cos）"""
+        queries = self._normalize(query_embeddings)
+        result: Dict[str, List[List[Any]]] = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        rows = self._candidate_rows(where)
+
+        if self._matrix is None or rows.size == 0:
+            for _ in range(len(queries)):
+                for key in result:
+                    result[key].append([])
+            return result
+
+        contiguous = rows.size == len(self.ids)
+        if self.cache_float32:
+            if self._matrix32 is None:
+                self._matrix32 = np.asarray(self._matrix, dtype=np.float32)
+            matrix32 = self._matrix32 if contiguous else self._matrix32[rows]
+            sims = queries @ matrix32.T
+        else:
+            # 事前絞り込みした行だけをブロックごとに float32 化して行列積
+            sims = np.empty((len(queries), rows.size), dtype=np.float32)
+            for start in range(0, rows.size, _BLOCK_ROWS):
+                block_rows = rows[start:start + _BLOCK_ROWS]
+                block = (self._matrix[start:start + len(block_rows)] if contiguous
+                         else self._matrix[block_rows])
+                sims[:, start:start + len(block_rows)] = queries @ np.asarray(block, dtype=np.float32).T
+
+        k = min(n_results, rows.size)
+        for q_sims in sims:
+            top = np.argpartition(-q_sims, k - 1)[:k] if k < rows.size else np.arange(rows.size)
+            top = top[np.argsort(-q_sims[top], kind="stable")]
+            picked = rows[top]
+            result["ids"].append([self.ids[i] for i in picked])
+            result["documents"].append([self.documents[i] for i in picked])
+            result["metadatas"].append([self.metadatas[i] for i in picked])
+            result["distances"].append([float(1.0 - s) for s in q_sims[top]])
+        return result
+
+# ---------------------------------------------------------------------------
+# save_docs_to_chroma / load_collection 相当の API
+# ---------------------------------------------------------------------------
+def load_memmap_store(collection_name: str, persist_directory: str) -> Optional[MemmapVectorStore]:
+    """永続化済みストアを読み込む（存在しない・空の場合は None）"""
+    store = MemmapVectorStore(persist_directory, collection_name)
+    return store if store.count() else None
+
+def save_docs_to_memmap(
+    *,
+    docs: List[Dict[str, Any]],
+    collection_name: str,
+    persist_directory: str,
+    batch_size: int = 50,
+    prune: bool = True,
+    rebuild: bool = False,
+) -> MemmapVectorStore:
+    """save_docs_to_chroma と同じ差分同期を memmap ストアに対して行う"""
+    from src.rag_vector import sync_docs_to_collection
+
+    store = MemmapVectorStore(persist_directory, collection_name)
+    if rebuild and store.count():
+        store.delete(list(store.ids))
+
+    result = sync_docs_to_collection(store, docs, batch_size=batch_size, prune=prune)
+    store.flush()
+    print(f"🎯 最終統計(memmap): upsert{result['upserted']}, 削除{result['deleted']}, "
+          f"変更なし{result['unchanged']}, DB内{store.count()} ドキュメント")
+    return store
+
+# ---------------------------------------------------------------------------
+# ベンチマーク
+# ---------------------------------------------------------------------------
+def benchmark_against_chroma(
+    n_docs: int = 3000,
+    dim: int = 1536,
+    n_queries: int = 50,
+    n_results: int = 8,
+    directory: Optional[str] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    ランダムベクトルで memmap ストアと Chroma（インメモリ）の
+    構築時間・検索レイテンシ（フィルタなし / 1ファイル絞り込み）を比較する。API は呼ばない。
+    """
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((n_docs, dim)).astype(np.float32)
+    queries = rng.standard_normal((n_queries, dim)).astype(np.float32)
+    ids = [f"doc_{i}" for i in range(n_docs)]
+    documents = [f"chunk {i}" for i in range(n_docs)]
+    metadatas = [{"source": f"file_{i % 30}.pdf", "kind": "text"} for i in range(n_docs)]
+    where = {"source": {"$in": ["file_3.pdf"]}}
+
+    def _run(store) -> Dict[str, float]:
+        stats: Dict[str, float] = {}
+        t0 = time.perf_counter()
+        for start in range(0, n_docs, 500):
+            store.upsert(
+                embeddings=vectors[start:start + 500].tolist(),
+                documents=documents[start:start + 500],
+                metadatas=metadatas[start:start + 500],
+                ids=ids[start:start + 500],
+            )
+        if hasattr(store, "flush"):
+            store.flush()
+        stats["build_s"] = time.perf_counter() - t0
+
+        for label, cond in (("query_ms", None), ("filtered_query_ms", where)):
+            t0 = time.perf_counter()
+            for q in queries:
+                kwargs: Dict[str, Any] = {"query_embeddings": [q.tolist()], "n_results": n_results}
+                if cond:
+                    kwargs["where"] = cond
+                store.query(**kwargs)
+            stats[label] = (time.perf_counter() - t0) / n_queries * 1000
+        return stats
+
+    results: Dict[str, Dict[str, float]] = {}
+    directory = directory or tempfile.mkdtemp(prefix="memmap_bench_")
+
+    t0 = time.perf_counter()
+    store = MemmapVectorStore(directory, "bench")
+    results["memmap"] = {"startup_s": time.perf_counter() - t0, **_run(store)}
+
+    try:
+        t0 = time.perf_counter()
+        from src.rag_vector import _import_chromadb
+        chromadb = _import_chromadb()
+        collection = chromadb.Client().get_or_create_collection(name="memmap_bench", metadata={"hnsw:space": "cosine"})
+        results["chroma"] = {"startup_s": time.perf_counter() - t0, **_run(collection)}
+    except Exception as e:
+        logger.warning("⚠️ Chroma ベンチマークをスキップ: %s", e)
+
+    for backend, stats in results.items():
+        print(f"📊 {backend}: " + ", ".join(f"{k}={v:.3f}" for k, v in stats.items()))
+    return results
+
+if __name__ == "__main__":
+    benchmark_against_chroma()
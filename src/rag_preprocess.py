@@ -2,7 +2,8 @@
 
 from __future__ import annotations
 from io import BytesIO
-from typing import List, Dict, Any
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Tuple
 import hashlib
 
 import pdfplumber       # pip install pdfplumber
@@ -18,7 +19,12 @@ __all__ = [
     "extract_text_from_pdf",
     "extract_text_from_txt",
     "chunk_text",
+    "count_tokens",
+    "split_file_pages",
+    "chunk_structured_text",
     "extract_tables_from_pdf",
+    "normalize_table",
+    "chunk_table_rows",
     "extract_images_from_pdf",
     "preprocess_files",
 ]
@@ -184,6 +190,182 @@ def chunk_text(text: str, *, chunk_size: int = 800, overlap: int = 80) -> List[s
     
     return chunks
 
+# ---------------------------------------------------------------------------
+# 2b) 構造を考慮したチャンク化（ページ・見出し・句点境界 + トークン予算）
+# ---------------------------------------------------------------------------
+_PAGE_MARKER = re.compile(r"^--- ページ (\d+) ---$", re.MULTILINE)
+_FILE_HEADER = re.compile(r"^=== ファイル: .* ===$", re.MULTILINE)
+_HEADING = re.compile(
+    r"^\s*(?:"
+    r"第[0-9０-９一二三四五六七八九十百]+[編章節款条項]"    # 第3章 / 第十二条
+    r"|[0-9０-９]+(?:[\.．][0-9０-９]+)*[\.．]?\s+\S"            # 1. 総則 / 3.4.1 設置基準
+    r"|[（(][0-9０-９一二三四五六七八九十]+[)）]"               # （1）
+    r"|【[^】]+】"                                          # 【設置基準】
+    r"|[■□◆◇●○▼▽]"                                       # 記号見出し
+    r")"
+)
+_SENTENCE_END = re.compile(r"(?<=[。！？])")
+
+@lru_cache(maxsize=1)
+def _get_token_encoder():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # 未インストール・エンコーディング取得失敗時は概算にフォールバック
+        return None
+
+def count_tokens(text: str) -> int:
+    """
+    トークン数を数える（tiktoken が使えれば cl100k_base、なければ概算）。
+    概算は日本語 1 文字 ≒ 1 トークン、英数字 4 文字 ≒ 1 トークン。
+    """
+    encoder = _get_token_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def split_file_pages(file_text: str) -> List[Tuple[int, str]]:
+    """preprocess_files が挿入した「--- ページ N ---」でファイルテキストをページ単位に分割"""
+    markers = list(_PAGE_MARKER.finditer(file_text))
+    if not markers:
+        body = _FILE_HEADER.sub("", file_text).strip()
+        return [(1, body)] if body else []
+
+    pages: List[Tuple[int, str]] = []
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(file_text)
+        page_text = file_text[marker.end():end].strip()
+        if page_text:
+            pages.append((int(marker.group(1)), page_text))
+    return pages
+
+def _split_units(page_text: str) -> List[Tuple[str, bool, bool]]:
+    """
+    ページを (テキスト, 見出しか, 段落の先頭か) の単位列に分割する。
+    見出し行は単独の単位、それ以外は空行と「。」で区切る（PDF の行内改行は保持）。
+    """
+    units: List[Tuple[str, bool, bool]] = []
+    buffer: List[str] = []
+
+    def flush_buffer():
+        if buffer:
+            paragraph = "\n".join(buffer)
+            sentences = [s for s in _SENTENCE_END.split(paragraph) if s.strip()]
+            for i, sentence in enumerate(sentences):
+                units.append((sentence.strip("\n") if i == 0 else sentence.lstrip("\n"), False, i == 0))
+            buffer.clear()
+
+    for line in page_text.splitlines():
+        if not line.strip():
+            flush_buffer()
+        elif _HEADING.match(line) and len(line.strip()) <= 60:
+            flush_buffer()
+            units.append((line.strip(), True, True))
+        else:
+            buffer.append(line.rstrip())
+    flush_buffer()
+    return units
+
+def _hard_split(text: str, max_tokens: int) -> List[str]:
+    """1 単位でも予算を超える場合のみ文字数で分割（表などの長い行対策）"""
+    pieces: List[str] = []
+    current = ""
+    for line in text.splitlines() or [text]:
+        while count_tokens(line) > max_tokens:
+            cut = max(1, len(line) * max_tokens // max(count_tokens(line), 1))
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:cut])
+            line = line[cut:]
+        candidate = f"{current}\n{line}" if current else line
+        if current and count_tokens(candidate) > max_tokens:
+            pieces.append(current)
+            current = line
+        else:
+            current = candidate
+    if current.strip():
+        pieces.append(current)
+    return pieces
+
+def chunk_structured_text(
+    file_text: str,
+    *,
+    max_tokens: int = 1000,
+    min_tokens: int = 200,
+) -> List[Dict[str, Any]]:
+    """
+    preprocess_files のファイルテキストを構造に沿ってチャンク化する。
+
+    - 見出し（章・条・番号・【】など）の手前で区切る（チャンクが min_tokens 未満なら続けて詰める）
+    - それ以外は「。」・空行の境界でだけ区切り、max_tokens を超えない範囲で詰める
+    - ページを跨いで詰めることができ、page_start / page_end に範囲を記録する
+    - 見出しの途中から始まるチャンクには直前の見出しを先頭に付ける
+
+    Returns:
+        [{"text", "page_start", "page_end", "heading", "tokens"}, ...]
+    """
+    if min_tokens >= max_tokens:
+        raise ValueError("min_tokens must be smaller than max_tokens")
+
+    chunks: List[Dict[str, Any]] = []
+    parts: List[str] = []  # 区切り文字（改行）込みで連結する断片
+    tokens = 0
+    page_start: Optional[int] = None
+    page_end: Optional[int] = None
+    heading: Optional[str] = None
+    chunk_heading: Optional[str] = None
+
+    def flush():
+        nonlocal parts, tokens, page_start
+        if parts:
+            chunks.append({
+                "text": "".join(parts).strip(),
+                "page_start": page_start,
+                "page_end": page_end,
+                "heading": chunk_heading,
+                "tokens": tokens,
+            })
+        parts, tokens, page_start = [], 0, None
+
+    for page, page_text in split_file_pages(file_text):
+        for unit, is_heading, starts_paragraph in _split_units(page_text):
+            if is_heading:
+                if tokens >= min_tokens:
+                    flush()
+                heading = unit
+
+            pieces = _hard_split(unit, max_tokens) if count_tokens(unit) > max_tokens else [unit]
+            for piece_idx, piece in enumerate(pieces):
+                piece_tokens = count_tokens(piece)
+                if parts and tokens + piece_tokens > max_tokens:
+                    flush()
+                heading_injected = False
+                if not parts:
+                    chunk_heading = heading
+                    page_start = page
+                    # 見出しの続きから始まる場合は文脈として見出しを付ける
+                    if heading and not is_heading:
+                        parts.append(heading)
+                        tokens += count_tokens(heading)
+                        heading_injected = True
+                # 付けた見出しと本文は必ず改行で区切る（続けると埋め込み・BM25 の語が崩れる）
+                new_line = piece_idx > 0 or starts_paragraph or heading_injected
+                parts.append(("\n" if parts and new_line else "") + piece)
+                tokens += piece_tokens
+                page_end = page
+    flush()
+    return chunks
+
+def _check_chunk_heading_separator() -> None:
+    """見出しの途中から始まるチャンクで、付けた見出しと本文が改行で区切られていることの確認"""
+    body = "感知器は天井に設ける。" * 200
+    chunks = chunk_structured_text(f"--- ページ 1 ---\n第1章 総則\n{body}", max_tokens=300, min_tokens=50)
+    assert len(chunks) > 1, chunks
+    for chunk in chunks[1:]:
+        assert chunk["text"].startswith("第1章 総則\n感知器"), chunk["text"][:40]
+
 # 🔥 新機能: ユニークID生成
 def generate_chunk_id(source: str, page: int, chunk_index: int, content: str) -> str:
     """ユニークなチャンクIDを生成"""
@@ -193,27 +375,163 @@ def generate_chunk_id(source: str, page: int, chunk_index: int, content: str) ->
 # ---------------------------------------------------------------------------
 # 3) 表の抽出
 # ---------------------------------------------------------------------------
+_NUMERIC_CELL = re.compile(r"^[\s　]*[-+−]?[0-9０-９]+(?:[.,．，][0-9０-９]+)*[\s　]*[^\s　]{0,4}$")
+
+def _clean_cell(cell: Any) -> Optional[str]:
+    """セル内の折り返し改行・余分な空白を除去（None は結合セルとして保持）"""
+    if cell is None:
+        return None
+    text = str(cell).replace("\r", "")
+    # 日本語の折り返しは空白なしで連結、英数字同士の折り返しは空白で連結
+    text = re.sub(r"(?<=[A-Za-z0-9])\n(?=[A-Za-z0-9])", " ", text)
+    text = text.replace("\n", "")
+    return re.sub(r"[ \t　]+", " ", text).strip()
+
+def _is_numeric_row(row: List[str]) -> bool:
+    filled = [c for c in row if c]
+    return bool(filled) and sum(1 for c in filled if _NUMERIC_CELL.match(c)) / len(filled) >= 0.5
+
+def normalize_table(raw_rows: List[List[Any]]) -> Dict[str, Any]:
+    """
+    pdfplumber の表（行×セル、結合セルは None）を正規化する。
+
+    - 結合セル: ヘッダー行は左のセル、本体行は上のセルの値で埋める
+    - ヘッダー検出: 先頭行をヘッダーとし、2 行目も数値主体でなく先頭行に横結合がある場合は
+      2 段ヘッダーとして「上段/下段」に連結する
+    - 空行・空列は除去
+
+    Returns:
+        {"header": List[str], "rows": List[List[str]]}
+    """
+    rows = [[_clean_cell(c) for c in row] for row in raw_rows if row]
+    rows = [row for row in rows if any(c for c in row)]
+    if not rows:
+        return {"header": [], "rows": []}
+
+    width = max(len(row) for row in rows)
+    rows = [row + [None] * (width - len(row)) for row in rows]
+
+    header_count = 1
+    if (len(rows) > 2 and any(c is None for c in rows[0][1:])
+            and not _is_numeric_row([c or "" for c in rows[1]])):
+        header_count = 2
+
+    # ヘッダー: 横方向の結合を左から埋めて、複数段を連結
+    header_rows = []
+    for row in rows[:header_count]:
+        filled, last = [], ""
+        for cell in row:
+            last = cell if cell is not None else last
+            filled.append(last)
+        header_rows.append(filled)
+    header = []
+    for col in range(width):
+        names = [hr[col] for hr in header_rows if hr[col]]
+        names = list(dict.fromkeys(names))
+        header.append("/".join(names) or f"列{col + 1}")
+
+    # 本体: 縦方向の結合を上から埋める
+    body: List[List[str]] = []
+    previous = [""] * width
+    for row in rows[header_count:]:
+        filled = [cell if cell is not None else previous[col] for col, cell in enumerate(row)]
+        body.append(filled)
+        previous = filled
+
+    # 全行で空の列を除去
+    keep = [col for col in range(width) if any(hr[col] for hr in header_rows) or any(r[col] for r in body)]
+    header = [header[col] for col in keep]
+    body = [[r[col] for col in keep] for r in body]
+    return {"header": header, "rows": body}
+
+def _render_table(header: List[str], rows: List[List[str]]) -> str:
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    lines.extend("| " + " | ".join(row) + " |" for row in rows)
+    return "\n".join(lines)
+
+def chunk_table_rows(
+    table: Dict[str, Any],
+    *,
+    max_tokens: int = 400,
+    caption: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    正規化済みの表を、各チャンクに列ヘッダーを繰り返した行グループ（Markdown 表）に分割する。
+
+    Returns:
+        [{"text", "row_start", "row_end", "tokens"}, ...]  # row_* は本体行の 0 始まりインデックス
+    """
+    header, rows = table.get("header", []), table.get("rows", [])
+    if not header or not rows:
+        return []
+
+    prefix = f"{caption}\n" if caption else ""
+    base_tokens = count_tokens(prefix + _render_table(header, []))
+    chunks: List[Dict[str, Any]] = []
+    group: List[List[str]] = []
+    group_start = 0
+    tokens = base_tokens
+
+    def flush():
+        if group:
+            chunks.append({
+                "text": prefix + _render_table(header, group),
+                "row_start": group_start,
+                "row_end": group_start + len(group) - 1,
+                "tokens": tokens,
+            })
+
+    for idx, row in enumerate(rows):
+        row_tokens = count_tokens("| " + " | ".join(row) + " |") + 1
+        if group and tokens + row_tokens > max_tokens:
+            flush()
+            group, group_start, tokens = [], idx, base_tokens
+        group.append(row)
+        tokens += row_tokens
+    flush()
+    return chunks
+
+def _tables_from_page(page, page_num: int) -> List[Dict[str, Any]]:
+    tables: List[Dict[str, Any]] = []
+    for tbl_idx, raw in enumerate(page.extract_tables(), start=1):
+        normalized = normalize_table(raw)
+        if not normalized["rows"]:
+            continue  # 空の表・ヘッダーのみの表をスキップ
+        tables.append({
+            "text": _render_table(normalized["header"], normalized["rows"]),
+            "header": normalized["header"],
+            "rows": normalized["rows"],
+            "page": page_num,
+            "table_id": tbl_idx,
+        })
+    return tables
+
 def extract_tables_from_pdf(data: bytes) -> List[Dict[str, Any]]:
-    """pdfplumber で表を抽出し、CSV ライクな文字列で返す。"""
+    """pdfplumber で表を抽出し、正規化した header / rows と Markdown 表の文字列で返す。"""
     tables: List[Dict[str, Any]] = []
     with pdfplumber.open(BytesIO(data)) as pdf:
         for page_num, page in enumerate(pdf.pages, start=1):
-            for tbl_idx, table in enumerate(page.extract_tables(), start=1):
-                # None を "" に置き換えてから結合
-                lines: list[str] = []
-                for row in table:
-                    cells = [(cell if cell is not None else "") for cell in row]
-                    lines.append(",".join(cells))
-                csv_text = "\n".join(lines)
-                
-                if csv_text.strip():  # 空の表をスキップ
-                    tables.append({
-                        "text": csv_text,
-                        "page": page_num,
-                        "table_id": tbl_idx,
-                    })
+            tables.extend(_tables_from_page(page, page_num))
     return tables
 
+def extract_pages_and_tables_from_pdf(data: bytes) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """1 回の pdfplumber オープンでページ別テキストと表の両方を抽出"""
+    pages_text: List[Dict[str, Any]] = []
+    tables: List[Dict[str, Any]] = []
+    with pdfplumber.open(BytesIO(data)) as pdf:
+        for page_num, page in enumerate(pdf.pages, start=1):
+            page_text = page.extract_text() or ""
+            if page_text.strip():  # 空ページをスキップ
+                pages_text.append({
+                    "text": page_text,
+                    "page": page_num
+                })
+            try:
+                tables.extend(_tables_from_page(page, page_num))
+            except Exception as e:
+                logger.warning("⚠️ 表抽出失敗 (p.%d): %s", page_num, e)
+    return pages_text, tables
+
 # ---------------------------------------------------------------------------
 # 4) 画像の抽出
 # ---------------------------------------------------------------------------
@@ -400,6 +718,7 @@ def preprocess_files(
         Dict[equipment_name, {
             "files": Dict[filename, file_text],  # ファイル別テキスト保持
             "sources": List[str],  # 使用したファイル名のリスト
+            "tables": Dict[filename, List[table]],  # PDF から抽出した正規化済みの表
             "equipment_category": str,
             "total_files": int,
             "total_pages": int,
@@ -421,6 +740,7 @@ def preprocess_files(
         if equipment_name not in equipment_data:
             equipment_data[equipment_name] = {
                 "files": {},  # ファイル名 → テキストの辞書
+                "tables": {},  # ファイル名 → 表のリスト
                 "sources": [],
                 "equipment_category": equipment_category,
                 "total_files": 0,
@@ -431,6 +751,7 @@ def preprocess_files(
         # ファイルごとのテキスト抽出
         file_text = ""
         file_pages = 0
+        file_tables: List[Dict[str, Any]] = []
         include_pages = should_include_page_numbers(name)
         
         # テキストファイルの処理
@@ -447,8 +768,8 @@ def preprocess_files(
         # PDFファイルの処理
         elif mime == "application/pdf" or name.lower().endswith(".pdf"):
             try:
-                # ページ別にテキストを抽出
-                pages_data = extract_text_from_pdf_by_pages(data)
+                # ページ別にテキストを抽出（表も同じパスで抽出）
+                pages_data, file_tables = extract_pages_and_tables_from_pdf(data)
                 
                 # 全ページのテキストを結合（ファイル単位）
                 page_texts = [f"=== ファイル: {name} ==="]  # ファイルヘッダー
@@ -470,7 +791,7 @@ def preprocess_files(
                         file_pages += 1
                 
                 file_text = "\n".join(page_texts)
-                print(f"  ✅ PDFファイル処理完了 - ページ数: {file_pages}, 文字数: {len(file_text)}")
+                print(f"  ✅ PDFファイル処理完了 - ページ数: {file_pages}, 表: {len(file_tables)}, 文字数: {len(file_text)}")
                 
             except Exception as e:
                 print(f"  ❌ PDFファイル処理エラー: {e}")
@@ -483,6 +804,8 @@ def preprocess_files(
         # 設備データに追加（ファイル別に保存）
         if file_text.strip():  # 空でない場合のみ追加
             equipment_data[equipment_name]["files"][name] = file_text
+            if file_tables:
+                equipment_data[equipment_name]["tables"][name] = file_tables
             equipment_data[equipment_name]["sources"].append(name)
             equipment_data[equipment_name]["total_files"] += 1
             equipment_data[equipment_name]["total_pages"] += file_pages
@@ -498,4 +821,8 @@ def preprocess_files(
         print(f"   ソース: {', '.join(data['sources'])}")
         print()
     
-    return equipment_data
\ No newline at end of file
+    return equipment_data
+
+if __name__ == "__main__":
+    _check_chunk_heading_separator()
+    print("✅ chunk_structured_text: 見出しと本文の区切りを確認")
@@ -0,0 +1,296 @@
+# src/rag_retriever.py
+"""
+暗黙知法令チャットモード用の検索（RAG）コンテキスト
+
+設備データ（preprocess_files の出力）をチャンク化して永続 Chroma コレクションに差分同期し、
+質問ごとに「選択中の設備・ファイル・管轄タグ」に絞った上位 k 件のチャンクだけを返す。
+検索はベクトル検索と文字 n-gram BM25 を RRF で統合したハイブリッド方式（既定）。
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from src.embedding_cache import get_cache_dir
+from src.rag_lexical import NgramBM25Index, reciprocal_rank_fusion
+from src.rag_preprocess import chunk_structured_text, chunk_table_rows, split_file_pages
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "RAG_COLLECTION_NAME",
+    "split_file_pages",
+    "build_chunk_docs",
+    "initialize_rag_index",
+    "get_rag_collection",
+    "get_lexical_index",
+    "get_rag_status",
+    "build_where_filter",
+    "retrieve_equipment_context",
+    "RETRIEVAL_METHODS",
+]
+
+RAG_COLLECTION_NAME = "equipment_docs"
+
+# ベクトルストアのバックエンド: "chroma"（既定） | "memmap"（numpy memmap・Chroma不要）
+RAG_VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "chroma")
+
+RETRIEVAL_METHODS = {
+    "hybrid": "ハイブリッド（ベクトル + BM25）",
+    "vector": "ベクトル検索のみ",
+    "lexical": "BM25（文字n-gram）のみ",
+}
+
+# ---------------------------------------------------------------------------
+# チャンク化
+# ---------------------------------------------------------------------------
+def build_chunk_docs(equipment_data: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """設備データを save_docs_to_chroma 用の docs に変換（本文は kind="text"、表は kind="table"）"""
+    docs: List[Dict[str, Any]] = []
+    for equipment_name, eq_data in equipment_data.items():
+        tags = {s["name"]: s["tag"] for s in eq_data.get("tagged_sources", [])}
+        for file_name, file_text in eq_data.get("files", {}).items():
+            for chunk_idx, chunk in enumerate(chunk_structured_text(file_text)):
+                docs.append({
+                    "content": chunk["text"],
+                    "metadata": {
+                        "source": file_name,
+                        "kind": "text",
+                        "page": chunk["page_start"],
+                        "page_start": chunk["page_start"],
+                        "page_end": chunk["page_end"],
+                        "heading": chunk["heading"],
+                        "tokens": chunk["tokens"],
+                        "chunk_id": chunk_idx,
+                        "equipment_name": equipment_name,
+                        "equipment_category": eq_data.get("equipment_category", "その他設備"),
+                        "jurisdiction_tag": tags.get(file_name, "📄一般設備資料"),
+                    },
+                })
+            # 表は行グループ単位（列ヘッダー付き）で別チャンクにする
+            for table in eq_data.get("tables", {}).get(file_name, []):
+                caption = f"【表{table['table_id']}】{file_name} p.{table['page']}"
+                for group_idx, group in enumerate(chunk_table_rows(table, caption=caption)):
+                    docs.append({
+                        "content": group["text"],
+                        "metadata": {
+                            "source": file_name,
+                            "kind": "table",
+                            "page": table["page"],
+                            "table_id": table["table_id"],
+                            "chunk_id": f"t{table['table_id']}_g{group_idx}",
+                            "row_start": group["row_start"],
+                            "row_end": group["row_end"],
+                            "tokens": group["tokens"],
+                            "equipment_name": equipment_name,
+                            "equipment_category": eq_data.get("equipment_category", "その他設備"),
+                            "jurisdiction_tag": tags.get(file_name, "📄一般設備資料"),
+                        },
+                    })
+    return docs
+
+# ---------------------------------------------------------------------------
+# インデックス（永続コレクション）の管理
+# ---------------------------------------------------------------------------
+_rag_collection = None
+_lexical_index: Optional[NgramBM25Index] = None
+_rag_fingerprint: Optional[str] = None
+_rag_status = "未初期化"
+_rag_lock = threading.Lock()
+
+def _docs_fingerprint(docs: List[Dict[str, Any]]) -> str:
+    digest = hashlib.sha256()
+    for doc in docs:
+        digest.update(doc["metadata"]["source"].encode("utf-8"))
+        digest.update(doc["content"].encode("utf-8"))
+    return digest.hexdigest()
+
+def _sync_index(docs: List[Dict[str, Any]], fingerprint: str, persist_directory: str) -> None:
+    global _rag_collection, _lexical_index, _rag_fingerprint, _rag_status
+    from src.rag_vector import save_docs_to_chroma, make_doc_id
+    from src.rag_memmap import save_docs_to_memmap
+
+    t0 = time.perf_counter()
+
+    # 語彙インデックスは API 不要なので先に構築（ベクトル側の同期中も検索に使える）
+    try:
+        lexical_index = NgramBM25Index().build(
+            (make_doc_id(doc["metadata"]), doc["content"], doc["metadata"]) for doc in docs
+        )
+        with _rag_lock:
+            _lexical_index = lexical_index
+    except Exception as e:
+        logger.error("❌ BM25インデックス構築失敗: %s", e, exc_info=True)
+
+    try:
+        save_docs = save_docs_to_memmap if RAG_VECTOR_BACKEND == "memmap" else save_docs_to_chroma
+        collection = save_docs(
+            docs=docs,
+            collection_name=RAG_COLLECTION_NAME,
+            persist_directory=persist_directory,
+        )
+        with _rag_lock:
+            _rag_collection = collection
+            _rag_fingerprint = fingerprint
+            _rag_status = "同期済み"
+        logger.info("✅ RAGインデックス同期完了 — chunks=%d elapsed=%.2fs", len(docs), time.perf_counter() - t0)
+    except Exception as e:
+        with _rag_lock:
+            _rag_status = f"同期失敗: {e}"
+        logger.error("❌ RAGインデックス同期失敗: %s", e, exc_info=True)
+
+def initialize_rag_index(equipment_data: Dict[str, Dict[str, Any]], background: bool = True) -> None:
+    """
+    起動時に永続コレクションを読み込み、設備データとの差分を同期する。
+    同じコーパスで既に同期済みの場合は何もしない。
+    """
+    global _rag_collection, _rag_status
+    from src.rag_vector import load_collection
+    from src.rag_memmap import load_memmap_store
+
+    docs = build_chunk_docs(equipment_data)
+    fingerprint = _docs_fingerprint(docs)
+    persist_directory = os.path.join(get_cache_dir(), RAG_VECTOR_BACKEND)
+    load = load_memmap_store if RAG_VECTOR_BACKEND == "memmap" else load_collection
+
+    with _rag_lock:
+        if _rag_fingerprint == fingerprint or _rag_status == "同期中":
+            return
+        if _rag_collection is None:
+            try:
+                _rag_collection = load(RAG_COLLECTION_NAME, persist_directory)
+            except Exception as e:
+                logger.warning("⚠️ 永続コレクション読み込み失敗: %s", e)
+        _rag_status = "同期中"
+
+    logger.info("🧭 RAGインデックス同期開始 — chunks=%d background=%s", len(docs), background)
+    if background:
+        threading.Thread(
+            target=_sync_index,
+            args=(docs, fingerprint, persist_directory),
+            daemon=True,
+            name="RagIndexSync",
+        ).start()
+    else:
+        _sync_index(docs, fingerprint, persist_directory)
+
+def get_rag_collection():
+    """検索に使うコレクション（未準備なら None）"""
+    with _rag_lock:
+        return _rag_collection
+
+def get_lexical_index() -> Optional[NgramBM25Index]:
+    """検索に使う BM25 インデックス（未準備なら None）"""
+    with _rag_lock:
+        return _lexical_index
+
+def get_rag_status() -> str:
+    with _rag_lock:
+        return _rag_status
+
+# ---------------------------------------------------------------------------
+# 検索
+# ---------------------------------------------------------------------------
+def build_where_filter(
+    equipment_name: Optional[str] = None,
+    files: Optional[List[str]] = None,
+    jurisdiction_tags: Optional[List[str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """設備・ファイル・管轄タグのメタデータフィルタ（Chroma の where 構文）"""
+    conditions: List[Dict[str, Any]] = []
+    if equipment_name:
+        conditions.append({"equipment_name": {"$eq": equipment_name}})
+    if files:
+        conditions.append({"source": {"$in": list(files)}})
+    if jurisdiction_tags:
+        conditions.append({"jurisdiction_tag": {"$in": list(jurisdiction_tags)}})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+def _format_hits(hits: List[Dict[str, Any]]) -> str:
+    parts = []
+    for hit in hits:
+        meta = hit.get("metadata") or {}
+        page_start = meta.get("page_start", meta.get("page", "?"))
+        page_end = meta.get("page_end", page_start)
+        pages = f"p.{page_start}" if page_start == page_end else f"p.{page_start}-{page_end}"
+        parts.append(f"=== ファイル: {meta.get('source', '不明')} ({pages}) ===\n{hit['content']}")
+    return "\n\n".join(parts)
+
+def retrieve_equipment_context(
+    question: str,
+    *,
+    equipment_name: str,
+    files: List[str],
+    jurisdiction_tags: Optional[List[str]] = None,
+    top_k: int = 8,
+    method: str = "hybrid",
+    rrf_k: int = 60,
+    extra_queries: Optional[List[str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    質問に関連する上位 top_k チャンクを取得して equipment_content 用テキストに整形する。
+
+    method:
+        "hybrid"  … ベクトル検索と BM25 を reciprocal rank fusion で統合
+        "vector"  … ベクトル検索のみ
+        "lexical" … BM25 のみ
+    片方のインデックスが未準備の場合は使える方だけで検索し、
+    どちらも使えない場合は None（呼び出し側で全文モードにフォールバック）。
+
+    extra_queries（言い換え・補助クエリ）を渡すと、質問と合わせて 1 回の埋め込みリクエストで
+    まとめて検索し、全クエリのランキングを RRF で統合する。
+    """
+    from src.rag_vector import query_collection_batch
+
+    collection = get_rag_collection() if method in ("hybrid", "vector") else None
+    lexical_index = get_lexical_index() if method in ("hybrid", "lexical") else None
+    if collection is None and lexical_index is None:
+        logger.warning("⚠️ RAGインデックス未準備 (%s) — 全文モードにフォールバック", get_rag_status())
+        return None
+
+    queries = list(dict.fromkeys([question, *(q for q in (extra_queries or []) if q and q.strip())]))
+    where = build_where_filter(equipment_name, files, jurisdiction_tags)
+    # 統合前の候補は多めに取る
+    candidate_k = top_k * 3 if collection is not None and lexical_index is not None else top_k
+    timings: Dict[str, float] = {}
+    rankings: List[List[str]] = []
+    hits_by_id: Dict[str, Dict[str, Any]] = {}
+
+    t0 = time.perf_counter()
+    if collection is not None:
+        for vector_hits in query_collection_batch(collection, queries, n_results=candidate_k, where=where):
+            rankings.append([hit["id"] for hit in vector_hits])
+            hits_by_id.update({hit["id"]: hit for hit in vector_hits})
+        timings["vector_ms"] = (time.perf_counter() - t0) * 1000
+
+    t1 = time.perf_counter()
+    if lexical_index is not None:
+        for query in queries:
+            lexical_hits = lexical_index.search(query, top_k=candidate_k, where=where)
+            rankings.append([hit["id"] for hit in lexical_hits])
+            for hit in lexical_hits:
+                hits_by_id.setdefault(hit["id"], hit)
+        timings["lexical_ms"] = (time.perf_counter() - t1) * 1000
+
+    fused = reciprocal_rank_fusion(rankings, k=rrf_k)[:top_k]
+    hits = [dict(hits_by_id[doc_id], rrf_score=score) for doc_id, score in fused]
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+
+    content = _format_hits(hits)
+    logger.info("🔎 RAG検索 — method=%s equipment=%s files=%d queries=%d hits=%d chars=%d elapsed=%.1fms %s",
+                method, equipment_name, len(files), len(queries), len(hits), len(content), elapsed_ms,
+                " ".join(f"{k}={v:.1f}" for k, v in timings.items()))
+    return {
+        "content": content,
+        "hits": hits,
+        "elapsed_ms": elapsed_ms,
+        "timings": timings,
+    }
@@ -1,31 +1,51 @@
 # src/rag_vector.py
 from __future__ import annotations
 from io import BytesIO
-from typing import List, Dict, Any
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Dict, Any, Sequence
+import os
+import threading
+import time
 import uuid
 
-# SQLite バージョン強制上書き（pysqlite3でchromadbが使えるようにする）
 import sys
-import pysqlite3
-sys.modules["sqlite3"] = pysqlite3
 
-import chromadb
-from chromadb.config import Settings
 from openai import OpenAI
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
+from src.embedding_cache import get_embedding_cache, content_hash
+
+if TYPE_CHECKING:  # 実行時は _import_chromadb で遅延 import
+    import chromadb
+
 # from transformers import CLIPProcessor, CLIPModel
 # from PIL import Image
 # import torch
 from uuid import uuid4
 
-__all__ = ["save_docs_to_chroma", "query_collection"]
+__all__ = [
+    "save_docs_to_chroma",
+    "sync_docs_to_collection",
+    "load_collection",
+    "query_collection",
+    "query_collection_batch",
+    "embed_texts",
+    "embed_queries",
+    "get_query_embedding_cache_stats",
+]
 
 # ---------------------------------------------------------------------------
 # モデル＆クライアント初期化
 # ---------------------------------------------------------------------------
 _OPENAI_MODEL = "text-embedding-ada-002"
-_openai_client = OpenAI()
+_openai_client: OpenAI | None = None
+
+def _get_openai_client() -> OpenAI:
+    """OpenAI クライアントを遅延生成（APIキー未設定でも import は失敗させない）"""
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = OpenAI()
+    return _openai_client
 
 # _clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
 # _clip_proc  = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
@@ -35,9 +55,95 @@ _openai_client = OpenAI()
 # ---------------------------------------------------------------------------
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
 def _embed_text_batch(texts: List[str]) -> List[List[float]]:
-    resp = _openai_client.embeddings.create(model=_OPENAI_MODEL, input=texts)
+    resp = _get_openai_client().embeddings.create(model=_OPENAI_MODEL, input=texts)
     return [item.embedding for item in resp.data]
 
+def embed_texts(texts: List[str], *, batch_size: int = 100) -> List[List[float]]:
+    """永続キャッシュ経由でテキストを埋め込む（キャッシュミス分のみ API 呼び出し）"""
+    return get_embedding_cache().embed(
+        texts,
+        model=_OPENAI_MODEL,
+        embed_fn=_embed_text_batch,
+        batch_size=batch_size,
+    )
+
+# ---------------------------------------------------------------------------
+# クエリ埋め込み（プロセス内 LRU / TTL キャッシュ）
+# ---------------------------------------------------------------------------
+class _QueryEmbeddingLRU:
+    """同じ質問・言い換えの再検索で API を引かないためのメモリキャッシュ"""
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._items: "OrderedDict[str, tuple[float, List[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0}
+
+    def get(self, key: str) -> List[float] | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.stats["misses"] += 1
+                return None
+            stored_at, vector = item
+            if self.ttl_seconds and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._items[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            return vector
+
+    def put(self, key: str, vector: List[float]) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic(), vector)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self.stats, entries=len(self._items))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] / lookups) if lookups else 0.0
+        return stats
+
+_query_embedding_cache = _QueryEmbeddingLRU(
+    maxsize=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "512")),
+    ttl_seconds=float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "3600")),
+)
+
+def embed_queries(queries: Sequence[str]) -> List[List[float]]:
+    """
+    検索クエリを埋め込む。メモリ LRU → API の順に引き、ミスしたクエリはまとめて 1 リクエストで埋め込む。
+    利用者の質問は種類が際限なく増えるため、チャンク用の永続キャッシュには書き込まない。
+    """
+    keys = [content_hash(q) for q in queries]
+    vectors: Dict[str, List[float]] = {}
+    missing: Dict[str, str] = {}
+    for query, key in zip(queries, keys):
+        if key in vectors or key in missing:
+            continue
+        cached = _query_embedding_cache.get(key)
+        if cached is not None:
+            vectors[key] = cached
+        else:
+            missing[key] = query
+
+    if missing:
+        new_vectors = _embed_text_batch(list(missing.values()))
+        for key, vector in zip(missing, new_vectors):
+            _query_embedding_cache.put(key, vector)
+            vectors[key] = vector
+
+    return [vectors[key] for key in keys]
+
+def get_query_embedding_cache_stats() -> Dict[str, float]:
+    """クエリ埋め込みメモリキャッシュの統計（hits / misses / expired / entries / hit_rate）"""
+    return _query_embedding_cache.get_stats()
+
 # # ---------------------------------------------------------------------------
 # # 画像埋め込み（CLIP）
 # # ---------------------------------------------------------------------------
@@ -50,168 +156,306 @@ def _embed_text_batch(texts: List[str]) -> List[List[float]]:
 #     return feats[0].cpu().tolist()
 
 # ---------------------------------------------------------------------------
-# ドキュメントを ChromaDB に保存
+# ChromaDB クライアント（永続化対応）
 # ---------------------------------------------------------------------------
-# src/rag_vector.py の save_docs_to_chroma関数を以下に置き換え
+_chroma_clients: Dict[str, Any] = {}
 
-def save_docs_to_chroma(
-        *,
-        docs: List[Dict[str, Any]],
-        collection_name: str,
-        persist_directory: str | None = None,
-        batch_size: int = 50,
-    ) -> chromadb.api.Collection:
-        """
-        1) ChromaDB のコレクションを作成・取得
-        2) preprocess_files 出力 docs をバッチ登録 (重複除去付き)
-        3) 必要なら永続化し、Collection オブジェクトを返す
-        """
-        # — クライアント作成 —
+def _import_chromadb():
+    """chromadb を遅延 import（memmap バックエンドだけ使う場合は読み込まない）"""
+    if "chromadb" not in sys.modules:
+        # SQLite バージョン強制上書き（pysqlite3でchromadbが使えるようにする）
+        import pysqlite3
+        sys.modules["sqlite3"] = pysqlite3
+    import chromadb
+    return chromadb
+
+def _get_chroma_client(persist_directory: str | None = None):
+    """persist_directory 指定時は PersistentClient（再起動後も残る）、未指定時はインメモリ"""
+    chromadb = _import_chromadb()
+    key = persist_directory or ":memory:"
+    if key not in _chroma_clients:
         if persist_directory:
-            client = chromadb.Client(Settings(persist_directory=persist_directory))
+            _chroma_clients[key] = chromadb.PersistentClient(path=persist_directory)
         else:
-            client = chromadb.Client()  # インメモリ
+            _chroma_clients[key] = chromadb.Client()  # インメモリ
+    return _chroma_clients[key]
 
-        # — 既存コレクションを安全に削除 —
-        try:
-            client.delete_collection(name=collection_name)
-            print(f"🗑️ 既存コレクション削除: {collection_name}")
-        except Exception:  # NotFoundError や ValueError など全てキャッチ
-            print(f"📝 新規コレクション作成: {collection_name}")
+def load_collection(
+    collection_name: str,
+    persist_directory: str,
+) -> chromadb.api.Collection | None:
+    """永続化済みコレクションを読み込む（存在しない・空の場合は None）"""
+    client = _get_chroma_client(persist_directory)
+    try:
+        collection = client.get_collection(name=collection_name)
+    except Exception:  # NotFoundError や ValueError など全てキャッチ
+        print(f"📝 永続コレクションなし: {collection_name}")
+        return None
 
-        collection = client.create_collection(name=collection_name)
+    count = collection.count()
+    print(f"📂 永続コレクション読み込み: {collection_name} ({count} ドキュメント)")
+    return collection if count else None
 
-        # — docs をバッチ登録 —
+# ---------------------------------------------------------------------------
+# ドキュメント ID / メタデータ
+# ---------------------------------------------------------------------------
+def make_doc_id(metadata: Dict[str, Any]) -> str:
+    """source / kind / page / chunk_id から安定したドキュメント ID を生成"""
+    source = metadata.get('source', 'unknown')
+    kind = metadata.get('kind', 'unknown')
+    chunk_id = metadata.get('chunk_id', metadata.get('table_id', 0))
+    page = metadata.get('page', 'unknown')
+    
+    # より詳細なID生成（安全な文字のみ）
+    return f"{source}_{kind}_p{page}_c{chunk_id}".replace(" ", "_").replace(".", "_").replace("-", "_")
+
+def _sanitize_metadata(metadata: Dict[str, Any]) -> Dict[str, Any]:
+    """Chroma が受け付けるスカラー値だけに整形（None は除外、その他は文字列化）"""
+    clean: Dict[str, Any] = {}
+    for key, value in metadata.items():
+        if value is None:
+            continue
+        if isinstance(value, (str, int, float, bool)):
+            clean[key] = value
+        else:
+            clean[key] = str(value)
+    return clean
+
+# ---------------------------------------------------------------------------
+# 差分同期（upsert / delete）
+# ---------------------------------------------------------------------------
+def sync_docs_to_collection(
+        collection,
+        docs: List[Dict[str, Any]],
+        *,
+        batch_size: int = 50,
+        prune: bool = True,
+    ) -> Dict[str, int]:
+        """
+        チャンク ID と content_hash で既存コレクションと差分を取り、
+        新規・変更分のみ埋め込み＆upsert、消えたチャンクは delete する。
+
+        prune=True の場合、docs に含まれない既存 ID を削除する（docs がコーパス全体の場合）。
+        prune=False の場合は追加・更新のみ行う（1ファイル追加時など）。
+        """
         docs_to_index = [d for d in docs if d["metadata"].get("kind") in ("text", "table")]
         print(f"🔍 処理対象ドキュメント: {len(docs_to_index)}")
         
-        if not docs_to_index:
-            print("⚠️ 処理対象ドキュメントがありません")
-            return collection
-        
         # 🔥 全体でユニークIDを管理
         global_seen_ids = set()
         processed_docs = []
         
         for doc in docs_to_index:
-            metadata = doc["metadata"]
-            source = metadata.get('source', 'unknown')
-            kind = metadata.get('kind', 'unknown')
-            chunk_id = metadata.get('chunk_id', metadata.get('table_id', 0))
-            page = metadata.get('page', 'unknown')
-            
-            # より詳細なID生成（安全な文字のみ）
-            doc_id = f"{source}_{kind}_p{page}_c{chunk_id}".replace(" ", "_").replace(".", "_").replace("-", "_")
+            doc_id = make_doc_id(doc["metadata"])
             
             # バッチを跨いだ重複チェック
             if doc_id not in global_seen_ids:
                 global_seen_ids.add(doc_id)
-                processed_docs.append((doc, doc_id))
+                metadata = _sanitize_metadata(doc["metadata"])
+                metadata["content_hash"] = content_hash(doc["content"])
+                processed_docs.append((doc, doc_id, metadata))
             else:
                 print(f"⚠️ 重複スキップ: {doc_id}")
         
         print(f"✅ 重複除去後: {len(processed_docs)} ドキュメント")
         
-        if not processed_docs:
-            print("⚠️ 重複除去後にドキュメントがありません")
-            return collection
+        # — 既存の ID / ハッシュを取得して差分を計算 —
+        existing = collection.get(include=["metadatas"])
+        existing_hashes = {
+            doc_id: (meta or {}).get("content_hash")
+            for doc_id, meta in zip(existing["ids"], existing["metadatas"])
+        }
         
-        # バッチ処理
-        total_added = 0
-        for start in range(0, len(processed_docs), batch_size):
-            batch = processed_docs[start:start+batch_size]
-            
-            embeddings, documents, metadatas, ids = [], [], [], []
-            batch_seen_ids = set()  # バッチ内重複チェック
+        changed = [
+            (doc, doc_id, metadata)
+            for doc, doc_id, metadata in processed_docs
+            if existing_hashes.get(doc_id) != metadata["content_hash"]
+        ]
+        stale_ids = [doc_id for doc_id in existing_hashes if doc_id not in global_seen_ids] if prune else []
+        unchanged = len(processed_docs) - len(changed)
+        
+        print(f"🧾 差分: 追加/更新 {len(changed)}, 削除 {len(stale_ids)}, 変更なし {unchanged}")
+        
+        # — 削除 —
+        deleted = 0
+        for start in range(0, len(stale_ids), batch_size):
+            batch_ids = stale_ids[start:start+batch_size]
+            try:
+                collection.delete(ids=batch_ids)
+                deleted += len(batch_ids)
+            except Exception as e:
+                print(f"❌ 削除エラー: {e}")
+        
+        # — upsert（バッチ処理） —
+        total_upserted = 0
+        for start in range(0, len(changed), batch_size):
+            batch = changed[start:start+batch_size]
             
-            for doc, doc_id in batch:
-                # バッチ内でも重複チェック（念のため）
-                if doc_id not in batch_seen_ids:
+            # 埋め込みはキャッシュ経由でバッチ生成（失敗時は1件ずつ再試行）
+            try:
+                batch_embeddings = embed_texts([doc["content"] for doc, _, _ in batch])
+            except Exception as e:
+                print(f"❌ バッチ埋め込み生成エラー: {e}")
+                batch_embeddings = []
+                for doc, doc_id, _ in batch:
                     try:
-                        emb = _embed_text_batch([doc["content"]])[0]
-                        embeddings.append(emb)
-                        documents.append(doc["content"])
-                        metadatas.append(doc["metadata"])
-                        ids.append(doc_id)
-                        batch_seen_ids.add(doc_id)
-                        
-                    except Exception as e:
-                        print(f"❌ 埋め込み生成エラー (ID: {doc_id}): {e}")
-                else:
-                    print(f"⚠️ バッチ内重複スキップ: {doc_id}")
+                        batch_embeddings.append(embed_texts([doc["content"]])[0])
+                    except Exception as e2:
+                        print(f"❌ 埋め込み生成エラー (ID: {doc_id}): {e2}")
+                        batch_embeddings.append(None)
             
-            # バッチをコレクションに追加
-            if embeddings:
-                try:
-                    collection.add(
-                        embeddings=embeddings,
-                        documents=documents,
-                        metadatas=metadatas,
-                        ids=ids
-                    )
-                    total_added += len(embeddings)
-                    print(f"✅ バッチ {start//batch_size + 1}/{(len(processed_docs)-1)//batch_size + 1} 完了: {len(embeddings)} ドキュメント")
-                    
-                except Exception as e:
-                    print(f"❌ バッチ追加エラー: {e}")
-                    print("🔄 個別追加を試行...")
-                    
-                    # 個別追加を試行
-                    for i, (emb, doc_content, meta, doc_id) in enumerate(zip(embeddings, documents, metadatas, ids)):
-                        try:
-                            collection.add(
-                                embeddings=[emb],
-                                documents=[doc_content],
-                                metadatas=[meta],
-                                ids=[doc_id]
-                            )
-                            total_added += 1
-                            print(f"  ✅ 個別追加成功: {doc_id}")
-                        except Exception as e2:
-                            print(f"  ❌ 個別追加失敗 (ID: {doc_id}): {e2}")
+            embeddings, documents, metadatas, ids = [], [], [], []
+            for (doc, doc_id, metadata), emb in zip(batch, batch_embeddings):
+                if emb is None:
+                    continue
+                embeddings.append(emb)
+                documents.append(doc["content"])
+                metadatas.append(metadata)
+                ids.append(doc_id)
+            
+            if not embeddings:
+                continue
             
-        # 永続化
-        if persist_directory:
             try:
-                client.persist()
-                print("💾 永続化完了")
+                collection.upsert(
+                    embeddings=embeddings,
+                    documents=documents,
+                    metadatas=metadatas,
+                    ids=ids
+                )
+                total_upserted += len(embeddings)
+                print(f"✅ バッチ {start//batch_size + 1}/{(len(changed)-1)//batch_size + 1} 完了: {len(embeddings)} ドキュメント")
+                
             except Exception as e:
-                print(f"⚠️ 永続化エラー: {e}")
+                print(f"❌ バッチupsertエラー: {e}")
+                print("🔄 個別upsertを試行...")
+                
+                # 個別upsertを試行
+                for emb, doc_content, meta, doc_id in zip(embeddings, documents, metadatas, ids):
+                    try:
+                        collection.upsert(
+                            embeddings=[emb],
+                            documents=[doc_content],
+                            metadatas=[meta],
+                            ids=[doc_id]
+                        )
+                        total_upserted += 1
+                        print(f"  ✅ 個別upsert成功: {doc_id}")
+                    except Exception as e2:
+                        print(f"  ❌ 個別upsert失敗 (ID: {doc_id}): {e2}")
+        
+        return {
+            "upserted": total_upserted,
+            "deleted": deleted,
+            "unchanged": unchanged,
+        }
+
+# ---------------------------------------------------------------------------
+# ドキュメントを ChromaDB に保存
+# ---------------------------------------------------------------------------
+def save_docs_to_chroma(
+        *,
+        docs: List[Dict[str, Any]],
+        collection_name: str,
+        persist_directory: str | None = None,
+        batch_size: int = 50,
+        prune: bool = True,
+        rebuild: bool = False,
+    ) -> chromadb.api.Collection:
+        """
+        1) ChromaDB のコレクションを取得（なければ作成）
+        2) preprocess_files 出力 docs と既存コレクションの差分のみ upsert / delete
+        3) Collection オブジェクトを返す（persist_directory 指定時は自動で永続化される）
+
+        rebuild=True の場合のみ既存コレクションを削除して作り直す。
+        """
+        client = _get_chroma_client(persist_directory)
+
+        if rebuild:
+            try:
+                client.delete_collection(name=collection_name)
+                print(f"🗑️ 既存コレクション削除: {collection_name}")
+            except Exception:  # NotFoundError や ValueError など全てキャッチ
+                pass
+
+        collection = client.get_or_create_collection(name=collection_name)
+        print(f"📝 コレクション: {collection_name} (既存 {collection.count()} ドキュメント)")
+
+        result = sync_docs_to_collection(collection, docs, batch_size=batch_size, prune=prune)
         
         final_count = collection.count()
-        print(f"🎯 最終統計: 追加{total_added}, DB内{final_count} ドキュメント")
+        cache_stats = get_embedding_cache().get_stats()
+        print(f"🎯 最終統計: upsert{result['upserted']}, 削除{result['deleted']}, "
+              f"変更なし{result['unchanged']}, DB内{final_count} ドキュメント")
+        print(f"🧮 埋め込みキャッシュ: ヒット率 {cache_stats['hit_rate']:.1%} "
+              f"(hit={cache_stats['hits']}, miss={cache_stats['misses']}, API呼び出し={cache_stats['api_calls']})")
         
         return collection
 
 # ---------------------------------------------------------------------------
 # コレクション検索ヘルパー
 # ---------------------------------------------------------------------------
+def _format_query_result(res: Dict[str, Any], index: int) -> List[Dict[str, Any]]:
+    hits: List[Dict[str, Any]] = []
+    for doc_id, doc, meta, dist in zip(
+        res["ids"][index], res["documents"][index], res["metadatas"][index], res["distances"][index]
+    ):
+        hits.append({
+            "id": doc_id,
+            "content": doc,
+            "metadata": meta,
+            "distance": dist,
+        })
+    return hits
+
+def query_collection_batch(
+    collection,
+    queries: Sequence[str],
+    n_results: int = 5,
+    where: Dict[str, Any] | Sequence[Dict[str, Any] | None] | None = None,
+) -> List[List[Dict[str, Any]]]:
+    """
+    複数クエリをまとめて検索し、クエリごとのヒット一覧を入力と同じ順で返す。
+
+    埋め込みは embed_queries で 1 リクエストにまとめる。where は全クエリ共通の dict か、
+    クエリごとのリスト（設備スコープ違いなど）。同じ where のクエリは 1 回の query にまとめる。
+    """
+    if not queries:
+        return []
+    embeddings = embed_queries(queries)
+
+    wheres = list(where) if isinstance(where, (list, tuple)) else [where] * len(queries)
+    if len(wheres) != len(queries):
+        raise ValueError(f"where の数がクエリ数と一致しません: {len(wheres)} != {len(queries)}")
+
+    # where ごとにクエリをグループ化
+    groups: Dict[str, tuple[Dict[str, Any] | None, List[int]]] = {}
+    for i, w in enumerate(wheres):
+        key = repr(sorted(w.items())) if w else ""
+        groups.setdefault(key, (w, []))[1].append(i)
+
+    results: List[List[Dict[str, Any]]] = [[] for _ in queries]
+    for w, indices in groups.values():
+        query_kwargs: Dict[str, Any] = {
+            "query_embeddings": [embeddings[i] for i in indices],
+            "n_results": n_results,
+        }
+        if w:
+            query_kwargs["where"] = w
+        res = collection.query(**query_kwargs)
+        for pos, i in enumerate(indices):
+            results[i] = _format_query_result(res, pos)
+    return results
+
 def query_collection(
     collection: chromadb.api.Collection,
     query: str,
     n_results: int = 5,
+    where: Dict[str, Any] | None = None,
 ) -> List[Dict[str, Any]]:
 
     """
     テキストクエリを埋め込み検索し、上位 n_results 件を dict のリストで返す。
+    where を指定するとメタデータで事前に絞り込む（Chroma の where 構文）。
     """
-    # 1) クエリを埋め込み
-    q_emb = _embed_text_batch([query])[0]
-    # 2) 検索実行
-    res = collection.query(
-        query_embeddings=[q_emb],
-        n_results=n_results,
-    )
-    # 3) 結果を抽出
-    documents = res["documents"][0]
-    metadatas = res["metadatas"][0]
-    distances = res["distances"][0]
-    # 4) dict リストに整形
-    hits: List[Dict[str, Any]] = []
-    for doc, meta, dist in zip(documents, metadatas, distances):
-        hits.append({
-            "content": doc,
-            "metadata": meta,
-            "distance": dist,
-        })
-    return hits
\ No newline at end of file
+    return query_collection_batch(collection, [query], n_results=n_results, where=where)[0]
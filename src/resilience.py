@@ -0,0 +1,276 @@
+# src/resilience.py
+"""
+チャットモデル呼び出しのリトライ・バックオフ・サーキットブレーカー
+
+Bedrock の ThrottlingException などの一時的なエラーで 1 ターンを失わないよう、
+
+- 例外を「再試行すべきもの（スロットリング・5xx・タイムアウト・接続断）」とそれ以外（認証・入力不正など）に分類
+- 再試行はジッター付き指数バックオフ（tenacity）で、回数と合計時間（deadline）の両方で打ち切る
+- プロバイダごとのサーキットブレーカー: 再試行対象のエラーが連続したら一定時間 open にして即座に失敗させ、
+  その後 half-open で 1 件だけ試して回復を確認する
+
+ストリーミングは中身のある最初のチャンクが届くまでを再試行の対象とする（途中まで表示した回答はやり直せないため）。
+"""
+from __future__ import annotations
+
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, TypeVar
+
+from tenacity import (
+    RetryCallState,
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_random_exponential,
+)
+
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "CircuitOpenError",
+    "is_retryable",
+    "CircuitBreaker",
+    "get_circuit_breaker",
+    "call_with_retry",
+    "resilient_stream",
+    "has_content",
+    "get_resilience_stats",
+]
+
+T = TypeVar("T")
+
+_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "4"))
+_RETRY_DEADLINE_S = float(os.getenv("LLM_RETRY_DEADLINE_S", "30"))
+_BACKOFF_BASE_S = float(os.getenv("LLM_RETRY_BACKOFF_S", "0.5"))
+_BACKOFF_MAX_S = float(os.getenv("LLM_RETRY_BACKOFF_MAX_S", "8"))
+_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))
+
+class CircuitOpenError(RuntimeError):
+    """プロバイダのサーキットブレーカーが open のため呼び出さなかった"""
+
+    def __init__(self, provider: str, retry_in_s: float):
+        super().__init__(f"{provider} は障害が続いているため一時的に停止中です（約{retry_in_s:.0f}秒後に再試行）")
+        self.provider = provider
+        self.retry_in_s = retry_in_s
+
+# ---------------------------------------------------------------------------
+# エラー分類
+# ---------------------------------------------------------------------------
+# botocore の ClientError のエラーコード（langchain_aws は ValueError に包んで文言に残す）
+_RETRYABLE_AWS_CODES = (
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+    "InternalServerException", "ModelNotReadyException", "ModelTimeoutException",
+)
+_RETRYABLE_CLASS_NAMES = {
+    # openai
+    "RateLimitError", "APIConnectionError", "APITimeoutError", "InternalServerError",
+    # httpx / botocore の通信エラー
+    "TimeoutException", "ConnectError", "ReadTimeout", "ConnectTimeout", "RemoteProtocolError",
+    "EndpointConnectionError", "ReadTimeoutError", "ConnectTimeoutError", "ConnectionClosedError",
+}
+_RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+_AWS_CODE_PATTERN = re.compile("|".join(_RETRYABLE_AWS_CODES))
+
+def _iter_causes(exc: BaseException) -> Iterator[BaseException]:
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        yield exc
+        exc = exc.__cause__ or exc.__context__
+
+def is_retryable(exc: BaseException) -> bool:
+    """スロットリング・サーバーエラー・タイムアウト・接続断なら True（認証・入力不正などは False）"""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    for err in _iter_causes(exc):
+        if type(err).__name__ in _RETRYABLE_CLASS_NAMES:
+            return True
+        status = getattr(err, "status_code", None) or getattr(getattr(err, "response", None), "status_code", None)
+        if isinstance(status, int) and status in _RETRYABLE_STATUS:
+            return True
+        response = getattr(err, "response", None)
+        if isinstance(response, dict) and response.get("Error", {}).get("Code") in _RETRYABLE_AWS_CODES:
+            return True
+        if _AWS_CODE_PATTERN.search(str(err)):
+            return True
+    return False
+
+# ---------------------------------------------------------------------------
+# サーキットブレーカー
+# ---------------------------------------------------------------------------
+class CircuitBreaker:
+    """closed → （再試行対象のエラーが threshold 回連続）→ open → （cooldown 経過）→ half_open → 成功で closed"""
+
+    def __init__(self, name: str, *, threshold: int = _BREAKER_THRESHOLD, cooldown_s: float = _BREAKER_COOLDOWN_S):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "failures": 0, "short_circuited": 0, "opened": 0}
+
+    def before_call(self) -> None:
+        """呼び出し前に確認し、open 中（half_open の試行中を含む）なら CircuitOpenError"""
+        with self._lock:
+            self.stats["calls"] += 1
+            if self.state == "open":
+                elapsed = time.monotonic() - self.opened_at
+                if elapsed < self.cooldown_s:
+                    self.stats["short_circuited"] += 1
+                    raise CircuitOpenError(self.name, self.cooldown_s - elapsed)
+                self.state = "half_open"
+                logger.info("🔌 circuit_breaker — %s half_open（回復確認のため 1 件だけ送信）", self.name)
+            if self.state == "half_open":
+                if self._probe_in_flight:
+                    self.stats["short_circuited"] += 1
+                    raise CircuitOpenError(self.name, 1.0)
+                self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                logger.info("✅ circuit_breaker — %s closed（回復）", self.name)
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self, exc: BaseException) -> None:
+        """再試行対象のエラーのみ数える（入力不正などはプロバイダの障害ではない）"""
+        with self._lock:
+            self._probe_in_flight = False
+            if not is_retryable(exc):
+                if self.state == "half_open":
+                    self.state = "closed"
+                return
+            self.stats["failures"] += 1
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.threshold:
+                if self.state != "open":
+                    self.stats["opened"] += 1
+                    logger.warning("🔌 circuit_breaker — %s open（連続 %d 回失敗: %s）",
+                                   self.name, self.consecutive_failures, exc)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def get_state(self) -> Dict[str, Any]:
+        with self._lock:
+            state = dict(self.stats, state=self.state, consecutive_failures=self.consecutive_failures)
+            if self.state == "open":
+                state["retry_in_s"] = round(max(self.cooldown_s - (time.monotonic() - self.opened_at), 0.0), 1)
+            return state
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+_retry_stats = {"attempts": 0, "retries": 0, "recovered": 0, "gave_up": 0}
+_retry_stats_lock = threading.Lock()
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    """プロバイダごとのサーキットブレーカー（プロセス共通）"""
+    with _breakers_lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(provider)
+        return breaker
+
+def _count(key: str) -> None:
+    with _retry_stats_lock:
+        _retry_stats[key] += 1
+
+# ---------------------------------------------------------------------------
+# リトライ
+# ---------------------------------------------------------------------------
+def _retrying(provider: str, max_attempts: int, deadline_s: float) -> Retrying:
+    def _before_sleep(state: RetryCallState) -> None:
+        _count("retries")
+        logger.warning("🔁 retry — provider=%s attempt=%d wait=%.1fs error=%s", provider, state.attempt_number,
+                       state.next_action.sleep if state.next_action else 0.0, state.outcome.exception())
+
+    return Retrying(
+        retry=retry_if_exception(is_retryable),
+        wait=wait_random_exponential(multiplier=_BACKOFF_BASE_S, max=_BACKOFF_MAX_S),
+        stop=stop_after_attempt(max_attempts) | stop_after_delay(deadline_s),
+        before_sleep=_before_sleep,
+        reraise=True,
+    )
+
+def _attempt(provider: str, fn: Callable[[], T]) -> T:
+    breaker = get_circuit_breaker(provider)
+    breaker.before_call()
+    _count("attempts")
+    try:
+        result = fn()
+    except BaseException as e:
+        breaker.record_failure(e)
+        raise
+    breaker.record_success()
+    return result
+
+def call_with_retry(provider: str, fn: Callable[[], T], *, max_attempts: int = _MAX_ATTEMPTS,
+                    deadline_s: float = _RETRY_DEADLINE_S) -> T:
+    """fn() を再試行・サーキットブレーカー付きで呼ぶ"""
+    retrying = _retrying(provider, max_attempts, deadline_s)
+    try:
+        result = retrying(_attempt, provider, fn)
+    except BaseException:
+        _count("gave_up")
+        raise
+    if retrying.statistics.get("attempt_number", 1) > 1:
+        _count("recovered")
+    return result
+
+def has_content(chunk: Any) -> bool:
+    """
+    ストリームのチャンクに中身があるか。StrOutputParser はメタデータだけの差分を空文字列で流すため、
+    最初のトークンの判定（ヘッジの採用・再試行の打ち切り）ではこれを数えない。
+    """
+    return bool(getattr(chunk, "content", chunk))
+
+def resilient_stream(provider: str, factory: Callable[[], Iterable[T]], *, max_attempts: int = _MAX_ATTEMPTS,
+                     deadline_s: float = _RETRY_DEADLINE_S) -> Iterator[T]:
+    """
+    factory() のストリームを開いて中身のある最初のチャンクを受け取るまでを再試行し、以降はそのまま流す。
+    途中で切れた場合は再試行せず例外を送出する（ブレーカーには失敗として記録）。
+    """
+    def _open():
+        iterator = iter(factory())
+        head: list = []  # 最初の中身のあるチャンクまで（手前の空チャンクを含む）
+        try:
+            for chunk in iterator:
+                head.append(chunk)
+                if has_content(chunk):
+                    break
+            return iterator, head
+        except BaseException:
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+            raise
+
+    iterator, head = call_with_retry(provider, _open, max_attempts=max_attempts, deadline_s=deadline_s)
+    try:
+        yield from head
+        yield from iterator
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        get_circuit_breaker(provider).record_failure(e)
+        raise
+    finally:
+        close = getattr(iterator, "close", None)
+        if close:
+            close()
+
+def get_resilience_stats() -> Dict[str, Any]:
+    with _breakers_lock:
+        breakers = {name: breaker.get_state() for name, breaker in _breakers.items()}
+    with _retry_stats_lock:
+        return {"retry": dict(_retry_stats), "breakers": breakers}
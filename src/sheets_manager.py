@@ -212,7 +212,8 @@ def log_to_sheets(
     model: str = None,
     temperature: float = None,
     max_tokens: int = None,
-    use_rag: bool = None
+    use_rag: bool = None,
+    usage: Dict[str, Any] = None
 ) -> bool:
     """Streamlitアプリから呼び出すログ関数（非同期対応版）"""
     
@@ -249,6 +250,9 @@ def log_to_sheets(
         "use_rag": final_use_rag,
         "timestamp": datetime.now().isoformat()
     }
+    # ターンのトークン使用量・コスト（usage_ledger.record の戻り値）
+    if usage:
+        metadata["usage"] = usage
     
     # 保存実行
     success = manager.log_conversation(
@@ -0,0 +1,180 @@
+# src/single_flight.py
+"""
+同一リクエストの同時実行をまとめる（single-flight）
+
+研修などで複数の利用者が同じ設備・同じ質問を数秒差で送ると、それぞれが Bedrock を呼び
+スロットリングの枠を消費する。入力全体のフィンガープリントが一致するリクエストが実行中なら、
+新しく呼び出さずにその結果を共有する。
+
+- SingleFlight: 同期呼び出し用。後から来た呼び出しは先行の完了を待って同じ結果（例外）を受け取る
+- StreamingSingleFlight: ストリーミング用。先行リクエストのチャンクをバッファし、
+  後から参加した購読者にもそれまでのチャンクを再生したうえで以降のチャンクを配信する
+"""
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "SingleFlight",
+    "StreamingSingleFlight",
+    "FlightStream",
+]
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+class SingleFlight:
+    """key ごとに実行中の呼び出しを 1 つに限定する"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.stats["leaders"] += 1
+            else:
+                call.waiters += 1
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            logger.info("🔗 single_flight — 実行中の同一リクエストに合流 key=%s", key[:12])
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._calls))
+
+class _StreamFlight:
+    """1 本の元ストリームを読み、チャンクを全購読者向けにバッファする"""
+
+    def __init__(self, source: Any):
+        self.source = source
+        self.chunks: List[Any] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+    def run(self, on_finish: Callable[[], None]) -> None:
+        try:
+            for chunk in self.source:
+                with self.cond:
+                    self.chunks.append(chunk)
+                    self.cond.notify_all()
+        except BaseException as e:
+            self.error = e
+        finally:
+            on_finish()
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+
+class FlightStream:
+    """
+    購読者ごとのイテレータ。バッファ済みのチャンクから順に返し、元ストリームの完了まで待つ。
+    result は元ストリームの result（後から参加した購読者には coalesced=True を付ける）。
+    """
+
+    def __init__(self, flight: _StreamFlight, *, leader: bool):
+        self._flight = flight
+        self.leader = leader
+
+    def __iter__(self):
+        flight = self._flight
+        index = 0
+        while True:
+            with flight.cond:
+                while index >= len(flight.chunks) and not flight.finished:
+                    flight.cond.wait()
+                if index < len(flight.chunks):
+                    chunk = flight.chunks[index]
+                elif flight.error is not None:
+                    raise flight.error
+                else:
+                    return
+            index += 1
+            yield chunk
+
+    @property
+    def result(self) -> Optional[Dict[str, Any]]:
+        result = getattr(self._flight.source, "result", None)
+        if result is None:
+            return None
+        return dict(result, coalesced=not self.leader, coalesced_subscribers=self._flight.subscribers)
+
+class StreamingSingleFlight:
+    """key ごとに実行中のストリームを 1 本に限定し、チャンクを購読者へ配信する"""
+
+    def __init__(self):
+        self._flights: Dict[str, _StreamFlight] = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced": 0}
+
+    def subscribe(self, key: str, factory: Callable[[], Any]) -> FlightStream:
+        """
+        実行中の同一 key があればそれに参加し、なければ factory() の返すストリームを
+        バックグラウンドスレッドで読み始める（利用者の画面が閉じられても他の購読者には配信が続く）。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _StreamFlight(None)
+                self.stats["leaders"] += 1
+            else:
+                self.stats["coalesced"] += 1
+            flight.subscribers += 1
+
+        if leader:
+            def _finish():
+                with self._lock:
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+
+            # ストリームの準備（モデル生成など）はロックの外で行う。参加者は最初のチャンクまで待つだけ
+            try:
+                flight.source = factory()
+            except BaseException as e:
+                _finish()
+                with flight.cond:
+                    flight.error, flight.finished = e, True
+                    flight.cond.notify_all()
+                raise
+            threading.Thread(target=flight.run, args=(_finish,), daemon=True,
+                             name=f"SingleFlight-{key[:8]}").start()
+        else:
+            logger.info("🔗 single_flight — 実行中の同一ストリームに合流 key=%s subscribers=%d",
+                        key[:12], flight.subscribers)
+        return FlightStream(flight, leader=leader)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, in_flight=len(self._flights))
@@ -7,6 +7,9 @@ from src.equipment_classifier import extract_equipment_from_filename, get_equipm
 from src.fire_department_classifier import classify_files_by_jurisdiction, get_jurisdiction_stats, extract_fire_department_info  # 🔥 追加
 from src.gdrive_simple import download_files_from_drive, download_fix_files_from_drive
 from src.building_manager import initialize_building_manager, get_building_manager
+from src.rag_retriever import initialize_rag_index
+from src.table_store import get_table_store
+from src.answer_cache import get_answer_cache, compute_corpus_version
 from src.logging_utils import init_logger
 logger = init_logger()
 
@@ -162,8 +165,7 @@ def initialize_equipment_data(input_dir: str = "rag_data") -> dict:
         
         logger.info(f"🏷️ {filename} → タグ: {file_dict['jurisdiction_tag']}")
     
-    # 既存の設備データ作成処理（変更なし）
-    equipment_data = preprocess_files(file_dicts)
+    # 設備データ（本文・表）は上で作成済み（タグ付けは preprocess_files の結果に影響しないため再処理しない）
     
     # 🔥 設備データの各ファイルにもタグ情報を追加
     for equipment_name, eq_data in equipment_data.items():
@@ -184,6 +186,24 @@ def initialize_equipment_data(input_dir: str = "rag_data") -> dict:
     # 既存の戻り値に加えて、タグ統計も追加
     tag_stats = get_tag_statistics(file_dicts)
     
+    # 🔥 検索モード用: 永続RAGインデックスを読み込み、差分をバックグラウンド同期
+    try:
+        initialize_rag_index(equipment_data)
+    except Exception as e:
+        logger.error(f"❌ RAGインデックス初期化失敗: {e}")
+    
+    # 🔥 表検索用: 抽出済みの表を SQLite ストアへ差分同期
+    try:
+        get_table_store().sync_from_equipment_data(equipment_data)
+    except Exception as e:
+        logger.error(f"❌ 表ストア同期失敗: {e}")
+    
+    # 🔥 回答キャッシュ: 資料が変わっていれば古い版の回答を破棄
+    try:
+        get_answer_cache().set_corpus_version(compute_corpus_version(equipment_data))
+    except Exception as e:
+        logger.error(f"❌ 回答キャッシュの無効化に失敗: {e}")
+    
     return {
         "equipment_data": equipment_data,
         "file_list": file_dicts,
@@ -201,6 +221,20 @@ def get_tag_statistics(file_dicts: list) -> dict:
         stats[tag] = stats.get(tag, 0) + 1
     return stats
 
+def get_allowed_jurisdiction_tags(selected_jurisdiction: str = None) -> list:
+    """選択された管轄で利用可能なファイルタグ一覧を取得"""
+    if not selected_jurisdiction:
+        # 管轄指定なし → 一般設備資料のみ
+        return ["📄一般設備資料"]
+    elif selected_jurisdiction == "🔥東京消防庁":
+        # 東京消防庁 → 一般設備資料 + 一般消防資料 + 東京消防庁
+        return ["📄一般設備資料", "📄一般消防資料", "🔥東京消防庁"]
+    elif selected_jurisdiction == "🔥丸の内消防署":
+        # 丸の内消防署 → 一般設備資料 + 一般消防資料 + 東京消防庁 + 丸の内消防署
+        return ["📄一般設備資料", "📄一般消防資料", "🔥東京消防庁", "🔥丸の内消防署"]
+    else:
+        return ["📄一般設備資料"]
+
 # 🔥 新規関数: 管轄に基づいてフィルタされたファイルリストを取得
 def get_filtered_files_by_jurisdiction(equipment_name: str, selected_jurisdiction: str = None) -> list:
     """
@@ -221,18 +255,7 @@ def get_filtered_files_by_jurisdiction(equipment_name: str, selected_jurisdictio
     
     eq_data = equipment_data[equipment_name]
     tagged_sources = eq_data.get("tagged_sources", [])
-    
-    if not selected_jurisdiction:
-        # 管轄指定なし → 一般設備資料のみ
-        allowed_tags = ["📄一般設備資料"]
-    elif selected_jurisdiction == "🔥東京消防庁":
-        # 東京消防庁 → 一般設備資料 + 一般消防資料 + 東京消防庁
-        allowed_tags = ["📄一般設備資料", "📄一般消防資料", "🔥東京消防庁"]
-    elif selected_jurisdiction == "🔥丸の内消防署":
-        # 丸の内消防署 → 一般設備資料 + 一般消防資料 + 東京消防庁 + 丸の内消防署
-        allowed_tags = ["📄一般設備資料", "📄一般消防資料", "🔥東京消防庁", "🔥丸の内消防署"]
-    else:
-        allowed_tags = ["📄一般設備資料"]
+    allowed_tags = get_allowed_jurisdiction_tags(selected_jurisdiction)
     
     # フィルタリング
     filtered_files = []
@@ -0,0 +1,313 @@
+# src/table_store.py
+"""
+法令・基準の表（早見表など）のローカル SQLite ストアと決定的な行検索
+
+PDF から抽出した正規化済みの表（rag_preprocess.normalize_table の出力）を保存し、
+質問のキーワードから候補の表を探して該当する行だけを返す。
+プロンプトには資料全文ではなく、列ヘッダー + 数行だけを載せられる。
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, List, Optional, Sequence
+
+from src.embedding_cache import content_hash, get_cache_dir
+from src.rag_lexical import tokenize_ngrams
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "infer_column_type",
+    "parse_cell_value",
+    "RegulationTableStore",
+    "get_table_store",
+    "format_table_lookup",
+]
+
+# 数値 + 単位（例: "90", "1.5m", "150m²", "20 ㎡以下"）
+_NUMBER_WITH_UNIT = re.compile(r"^([-+]?\d+(?:,\d{3})*(?:\.\d+)?)\s*([^\d\s][^\s]{0,5})?$")
+
+# ---------------------------------------------------------------------------
+# 型推定
+# ---------------------------------------------------------------------------
+def parse_cell_value(cell: str) -> Dict[str, Any]:
+    """セル文字列を {"value": int|float|str, "unit": str|None} に変換"""
+    text = unicodedata.normalize("NFKC", cell or "").strip()
+    match = _NUMBER_WITH_UNIT.match(text)
+    if not match:
+        return {"value": cell, "unit": None}
+    number = match.group(1).replace(",", "")
+    value: Any = float(number) if "." in number else int(number)
+    return {"value": value, "unit": match.group(2) or None}
+
+def infer_column_type(cells: Sequence[str]) -> Dict[str, Any]:
+    """
+    列の型を推定する。空でないセルの 8 割以上が数値なら INTEGER / REAL、
+    それ以外は TEXT。単位が揃っていれば unit も返す。
+    """
+    parsed = [parse_cell_value(c) for c in cells if c and c.strip()]
+    numbers = [p for p in parsed if not isinstance(p["value"], str)]
+    if not parsed or len(numbers) / len(parsed) < 0.8:
+        return {"type": "TEXT", "unit": None}
+    col_type = "REAL" if any(isinstance(p["value"], float) for p in numbers) else "INTEGER"
+    units = {p["unit"] for p in numbers if p["unit"]}
+    return {"type": col_type, "unit": units.pop() if len(units) == 1 else None}
+
+def _typed_row(row: Sequence[str], column_types: Sequence[Dict[str, Any]]) -> List[Any]:
+    values: List[Any] = []
+    for cell, col_type in zip(row, column_types):
+        parsed = parse_cell_value(cell)
+        values.append(parsed["value"] if col_type["type"] != "TEXT" and not isinstance(parsed["value"], str) else cell)
+    return values
+
+# ---------------------------------------------------------------------------
+# ストア本体
+# ---------------------------------------------------------------------------
+class RegulationTableStore:
+    """表カタログ（regulation_tables）と行（regulation_table_rows）の 2 テーブル構成"""
+
+    def __init__(self, db_path: str | None = None):
+        self.db_path = db_path or os.path.join(get_cache_dir(), "regulation_tables.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS regulation_tables (
+                table_key      TEXT PRIMARY KEY,
+                equipment_name TEXT NOT NULL,
+                source         TEXT NOT NULL,
+                page           INTEGER,
+                table_id       INTEGER,
+                header_json    TEXT NOT NULL,
+                column_types   TEXT NOT NULL,
+                search_text    TEXT NOT NULL,
+                content_hash   TEXT NOT NULL,
+                updated_at     REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS regulation_table_rows (
+                table_key  TEXT NOT NULL,
+                row_idx    INTEGER NOT NULL,
+                cells_json TEXT NOT NULL,
+                values_json TEXT NOT NULL,
+                PRIMARY KEY (table_key, row_idx)
+            );
+            CREATE INDEX IF NOT EXISTS idx_regulation_tables_scope
+                ON regulation_tables (equipment_name, source);
+            """
+        )
+        self._conn.commit()
+        # 検索用の n-gram 集合（表ごと）をメモリに保持
+        self._catalog: Dict[str, Dict[str, Any]] = {}
+        self._load_catalog()
+
+    def _load_catalog(self) -> None:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT table_key, equipment_name, source, page, table_id, header_json, column_types, search_text "
+                "FROM regulation_tables"
+            ).fetchall()
+        self._catalog = {
+            key: {
+                "table_key": key,
+                "equipment_name": equipment_name,
+                "source": source,
+                "page": page,
+                "table_id": table_id,
+                "header": json.loads(header_json),
+                "column_types": json.loads(column_types),
+                "terms": set(tokenize_ngrams(search_text)),
+            }
+            for key, equipment_name, source, page, table_id, header_json, column_types, search_text in rows
+        }
+
+    # — 同期 —
+    def sync_from_equipment_data(self, equipment_data: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+        """
+        preprocess_files の出力に含まれる表をストアへ差分同期する。
+        内容ハッシュが変わらない表は書き換えず、消えた表は削除する。
+        """
+        t0 = time.perf_counter()
+        with self._lock:
+            existing = dict(self._conn.execute("SELECT table_key, content_hash FROM regulation_tables").fetchall())
+
+        seen = set()
+        inserted = 0
+        now = time.time()
+        with self._lock:
+            for equipment_name, eq_data in equipment_data.items():
+                for source, tables in eq_data.get("tables", {}).items():
+                    for table in tables:
+                        key = f"{equipment_name}|{source}|p{table['page']}|t{table['table_id']}"
+                        digest = content_hash(json.dumps([table["header"], table["rows"]], ensure_ascii=False))
+                        seen.add(key)
+                        if existing.get(key) == digest:
+                            continue
+
+                        column_types = [
+                            infer_column_type([row[col] for row in table["rows"] if col < len(row)])
+                            for col in range(len(table["header"]))
+                        ]
+                        search_text = " ".join([source, *table["header"], *(" ".join(r) for r in table["rows"])])
+                        self._conn.execute("DELETE FROM regulation_table_rows WHERE table_key = ?", (key,))
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO regulation_tables "
+                            "(table_key, equipment_name, source, page, table_id, header_json, column_types, "
+                            " search_text, content_hash, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (key, equipment_name, source, table["page"], table["table_id"],
+                             json.dumps(table["header"], ensure_ascii=False),
+                             json.dumps(column_types, ensure_ascii=False),
+                             search_text, digest, now),
+                        )
+                        self._conn.executemany(
+                            "INSERT INTO regulation_table_rows (table_key, row_idx, cells_json, values_json) "
+                            "VALUES (?, ?, ?, ?)",
+                            [
+                                (key, idx, json.dumps(row, ensure_ascii=False),
+                                 json.dumps(_typed_row(row, column_types), ensure_ascii=False))
+                                for idx, row in enumerate(table["rows"])
+                            ],
+                        )
+                        inserted += 1
+
+            stale = [key for key in existing if key not in seen]
+            for key in stale:
+                self._conn.execute("DELETE FROM regulation_tables WHERE table_key = ?", (key,))
+                self._conn.execute("DELETE FROM regulation_table_rows WHERE table_key = ?", (key,))
+            self._conn.commit()
+
+        self._load_catalog()
+        result = {"upserted": inserted, "deleted": len(stale), "unchanged": len(seen) - inserted}
+        logger.info("🗃️ 表ストア同期 — tables=%d upserted=%d deleted=%d elapsed=%.2fs",
+                    len(seen), inserted, len(stale), time.perf_counter() - t0)
+        return result
+
+    # — 検索 —
+    def find_tables(
+        self,
+        query: str,
+        *,
+        equipment_name: Optional[str] = None,
+        sources: Optional[Sequence[str]] = None,
+        limit: int = 3,
+        min_score: float = 0.15,
+    ) -> List[Dict[str, Any]]:
+        """
+        クエリの n-gram が表（ファイル名・列ヘッダー・セル）にどれだけ含まれるかで候補の表を返す。
+        score はクエリ n-gram のうち表に現れる割合（0〜1）。
+        """
+        query_terms = set(tokenize_ngrams(query))
+        if not query_terms:
+            return []
+        source_set = set(sources) if sources else None
+
+        scored = []
+        for entry in self._catalog.values():
+            if equipment_name and entry["equipment_name"] != equipment_name:
+                continue
+            if source_set is not None and entry["source"] not in source_set:
+                continue
+            score = len(query_terms & entry["terms"]) / len(query_terms)
+            if score >= min_score:
+                scored.append((score, entry))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [dict(entry, score=score) for score, entry in scored[:limit]]
+
+    def get_rows(self, table_key: str) -> List[Dict[str, Any]]:
+        """表の全行（cells: 文字列, values: 型付き値）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT row_idx, cells_json, values_json FROM regulation_table_rows "
+                "WHERE table_key = ? ORDER BY row_idx",
+                (table_key,),
+            ).fetchall()
+        return [
+            {"row_idx": idx, "cells": json.loads(cells), "values": json.loads(values)}
+            for idx, cells, values in rows
+        ]
+
+    def lookup(
+        self,
+        query: str,
+        *,
+        equipment_name: Optional[str] = None,
+        sources: Optional[Sequence[str]] = None,
+        max_tables: int = 2,
+        max_rows: int = 6,
+    ) -> List[Dict[str, Any]]:
+        """
+        候補の表ごとに、クエリと一致する n-gram が多い行（最良行の半分以上の一致）を
+        最大 max_rows 行返す（元の行順を維持）。
+        一致する行がない表は、行数が max_rows 以下なら全行を返し、それ以外は除外する。
+        """
+        query_terms = set(tokenize_ngrams(query))
+        results: List[Dict[str, Any]] = []
+        for table in self.find_tables(query, equipment_name=equipment_name, sources=sources, limit=max_tables):
+            rows = self.get_rows(table["table_key"])
+            scored = [
+                (len(query_terms & set(tokenize_ngrams(" ".join(row["cells"])))), row)
+                for row in rows
+            ]
+            best = max((score for score, _ in scored), default=0)
+            # 最も一致した行の半分以上のスコアを持つ行だけを残す
+            matched = [item for item in scored if item[0] > 0 and item[0] * 2 >= best]
+            if matched:
+                top = sorted(matched, key=lambda item: item[0], reverse=True)[:max_rows]
+                picked = sorted((row for _, row in top), key=lambda row: row["row_idx"])
+            elif len(rows) <= max_rows:
+                picked = rows
+            else:
+                continue
+            results.append({
+                "source": table["source"],
+                "page": table["page"],
+                "table_id": table["table_id"],
+                "header": table["header"],
+                "column_types": table["column_types"],
+                "rows": picked,
+                "total_rows": len(rows),
+                "score": table["score"],
+            })
+        return results
+
+    def count(self) -> int:
+        return len(self._catalog)
+
+def format_table_lookup(results: List[Dict[str, Any]]) -> str:
+    """lookup の結果をプロンプト用の Markdown 表に整形"""
+    parts = []
+    for result in results:
+        header = [
+            f"{name}[{col_type['unit']}]" if col_type.get("unit") else name
+            for name, col_type in zip(result["header"], result["column_types"])
+        ]
+        lines = [
+            f"=== 表: {result['source']} (p.{result['page']} 表{result['table_id']}, "
+            f"{len(result['rows'])}/{result['total_rows']}行) ===",
+            "| " + " | ".join(header) + " |",
+            "|" + "---|" * len(header),
+        ]
+        lines.extend("| " + " | ".join(row["cells"]) + " |" for row in result["rows"])
+        parts.append("\n".join(lines))
+    return "\n\n".join(parts)
+
+# ---------------------------------------------------------------------------
+# シングルトン
+# ---------------------------------------------------------------------------
+_table_store: Optional[RegulationTableStore] = None
+_table_store_lock = threading.Lock()
+
+def get_table_store() -> RegulationTableStore:
+    """プロセス共通の RegulationTableStore を取得"""
+    global _table_store
+    with _table_store_lock:
+        if _table_store is None:
+            _table_store = RegulationTableStore()
+            logger.info("🗃️ RegulationTableStore 初期化: %s (%d 表)", _table_store.db_path, _table_store.count())
+        return _table_store
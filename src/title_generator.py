@@ -0,0 +1,95 @@
+# src/title_generator.py
+"""
+チャットタイトルの生成（回答生成とは別経路）
+
+初回の質問からタイトルを作る。TITLE_MODEL が設定されていれば小さいモデルで生成し、
+未設定・失敗・タイムアウト時はローカルのヒューリスティックで作る。
+回答のストリーミングを妨げないよう、バックグラウンドのスレッドプールで実行して Future を返す。
+"""
+from __future__ import annotations
+
+import os
+import re
+import time
+import unicodedata
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "TITLE_MODEL",
+    "heuristic_title",
+    "generate_title",
+    "generate_title_async",
+]
+
+# "heuristic" の場合は LLM を使わない（例: TITLE_MODEL=gpt-4o-mini で Azure の小型デプロイを使用）
+TITLE_MODEL = os.getenv("TITLE_MODEL", "heuristic")
+_TITLE_MAX_CHARS = 30
+
+_title_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="TitleGen")
+
+# 質問文の末尾によくある依頼・疑問表現（タイトルには不要）
+_TRAILING_PHRASES = re.compile(
+    r"(について)?(を)?(詳しく|簡単に)?(教えて(ください|下さい|ほしい|欲しい)?|知りたい(です)?|"
+    r"ありますか|ですか|でしょうか|ますか|か)?[。．.？?！!\s]*$"
+)
+_LEADING_PHRASES = re.compile(r"^(すみません|質問です|お疲れ様です)[、,。\s]*")
+
+def heuristic_title(question: str) -> str:
+    """質問文の最初の文から依頼表現を取り除き、30文字以内に収めたタイトル"""
+    text = unicodedata.normalize("NFKC", question or "").strip()
+    text = re.sub(r"\s+", " ", text)
+    text = _LEADING_PHRASES.sub("", text)
+    first_sentence = re.split(r"(?<=[。？?！!])\s*|\n", text, maxsplit=1)[0]
+    title = _TRAILING_PHRASES.sub("", first_sentence).strip(" 、,「」『』\"'")
+    if not title:
+        title = first_sentence.strip() or "Chat"
+    if len(title) > _TITLE_MAX_CHARS:
+        title = title[:_TITLE_MAX_CHARS - 1] + "…"
+    return title
+
+def _llm_title(question: str, model: str) -> str:
+    from langchain_core.messages import HumanMessage, SystemMessage
+    from src.admission import ADMISSION_ENABLED, get_admission_controller
+    from src.resilience import call_with_retry
+    from src.langchain_models import get_chat_model, get_provider
+    from src.usage_ledger import record_usage, usage_or_estimate
+
+    chat_model = get_chat_model(model, temperature=0.0, max_tokens=60)
+    prompt_messages = [
+        SystemMessage(content=f"ユーザーの質問に対して、会話のタイトルを{_TITLE_MAX_CHARS}文字以内の日本語で1つだけ出力してください。"
+                              "タイトル以外の文字（説明・引用符・句点）は出力しないでください。"),
+        HumanMessage(content=question[:2000]),
+    ]
+    t0 = time.perf_counter()
+    if ADMISSION_ENABLED:
+        # バックグラウンド処理なので長くは待たない（待ちきれなければヒューリスティックで代替）
+        with get_admission_controller().admit(get_provider(model), "background", timeout=10):
+            response = call_with_retry(get_provider(model), lambda: chat_model.invoke(prompt_messages), max_attempts=2)
+    else:
+        response = call_with_retry(get_provider(model), lambda: chat_model.invoke(prompt_messages), max_attempts=2)
+    usage, estimated = usage_or_estimate(response, question[:2000])
+    record_usage(model=model, usage=usage, purpose="title", latency_s=time.perf_counter() - t0, estimated=estimated)
+    return str(response.content).strip().splitlines()[0] if response.content else ""
+
+def generate_title(question: str, model: Optional[str] = None) -> str:
+    """タイトルを同期生成（LLM が使えない・失敗した場合はヒューリスティック）"""
+    model = model or TITLE_MODEL
+    if model and model != "heuristic":
+        try:
+            title = _llm_title(question, model)
+            if title:
+                logger.info("🏷️ タイトル生成 (model=%s): %s", model, title)
+                return title
+        except Exception as e:
+            logger.warning("⚠️ タイトル生成失敗 (model=%s)、ヒューリスティックで代替: %s", model, e)
+    title = heuristic_title(question)
+    logger.info("🏷️ タイトル生成 (heuristic): %s", title)
+    return title
+
+def generate_title_async(question: str, model: Optional[str] = None) -> "Future[str]":
+    """タイトル生成をバックグラウンドで開始し Future を返す"""
+    return _title_executor.submit(generate_title, question, model)
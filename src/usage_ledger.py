@@ -0,0 +1,238 @@
+# src/usage_ledger.py
+"""
+LLM 呼び出しごとのトークン使用量・コストの記録と集計
+
+回答生成・比較モード・タイトル生成・履歴要約の各呼び出しについて、プロバイダが返した usage
+（入力 / 出力 / キャッシュ読み込み / キャッシュ書き込みトークン）とレイテンシ・モデルを SQLite に記録し、
+ユーザー・モード・モデル・設備・ファイル単位で集計する（どのモード・資料がコストを押し上げているかの把握用）。
+
+- 単価は MODEL_PRICING（USD / 100 万トークン）。USAGE_PRICING_JSON で上書き・追加できる
+- プロバイダが usage を返さなかった呼び出しは概算値で記録し estimated=1 とする
+"""
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.embedding_cache import get_cache_dir
+from src.logging_utils import init_logger
+logger = init_logger()
+
+__all__ = [
+    "MODEL_PRICING",
+    "estimate_cost",
+    "usage_from_message",
+    "usage_or_estimate",
+    "UsageLedger",
+    "get_usage_ledger",
+    "record_usage",
+]
+
+# USD / 100 万トークン（input は通常入力、cache_read / cache_write はプロンプトキャッシュ分）
+MODEL_PRICING: Dict[str, Dict[str, float]] = {
+    "claude-4-sonnet": {"input": 3.00, "output": 15.00, "cache_read": 0.30, "cache_write": 3.75},
+    "claude-3.7": {"input": 3.00, "output": 15.00, "cache_read": 0.30, "cache_write": 3.75},
+    "gpt-4.1": {"input": 2.00, "output": 8.00, "cache_read": 0.50, "cache_write": 2.00},
+    "gpt-4o": {"input": 2.50, "output": 10.00, "cache_read": 1.25, "cache_write": 2.50},
+}
+try:
+    MODEL_PRICING.update(json.loads(os.getenv("USAGE_PRICING_JSON", "") or "{}"))
+except ValueError as e:
+    logger.warning(f"⚠️ USAGE_PRICING_JSON を解釈できないため既定の単価を使用: {e}")
+
+_GROUP_COLUMNS = ("user", "mode", "model", "purpose", "equipment", "day")
+_warned_models: set = set()
+
+def estimate_cost(model: str, usage: Dict[str, int]) -> float:
+    """
+    usage から USD のコストを計算する。
+    input_tokens はキャッシュ読み書き分を含む合計として扱い、その分を差し引いて通常入力の単価を掛ける。
+    """
+    pricing = MODEL_PRICING.get(model)
+    if pricing is None:
+        if model not in _warned_models:
+            _warned_models.add(model)
+            logger.warning("⚠️ usage_ledger — 単価未登録のモデル %s はコスト 0 として記録", model)
+        return 0.0
+    cache_read = usage.get("cache_read_tokens", 0) or 0
+    cache_write = usage.get("cache_write_tokens", 0) or 0
+    plain_input = max((usage.get("input_tokens", 0) or 0) - cache_read - cache_write, 0)
+    cost = (
+        plain_input * pricing["input"]
+        + (usage.get("output_tokens", 0) or 0) * pricing["output"]
+        + cache_read * pricing.get("cache_read", pricing["input"])
+        + cache_write * pricing.get("cache_write", pricing["input"])
+    )
+    return cost / 1_000_000
+
+def usage_from_message(message: Any) -> Optional[Dict[str, int]]:
+    """AIMessage.usage_metadata を usage_ledger 形式に変換（usage が返らなかった場合は None）"""
+    metadata = getattr(message, "usage_metadata", None)
+    if not metadata:
+        return None
+    details = metadata.get("input_token_details") or {}
+    return {
+        "input_tokens": metadata.get("input_tokens", 0) or 0,
+        "output_tokens": metadata.get("output_tokens", 0) or 0,
+        "cache_read_tokens": details.get("cache_read", 0) or 0,
+        "cache_write_tokens": details.get("cache_creation", 0) or 0,
+    }
+
+def usage_or_estimate(message: Any, prompt_text: str) -> Tuple[Dict[str, int], bool]:
+    """(usage, estimated)。usage が返らなかった場合は送信文と応答の文字数から概算する"""
+    usage = usage_from_message(message)
+    if usage is not None:
+        return usage, False
+    from src.context_packer import estimate_tokens
+    return {"input_tokens": estimate_tokens(prompt_text),
+            "output_tokens": estimate_tokens(str(getattr(message, "content", "") or ""))}, True
+
+class UsageLedger:
+    """SQLite に呼び出し単位の使用量を保存し、任意の列で集計する"""
+
+    def __init__(self, db_path: str | None = None):
+        self.db_path = db_path or os.path.join(get_cache_dir(), "usage_ledger.sqlite3")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS usage_ledger (
+                id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts                 REAL NOT NULL,
+                day                TEXT NOT NULL,
+                user               TEXT NOT NULL,
+                sid                TEXT,
+                mode               TEXT NOT NULL,
+                model              TEXT NOT NULL,
+                purpose            TEXT NOT NULL,
+                equipment          TEXT,
+                files              TEXT,
+                input_tokens       INTEGER NOT NULL,
+                output_tokens      INTEGER NOT NULL,
+                cache_read_tokens  INTEGER NOT NULL,
+                cache_write_tokens INTEGER NOT NULL,
+                latency_s          REAL,
+                cost_usd           REAL NOT NULL,
+                estimated          INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_usage_ledger_ts ON usage_ledger (ts);
+            """
+        )
+        self._conn.commit()
+
+    def record(
+        self,
+        *,
+        model: str,
+        usage: Dict[str, int],
+        purpose: str = "answer",
+        user: Optional[str] = None,
+        mode: Optional[str] = None,
+        sid: Optional[str] = None,
+        equipment: Optional[str] = None,
+        files: Optional[Sequence[str]] = None,
+        latency_s: Optional[float] = None,
+        estimated: bool = False,
+    ) -> Dict[str, Any]:
+        """1 回の呼び出しを記録し、コストを含む記録内容（ターンの結果・ログにそのまま添付できる形）を返す"""
+        ts = time.time()
+        record = {
+            "model": model,
+            "purpose": purpose,
+            "input_tokens": int(usage.get("input_tokens", 0) or 0),
+            "output_tokens": int(usage.get("output_tokens", 0) or 0),
+            "cache_read_tokens": int(usage.get("cache_read_tokens", 0) or 0),
+            "cache_write_tokens": int(usage.get("cache_write_tokens", 0) or 0),
+            "latency_s": round(latency_s, 3) if latency_s is not None else None,
+            "cost_usd": round(estimate_cost(model, usage), 6),
+            "estimated": bool(estimated),
+        }
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO usage_ledger (ts, day, user, sid, mode, model, purpose, equipment, files, "
+                "input_tokens, output_tokens, cache_read_tokens, cache_write_tokens, latency_s, cost_usd, estimated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (ts, time.strftime("%Y-%m-%d", time.localtime(ts)), user or "-", sid, mode or "-", model, purpose,
+                 equipment, json.dumps(list(files or []), ensure_ascii=False),
+                 record["input_tokens"], record["output_tokens"], record["cache_read_tokens"],
+                 record["cache_write_tokens"], latency_s, record["cost_usd"], int(estimated)),
+            )
+            self._conn.commit()
+        logger.info("💰 usage — purpose=%s user=%s mode=%s model=%s in=%d out=%d cache_read=%d cost=$%.4f%s",
+                    purpose, user or "-", mode or "-", model, record["input_tokens"], record["output_tokens"],
+                    record["cache_read_tokens"], record["cost_usd"], " (推定)" if estimated else "")
+        return record
+
+    def aggregate(self, group_by: Sequence[str] = ("user", "mode", "model"),
+                  since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """group_by の列ごとの呼び出し数・トークン数・コスト（コストの大きい順）"""
+        columns = [c for c in group_by if c in _GROUP_COLUMNS]
+        if len(columns) != len(group_by):
+            raise ValueError(f"group_by は {_GROUP_COLUMNS} から選択してください: {group_by}")
+        select = ", ".join(columns + [
+            "COUNT(*) AS calls", "SUM(input_tokens) AS input_tokens", "SUM(output_tokens) AS output_tokens",
+            "SUM(cache_read_tokens) AS cache_read_tokens", "SUM(cache_write_tokens) AS cache_write_tokens",
+            "SUM(cost_usd) AS cost_usd", "AVG(latency_s) AS avg_latency_s",
+        ])
+        sql = f"SELECT {select} FROM usage_ledger WHERE ts >= ?"
+        if columns:
+            sql += f" GROUP BY {', '.join(columns)}"
+        sql += " ORDER BY cost_usd DESC"
+        with self._lock:
+            cursor = self._conn.execute(sql, (since or 0.0,))
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def aggregate_by_file(self, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        資料ファイルごとの集計。1 ターンで複数ファイルを使った場合、そのターンのトークン・コストは
+        ファイル数で等分して各ファイルに配分する。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT equipment, files, input_tokens, output_tokens, cost_usd FROM usage_ledger "
+                "WHERE ts >= ? AND files IS NOT NULL AND files != '[]'", (since or 0.0,),
+            ).fetchall()
+        totals: Dict[tuple, Dict[str, Any]] = {}
+        for equipment, files_json, input_tokens, output_tokens, cost_usd in rows:
+            files = json.loads(files_json)
+            share = 1.0 / len(files)
+            for file_name in files:
+                entry = totals.setdefault((equipment, file_name), {
+                    "equipment": equipment, "file": file_name, "turns": 0,
+                    "input_tokens": 0.0, "output_tokens": 0.0, "cost_usd": 0.0,
+                })
+                entry["turns"] += 1
+                entry["input_tokens"] += input_tokens * share
+                entry["output_tokens"] += output_tokens * share
+                entry["cost_usd"] += cost_usd * share
+        return sorted(totals.values(), key=lambda e: e["cost_usd"], reverse=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        totals = self.aggregate(group_by=())
+        return totals[0] if totals else {}
+
+_usage_ledger: Optional[UsageLedger] = None
+_usage_ledger_lock = threading.Lock()
+
+def get_usage_ledger() -> UsageLedger:
+    """プロセス共通の UsageLedger を取得"""
+    global _usage_ledger
+    with _usage_ledger_lock:
+        if _usage_ledger is None:
+            _usage_ledger = UsageLedger()
+            logger.info("💰 UsageLedger 初期化: %s", _usage_ledger.db_path)
+        return _usage_ledger
+
+def record_usage(**kwargs: Any) -> Optional[Dict[str, Any]]:
+    """UsageLedger.record の失敗を握りつぶす便利関数（記録の失敗で回答処理を止めない）"""
+    try:
+        return get_usage_ledger().record(**kwargs)
+    except Exception as e:
+        logger.warning(f"⚠️ 使用量の記録に失敗: {e}")
+        return None